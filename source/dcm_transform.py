@@ -11,11 +11,25 @@
     - Supports 3D transforms (ImagePositionPatient and ImageOrientationPatient)
         by allowing adding position offset
           or rotating the image (see -x, -y, -z, -ax, -ay &-az script parameters).
-    - Supports changing any dicom tag value that can be expressed
-        as a key, value pair (see -tags parameter).
+    - Supports changing, creating or deleting any dicom tag value that can be expressed
+        as a key, value pair, nested in sequences or not (see -tags and -tagfile parameters).
+    - Supports pixel edits on native and encapsulated (RLE, JPEG, ...) pixel data,
+        only the edited frames are decoded and encoded back.
+    - Supports drawing per instance shapes from csv or json annotation files
+        (see -annotations parameter).
+    - Supports drawing spheres, boxes and cylinders given in patient mm where they
+        cross each slice, slices they miss are left undecoded (see -roi3d parameter).
+    - Supports writing the shapes as overlay planes or presentation states instead,
+        leaving the pixel data untouched (see -overlay parameter).
+    - Supports logging the old and new values of every changed tag in a csv, SQLite
+        or Parquet audit file (see -audit parameter).
     - Support recursive tree traversal in order to run in batch mode
         and replicate a complete dicom tree directory
           structure with the required modifications applied to it.
+    - Supports splitting a tree by series across several nodes (see -shard
+        and -merge_shards parameters).
+    - Supports applying different option sets to different files in a single
+        read and write pass, chosen by header predicates (see -jobs parameter).
 
     - Requires Python 2.7.x, 3.6.x or better
     - Requires Packages: pydicom (as well as scipy, numpy if you don't use anaconda)
@@ -46,9 +60,25 @@
 """
 
 from __future__ import print_function
-import os, sys, math, argparse, time
+import os, sys, io, math, argparse, time, struct, copy, json, itertools, zlib, tempfile, fnmatch, glob
+import hashlib, re, binascii, random, csv, sqlite3, functools
 import os.path
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # noinspection PyUnresolvedReferences
+        from scandir import scandir  # python 2.7 backport
+    except ImportError:
+        scandir = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # parquet audit logs are written as csv instead
 
 import numpy as np
 
@@ -62,34 +92,62 @@ except ImportError:
 
 # ------------------------------------------------------------------------------
 class PixelEditor:
-    """ Pixel editing utility class for drawing simple geometries inside the 2D pixel array"""
+    """ Pixel editing utility class for drawing simple geometries inside the 2D pixel array
+        of one or more frames, the buffer is shaped (frames, rows, cols, samples)"""
     pixel_buffer = None
 
     # ------------------------------------------------------------------------------
     def __init__(self, the_buf):
-        """Constructor from a pixel buffer"""
+        """Constructor from a pixel buffer, a plain 2D (rows, cols) array is accepted too"""
+        if the_buf.ndim == 2:
+            the_buf = the_buf.reshape((1,) + the_buf.shape + (1,))
         self.pixel_buffer = the_buf
 
     # ------------------------------------------------------------------------------
     def buffer_length(self):
         """Get contained pixel buffer length."""
-        return len(self.pixel_buffer)
+        return self.pixel_buffer.size
 
     # ------------------------------------------------------------------------------
     def buffer_to_string(self):
         """Get contained pixel buffer as a string."""
-        return self.pixel_buffer.tostring()
+        return self.pixel_buffer.tobytes()
+
+    # ------------------------------------------------------------------------------
+    def blend_region(self, region, val, alpha=1.0):
+        """Blend value val (a scalar or one value per sample) into a (rows, cols) region
+           of all the frames at once, region being slices, a 2D mask or index arrays"""
+        index = (slice(None),) + tuple(region)
+        value = np.asarray(val, dtype=np.float64)
+        if alpha >= 1.0:
+            blend = value
+        else:
+            blend = self.pixel_buffer[index] * (1 - alpha) + value * alpha
+        if self.pixel_buffer.dtype.kind in 'iu':
+            limits = np.iinfo(self.pixel_buffer.dtype)
+            blend = np.clip(blend, limits.min, limits.max)
+        self.pixel_buffer[index] = blend
+
+    # ------------------------------------------------------------------------------
+    def fill_mask(self, mask, val, alpha=1.0):
+        """Blend value val in all the pixels of a (rows, cols) boolean mask"""
+        self.blend_region((mask,), val, alpha)
 
     # ------------------------------------------------------------------------------
     def draw_pixel(self, pos_x, width, xstep, pos_y, height, ystep, val, alpha=1.0):
         """Set a pixel buffer value val at x, y to x+w, y+h with an xstep and ystep increments """
-        for col in range(int(pos_x), int(pos_x + width), xstep):
-            for row in range(int(pos_y), int(pos_y + height), ystep):
-                #            print(col, row)
-                orig = self.pixel_buffer[row, col] * (1 - alpha)
-                new = val * alpha
-                blend = orig + new
-                self.pixel_buffer[row, col] = blend
+        rows, cols = self.pixel_buffer.shape[1:3]
+        start_x, start_y = int(pos_x), int(pos_y)
+        # skip the leading out of buffer pixels while keeping the step phase
+        if start_x < 0:
+            start_x += -(-start_x // xstep) * xstep
+        if start_y < 0:
+            start_y += -(-start_y // ystep) * ystep
+        end_x = min(int(pos_x + width), cols)
+        end_y = min(int(pos_y + height), rows)
+        if start_x >= end_x or start_y >= end_y:
+            return
+        self.blend_region((slice(start_y, end_y, ystep), slice(start_x, end_x, xstep)), val, alpha)
 
     # ------------------------------------------------------------------------------
     def draw_hline(self, pos_x, pos_y, width, step, val, alpha=1.0):
@@ -104,10 +162,14 @@ class PixelEditor:
     # ------------------------------------------------------------------------------
     def draw_elp(self, pos_x, pos_y, width, height, val, alpha=1.0, step=1):
         """ Draws an ellipse"""
-        for theta in range(0, 360, step):
-            point_x1 = pos_x + width / 2.0 * math.cos(theta / 180.0 * math.pi)
-            point_y1 = pos_y - height / 2.0 * math.sin(theta / 180.0 * math.pi)
-            self.draw_pixel(int(point_x1), 1, 1, int(point_y1), 1, 1, val, alpha)
+        theta = np.arange(0, 360, step) / 180.0 * math.pi
+        points_x = (pos_x + width / 2.0 * np.cos(theta)).astype(int)
+        points_y = (pos_y - height / 2.0 * np.sin(theta)).astype(int)
+        rows, cols = self.pixel_buffer.shape[1:3]
+        inside = (points_x >= 0) & (points_x < cols) & (points_y >= 0) & (points_y < rows)
+        mask = np.zeros((rows, cols), dtype=bool)
+        mask[points_y[inside], points_x[inside]] = True
+        self.fill_mask(mask, val, alpha)
 
     # ------------------------------------------------------------------------------
     def draw_rect(self, pos_x, pos_y, width, height, step, val, alpha=1.0):
@@ -120,8 +182,7 @@ class PixelEditor:
     # ------------------------------------------------------------------------------
     def draw_frect(self, pos_x, pos_y, width, height, val, alpha=1.0):
         """Draws a rect in the buffer at x, y to x+w, y+h with an [0, ] transparency factor """
-        for i in range(int(pos_y), int(pos_y + height)):
-            self.draw_hline(pos_x, i, width, 1, val, alpha)
+        self.draw_pixel(pos_x, width, 1, int(pos_y), int(pos_y + height) - int(pos_y), 1, val, alpha)
 
     # ------------------------------------------------------------------------------
     def draw_xhair(self, pos_x, pos_y, pen_size, width, val, alpha=1.0):
@@ -140,6 +201,1323 @@ class PixelEditor:
                         rounded_width, line_len - half_width, val, alpha)
 
 
+# ------------------------------------------------------------------------------
+class PixelTransform:
+    """ Vectorized pixel intensity transforms (lookup table, linear rescale, threshold, clip and
+        seeded gaussian noise) of the (frames, rows, cols, samples) buffer of a pixel session.
+        The deterministic steps are folded in one lookup table per stored pixel range, computed
+        once and reused for all the files sharing that range"""
+    lut_points = None
+    rescale = None
+    threshold = None
+    clip = None
+    noise_sigma = 0.0
+    noise_seed = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, lut_points=None, rescale=None, threshold=None, clip=None,
+                 noise_sigma=0.0, noise_seed=None):
+        """Constructor from the (inputs, outputs) lut points, (slope, intercept) rescale,
+           (threshold, low, high) threshold, (min, max) clip and noise parameters"""
+        self.lut_points = lut_points
+        self.rescale = rescale
+        self.threshold = threshold
+        self.clip = clip
+        self.noise_sigma = noise_sigma
+        self.noise_seed = noise_seed
+        self._luts = {}
+
+    # ------------------------------------------------------------------------------
+    def is_mapping(self):
+        """Tell if there is any deterministic value mapping step"""
+        return self.lut_points is not None or self.rescale is not None \
+            or self.threshold is not None or self.clip is not None
+
+    # ------------------------------------------------------------------------------
+    def map_values(self, values):
+        """Apply the deterministic steps to a float array of pixel values"""
+        if self.lut_points is not None:
+            values = np.interp(values, self.lut_points[0], self.lut_points[1])
+        if self.rescale is not None:
+            values = values * self.rescale[0] + self.rescale[1]
+        if self.threshold is not None:
+            values = np.where(values < self.threshold[0], self.threshold[1], self.threshold[2])
+        if self.clip is not None:
+            values = np.clip(values, self.clip[0], self.clip[1])
+        return values
+
+    # ------------------------------------------------------------------------------
+    def lookup_table(self, first, last, dtype):
+        """Get the cached lookup table of the stored values first to last for an integer dtype"""
+        key = (first, last, dtype.str)
+        if key not in self._luts:
+            limits = np.iinfo(dtype)
+            values = self.map_values(np.arange(first, last + 1, dtype=np.float64))
+            self._luts[key] = np.clip(np.rint(values), limits.min, limits.max).astype(dtype)
+        return self._luts[key]
+
+    # ------------------------------------------------------------------------------
+    def apply(self, dataset, pixel_session):
+        """Transform the selected frames of the pixel session, updating BitsStored when needed"""
+        if not pixel_session.has_pixels():
+            return
+        buf = pixel_session.editor().pixel_buffer
+        integer = buf.dtype.kind in 'iu'
+
+        if self.is_mapping():
+            if integer and buf.dtype.itemsize <= 2:
+                bits_stored = int(dataset.get('BitsStored', 8 * buf.dtype.itemsize))
+                if dataset.get('PixelRepresentation', 0) == 1:
+                    first, last = -(1 << (bits_stored - 1)), (1 << (bits_stored - 1)) - 1
+                else:
+                    first, last = 0, (1 << bits_stored) - 1
+                lut = self.lookup_table(first, last, buf.dtype)
+                index = np.clip(buf, first, last)
+                if first != 0:
+                    index = index.astype(np.int32) - first
+                buf[...] = lut[index]
+            else:
+                values = self.map_values(buf.astype(np.float64))
+                buf[...] = np.clip(np.rint(values), np.iinfo(buf.dtype).min, np.iinfo(buf.dtype).max) \
+                    if integer else values
+
+        if self.noise_sigma > 0:
+            seed = self.noise_seed
+            if seed is not None:  # reproducible but different for each instance
+                seed = (seed + zlib.crc32(str(dataset.get('SOPInstanceUID', '')).encode())) & 0xFFFFFFFF
+            noisy = buf + np.random.RandomState(seed).normal(0.0, self.noise_sigma, buf.shape)
+            buf[...] = np.clip(np.rint(noisy), np.iinfo(buf.dtype).min, np.iinfo(buf.dtype).max) \
+                if integer else noisy
+
+        if integer:
+            update_bits_stored(dataset, buf)
+
+
+# ------------------------------------------------------------------------------
+def update_bits_stored(dataset, arr):
+    """Widen BitsStored and HighBit if the pixel values don't fit anymore, and refresh
+       the smallest/largest image pixel values"""
+    if arr.size == 0:
+        return
+    min_val, max_val = int(arr.min()), int(arr.max())
+    bits_stored = int(dataset.get('BitsStored', 8 * arr.dtype.itemsize))
+    if dataset.get('PixelRepresentation', 0) == 1:
+        needed = max(max_val.bit_length(), (-min_val - 1).bit_length()) + 1
+    else:
+        needed = max_val.bit_length()
+    if needed > bits_stored:
+        dataset.BitsStored = min(needed, int(dataset.BitsAllocated))
+        dataset.HighBit = dataset.BitsStored - 1
+    if 'SmallestImagePixelValue' in dataset:
+        dataset.SmallestImagePixelValue = min(min_val, dataset.SmallestImagePixelValue)
+    if 'LargestImagePixelValue' in dataset:
+        dataset.LargestImagePixelValue = max(max_val, dataset.LargestImagePixelValue)
+
+
+# ------------------------------------------------------------------------------
+def load_lut_points(filename):
+    """Load a lookup table file, either .npy or text/csv: one column gives the output value of each
+       input value from 0, two columns give (input, output) points linearly interpolated"""
+    if filename.endswith('.npy'):
+        table = np.load(filename)
+    else:
+        with open(filename) as lut_file:
+            table = np.array([[float(val) for val in line.replace(',', ' ').split()]
+                              for line in lut_file if line.strip() != '' and not line.startswith('#')])
+    if table.ndim == 1 or table.shape[1] == 1:
+        outputs = table.ravel().astype(np.float64)
+        return np.arange(outputs.size, dtype=np.float64), outputs
+    order = np.argsort(table[:, 0])
+    return table[order, 0].astype(np.float64), table[order, 1].astype(np.float64)
+
+
+# cache of the pixel transforms (and their lookup tables) for the whole run
+PIXEL_TRANSFORMS = {}
+
+
+# ------------------------------------------------------------------------------
+def get_pixel_transform(args):
+    """Get the pixel transform stage requested by args, built once per run, None if not requested"""
+    key = (args.lut, tuple(args.rescale), tuple(args.threshold), tuple(args.clip), tuple(args.noise))
+    if key == ('', (), (), (), ()):
+        return None
+    if key not in PIXEL_TRANSFORMS:
+        noise = [float(val) for val in args.noise]
+        PIXEL_TRANSFORMS[key] = PixelTransform(
+            load_lut_points(args.lut) if args.lut != '' else None,
+            [float(val) for val in args.rescale] if args.rescale != '' else None,
+            [float(val) for val in args.threshold] if args.threshold != '' else None,
+            [float(val) for val in args.clip] if args.clip != '' else None,
+            noise[0] if noise else 0.0,
+            int(noise[1]) if len(noise) > 1 else None)
+    return PIXEL_TRANSFORMS[key]
+
+
+# ------------------------------------------------------------------------------
+class RedactionRules:
+    """ Burned-in annotation redaction rule table keyed by (Manufacturer, ManufacturerModelName,
+        Rows, Columns, Modality). Each rule gives the key values to match (fnmatch patterns for
+        strings, missing keys match anything) and its [x, y, w, h(, value)] regions to blank.
+        The regions of all the rules matching a key are compiled once in cached masks"""
+    keys = ['Manufacturer', 'ManufacturerModelName', 'Rows', 'Columns', 'Modality']
+    rules = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, rules):
+        """Constructor from a list of rule dictionaries"""
+        self.rules = rules
+        self._masks = {}
+
+    # ------------------------------------------------------------------------------
+    def matches(self, rule, key):
+        """Tell if a rule matches a (Manufacturer, ManufacturerModelName, Rows, Columns, Modality) key"""
+        for name, value in zip(self.keys, key):
+            if name not in rule:
+                continue
+            if isinstance(rule[name], int):
+                if rule[name] != value:
+                    return False
+            elif not fnmatch.fnmatchcase(str(value), str(rule[name])):
+                return False
+        return True
+
+    # ------------------------------------------------------------------------------
+    def masks(self, dataset):
+        """Get the cached list of (mask, value) to blank for a dataset, empty if no rule matches"""
+        key = tuple(dataset.get(name, '') for name in self.keys[:2]) + \
+            (int(dataset.Rows), int(dataset.Columns), dataset.get('Modality', ''))
+        if key not in self._masks:
+            masks = OrderedDict()
+            for rule in self.rules:
+                if not self.matches(rule, key):
+                    continue
+                for region in rule.get('regions', []):
+                    value = region[4] if len(region) > 4 else 0
+                    if value not in masks:
+                        masks[value] = np.zeros((key[2], key[3]), dtype=bool)
+                    pos_x, pos_y, width, height = [int(val) for val in region[:4]]
+                    masks[value][max(pos_y, 0):pos_y + height, max(pos_x, 0):pos_x + width] = True
+            if not masks:
+                print("  Warning: no redaction rule for " + str(key) + ", pixels won't be redacted ...")
+            self._masks[key] = [(mask, value) for value, mask in masks.items()]
+        return self._masks[key]
+
+    # ------------------------------------------------------------------------------
+    def apply(self, dataset, pixel_session):
+        """Blank the regions of the matching rules in all the frames of the pixel session"""
+        masks = self.masks(dataset)
+        if not masks:
+            return
+        pixel_editor = pixel_session.editor(pixel_session.frame_indices())
+        for mask, value in masks:
+            pixel_editor.fill_mask(mask, value)
+
+
+# cache of the redaction rule tables (and their masks) for the whole run
+REDACTION_RULES = {}
+
+
+# ------------------------------------------------------------------------------
+def redaction_applies(header, args):
+    """Tell if a redaction rule matches a file header"""
+    return len(get_redaction_rules(args).masks(header)) > 0
+
+
+# ------------------------------------------------------------------------------
+def get_redaction_rules(args):
+    """Get the redaction rule table of the -redact file, loaded once per run, None if not requested"""
+    if args.redact == '':
+        return None
+    if args.redact not in REDACTION_RULES:
+        with open(args.redact) as rules_file:
+            REDACTION_RULES[args.redact] = RedactionRules(json.load(rules_file))
+    return REDACTION_RULES[args.redact]
+
+
+# ------------------------------------------------------------------------------
+def rasterize_spans(rows, cols, span_rows, starts, ends):
+    """Union mask of horizontal pixel spans [start, end] of rows, clipped to the image, through one
+       difference array instead of a loop over the spans"""
+    starts = np.maximum(starts, 0)
+    ends = np.minimum(ends, cols - 1)
+    keep = (span_rows >= 0) & (span_rows < rows) & (starts <= ends)
+    span_rows, starts, ends = span_rows[keep], starts[keep], ends[keep]
+    diff = np.zeros((rows, cols + 1), dtype=np.int32)
+    np.add.at(diff, (span_rows, starts), 1)
+    np.add.at(diff, (span_rows, ends + 1), -1)
+    return np.cumsum(diff, axis=1)[:, :cols] > 0
+
+
+# ------------------------------------------------------------------------------
+def expand_rows(first_rows, last_rows):
+    """Expand [first, last] row ranges, return the range index and the row of each (range, row) pair"""
+    counts = np.maximum(last_rows - first_rows + 1, 0)
+    owners = np.repeat(np.arange(counts.size), counts)
+    offsets = np.arange(owners.size) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, first_rows[owners] + offsets
+
+
+# ------------------------------------------------------------------------------
+def box_spans(x0, y0, x1, y1):
+    """Spans of filled boxes given by their inclusive pixel corners"""
+    owners, span_rows = expand_rows(y0, y1)
+    return span_rows, x0[owners], x1[owners]
+
+
+# ------------------------------------------------------------------------------
+def ellipse_spans(x0, y0, x1, y1):
+    """Spans of the filled ellipses inscribed in boxes: the pixels whose center is inside"""
+    owners, span_rows = expand_rows(y0, y1)
+    half_x = (x1 - x0 + 1) / 2.0
+    half_y = (y1 - y0 + 1) / 2.0
+    center_x = x0 + half_x
+    center_y = y0 + half_y
+    dist_y = (span_rows + 0.5 - center_y[owners]) / half_y[owners]
+    half_width = half_x[owners] * np.sqrt(np.maximum(1.0 - dist_y * dist_y, 0.0))
+    starts = np.ceil(center_x[owners] - half_width - 0.5).astype(np.int64)
+    ends = np.floor(center_x[owners] + half_width - 0.5).astype(np.int64)
+    return span_rows, starts, ends
+
+
+# ------------------------------------------------------------------------------
+def ellipse_outline_points(x0, y0, x1, y1):
+    """(xs, ys) pixels of the outlines of the ellipses inscribed in boxes, sampled along their perimeter"""
+    half_x = (x1 - x0 + 1) / 2.0
+    half_y = (y1 - y0 + 1) / 2.0
+    counts = (np.ceil(4 * math.pi * np.maximum(half_x, half_y)) + 8).astype(np.int64)
+    owners = np.repeat(np.arange(counts.size), counts)
+    theta = 2 * math.pi * (np.arange(owners.size) - np.repeat(np.cumsum(counts) - counts, counts)) / counts[owners]
+    xs = np.floor(x0[owners] + half_x[owners] + (half_x[owners] - 0.5) * np.cos(theta)).astype(np.int64)
+    ys = np.floor(y0[owners] + half_y[owners] + (half_y[owners] - 0.5) * np.sin(theta)).astype(np.int64)
+    return xs, ys
+
+
+# ------------------------------------------------------------------------------
+def pixel_center_span(start, size):
+    """Get the (first, last) indices of the pixels whose center is within start to start + size (in
+       pixels from the center of the first pixel), the pixel nearest to the middle if none is"""
+    eps = 1e-6
+    first = np.ceil(start - eps).astype(np.int64)
+    last = np.floor(start + size + eps).astype(np.int64)
+    nearest = np.floor(start + size / 2.0 + 0.5).astype(np.int64)
+    empty = last < first
+    return np.where(empty, nearest, first), np.where(empty, nearest, last)
+
+
+# ------------------------------------------------------------------------------
+class AnnotationIndex:
+    """ Per instance annotations of a csv or json file, indexed once by SOPInstanceUID or by
+        InstanceNumber within a SeriesInstanceUID (within any series if not given). Each annotation
+        is a rect, frect, ellipse, fellipse or point shape of a x, y, width, height box (top-left
+        corner), in pixel units or patient units (x, y, z in mm, width and height in mm along the
+        rows and columns, covering the pixels whose center is within, as the 3D ROIs), with a value,
+        alpha and frame (1 based).
+        The shapes of a file sharing a value, alpha and frame are rasterized together in one mask"""
+    shapes = ['rect', 'frect', 'ellipse', 'fellipse', 'point']
+    columns = None
+    index = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, annotations):
+        """Constructor from the list of annotation dictionaries, stored as columns"""
+        self.index = {}
+        self.columns = dict((name, []) for name in ['shape', 'x', 'y', 'z', 'width', 'height',
+                                                    'value', 'alpha', 'frame', 'patient'])
+        for i, annotation in enumerate(annotations):
+            shape = str(annotation.get('shape', 'frect')).strip().lower()
+            if shape not in self.shapes:
+                print("  Warning: annotation " + str(i + 1) + " ignored, unknown shape " + shape)
+                continue
+            uid = str(annotation.get('sop_instance_uid', '') or '').strip()
+            number = str(annotation.get('instance_number', '') or '').strip()
+            series = str(annotation.get('series_instance_uid', '') or '').strip()
+            keys = ([('uid', uid)] if uid != '' else []) + \
+                ([('number', series, int(number))] if number != '' else [])
+            if not keys:
+                print("  Warning: annotation " + str(i + 1) + " ignored, no sop_instance_uid or instance_number")
+                continue
+            for key in keys[:1]:  # the uid wins when both are given
+                self.index.setdefault(key, []).append(len(self.columns['shape']))
+            self.columns['shape'].append(self.shapes.index(shape))
+            for name in ['x', 'y', 'z', 'width', 'height']:
+                self.columns[name].append(float(annotation.get(name, 0) or 0))
+            self.columns['value'].append(parse_annotation_value(annotation.get('value', 0)))
+            alpha = annotation.get('alpha', 1)
+            self.columns['alpha'].append(float(alpha) if alpha not in (None, '') else 1.0)
+            self.columns['frame'].append(int(annotation.get('frame', 0) or 0))
+            self.columns['patient'].append(str(annotation.get('units', 'pixel')).strip().lower() == 'patient')
+        for name in ['shape', 'x', 'y', 'z', 'width', 'height', 'alpha', 'frame', 'patient']:
+            self.columns[name] = np.array(self.columns[name])
+        self._warned = False
+        self._number_series = {}
+
+    # ------------------------------------------------------------------------------
+    def select(self, dataset):
+        """Get the annotation indices of a dataset, from its SOPInstanceUID or InstanceNumber"""
+        selected = list(self.index.get(('uid', str(dataset.get('SOPInstanceUID', ''))), []))
+        if dataset.get('InstanceNumber', None) not in (None, ''):
+            number = int(dataset.InstanceNumber)
+            series = str(dataset.get('SeriesInstanceUID', ''))
+            selected += self.index.get(('number', series, number), [])
+            unscoped = self.index.get(('number', '', number), [])
+            if unscoped:
+                selected += unscoped
+                seen = self._number_series.setdefault(number, set())
+                seen.add(series)
+                if len(seen) == 2:
+                    print("  Warning: the annotations of instance_number " + str(number) + " without " +
+                          "series_instance_uid match the instances of several series ...")
+        return np.array(sorted(set(selected)), dtype=np.int64)
+
+    # ------------------------------------------------------------------------------
+    def pixel_boxes(self, dataset, selected):
+        """Get the (x0, y0, x1, y1) inclusive pixel boxes of the selected annotations, converting the
+           patient coordinates with the image plane geometry, and the mask of the drawable ones"""
+        pos_x = self.columns['x'][selected]
+        pos_y = self.columns['y'][selected]
+        width = self.columns['width'][selected]
+        height = self.columns['height'][selected]
+        patient = self.columns['patient'][selected]
+        drawable = np.ones(selected.size, dtype=bool)
+        if patient.any():
+            try:
+                orientation = np.array([float(val) for val in dataset.ImageOrientationPatient])
+                origin = np.array([float(val) for val in dataset.ImagePositionPatient])
+                row_spacing, col_spacing = [float(val) for val in dataset.PixelSpacing]
+            except (AttributeError, ValueError):
+                if not self._warned:
+                    print("  Warning: no image plane geometry, patient annotations won't be drawn ...")
+                    self._warned = True
+                orientation, origin, row_spacing, col_spacing = np.eye(2, 3).ravel(), np.zeros(3), 1.0, 1.0
+                drawable = ~patient
+            points = np.stack([pos_x, pos_y, self.columns['z'][selected]], axis=1) - origin
+            pos_x = np.where(patient, points.dot(orientation[:3]) / col_spacing, pos_x)
+            pos_y = np.where(patient, points.dot(orientation[3:]) / row_spacing, pos_y)
+            width = np.where(patient, width / col_spacing, width)
+            height = np.where(patient, height / row_spacing, height)
+        x0 = np.floor(pos_x).astype(np.int64)
+        y0 = np.floor(pos_y).astype(np.int64)
+        x1 = x0 + np.maximum(np.round(width).astype(np.int64), 1) - 1
+        y1 = y0 + np.maximum(np.round(height).astype(np.int64), 1) - 1
+        if patient.any():
+            # the image position is the center of the first pixel, as for the 3D ROIs
+            first, last = pixel_center_span(pos_x, width)
+            x0, x1 = np.where(patient, first, x0), np.where(patient, last, x1)
+            first, last = pixel_center_span(pos_y, height)
+            y0, y1 = np.where(patient, first, y0), np.where(patient, last, y1)
+        return x0, y0, x1, y1, drawable
+
+    # ------------------------------------------------------------------------------
+    def rasterize(self, shapes, x0, y0, x1, y1, rows, cols):
+        """Union mask of shapes (codes) given by their pixel boxes"""
+        span_rows, starts, ends = [], [], []
+        is_rect = shapes == self.shapes.index('rect')
+        is_frect = shapes == self.shapes.index('frect')
+        is_fellipse = shapes == self.shapes.index('fellipse')
+        # rectangle outlines as their 4 one pixel wide sides
+        sides = [(x0, y0, x1, y0), (x0, y1, x1, y1), (x0, y0, x0, y1), (x1, y0, x1, y1)]
+        boxes = [[corner[is_rect] for corner in side] for side in sides] + \
+            [[corner[is_frect] for corner in (x0, y0, x1, y1)]]
+        for box in boxes:
+            spans = box_spans(*box)
+            span_rows.append(spans[0])
+            starts.append(spans[1])
+            ends.append(spans[2])
+        spans = ellipse_spans(x0[is_fellipse], y0[is_fellipse], x1[is_fellipse], y1[is_fellipse])
+        span_rows.append(spans[0])
+        starts.append(spans[1])
+        ends.append(spans[2])
+        mask = rasterize_spans(rows, cols, np.concatenate(span_rows), np.concatenate(starts), np.concatenate(ends))
+
+        # outlines and points as single pixels
+        is_ellipse = shapes == self.shapes.index('ellipse')
+        is_point = shapes == self.shapes.index('point')
+        xs, ys = ellipse_outline_points(x0[is_ellipse], y0[is_ellipse], x1[is_ellipse], y1[is_ellipse])
+        xs = np.concatenate([xs, x0[is_point]])
+        ys = np.concatenate([ys, y0[is_point]])
+        inside = (xs >= 0) & (xs < cols) & (ys >= 0) & (ys < rows)
+        mask[ys[inside], xs[inside]] = True
+        return mask
+
+    # ------------------------------------------------------------------------------
+    def apply(self, dataset, pixel_session):
+        """Draw the annotations of a dataset with the editors of a pixel (or overlay) session"""
+        selected = self.select(dataset)
+        if selected.size == 0:
+            return
+        x0, y0, x1, y1, drawable = self.pixel_boxes(dataset, selected)
+        selected, x0, y0, x1, y1 = selected[drawable], x0[drawable], y0[drawable], x1[drawable], y1[drawable]
+        rows, cols = int(dataset.Rows), int(dataset.Columns)
+
+        # group the shapes drawn with the same value, alpha and frame
+        groups = OrderedDict()
+        for i, annotation in enumerate(selected):
+            value = self.columns['value'][annotation]
+            key = (value if not isinstance(value, list) else tuple(value),
+                   self.columns['alpha'][annotation], self.columns['frame'][annotation])
+            groups.setdefault(key, []).append(i)
+        for (value, alpha, frame), members in groups.items():
+            members = np.array(members)
+            pixel_editor = pixel_session.editor([frame - 1] if frame > 0 else None)
+            if pixel_editor.buffer_length() == 0:
+                print("  Could not find a pixel array, annotations won't be drawn ...")
+                return
+            shapes = self.columns['shape'][selected[members]]
+            if isinstance(pixel_editor, GraphicEditor):  # presentation state graphics, no rasterization
+                for shape, left, top, right, bottom in zip(shapes, x0[members], y0[members],
+                                                           x1[members], y1[members]):
+                    width, height = right - left + 1, bottom - top + 1
+                    if self.shapes[shape] == 'rect':
+                        pixel_editor.draw_rect(left, top, width, height, 1, value, alpha)
+                    elif self.shapes[shape] == 'frect':
+                        pixel_editor.draw_frect(left, top, width, height, value, alpha)
+                    elif self.shapes[shape] == 'point':
+                        pixel_editor.draw_pixel(left, 1, 1, top, 1, 1, value, alpha)
+                    else:
+                        pixel_editor.draw_elp(left + width // 2, top + height // 2, width, height, value, alpha)
+                continue
+            mask = self.rasterize(shapes, x0[members], y0[members], x1[members], y1[members], rows, cols)
+            pixel_editor.fill_mask(mask, value, alpha)
+
+
+# ------------------------------------------------------------------------------
+def load_annotations(filename):
+    """Load an annotation file: csv with a header line, or json list (or {"annotations": [...]})"""
+    if filename.lower().endswith('.json'):
+        with open(filename) as annotations_file:
+            annotations = json.load(annotations_file)
+        if isinstance(annotations, dict):
+            annotations = annotations.get('annotations', [])
+    else:
+        with open(filename) as annotations_file:
+            annotations = list(csv.DictReader(line for line in annotations_file if not line.startswith('#')))
+    return AnnotationIndex(annotations)
+
+
+# annotation indexes of the whole run
+ANNOTATION_INDEXES = {}
+
+
+# ------------------------------------------------------------------------------
+def annotations_apply(header, args):
+    """Tell if the annotation file has shapes for a file header"""
+    return get_annotation_index(args).select(header).size > 0
+
+
+# ------------------------------------------------------------------------------
+def get_annotation_index(args):
+    """Get the annotation index of the -annotations file, loaded once per run, None if not requested"""
+    if args.annotations == '':
+        return None
+    if args.annotations not in ANNOTATION_INDEXES:
+        ANNOTATION_INDEXES[args.annotations] = load_annotations(args.annotations)
+    return ANNOTATION_INDEXES[args.annotations]
+
+
+# ------------------------------------------------------------------------------
+class Roi3D:
+    """ Region of interest defined in patient mm space: a sphere (center, radius), an axis aligned box
+        (two opposite corners) or a cylinder (axis end points, radius), drawn with a value and alpha
+        where it crosses each slice plane. A slice is a plane origin O with orthonormal row and column
+        directions u, v (normal n), its pixel centers being O + x.u + y.v for the x, y grids in mm"""
+    shapes = {'sphere': 4, 'box': 6, 'cylinder': 7}
+    shape = 'sphere'
+    params = None
+    value = 0
+    alpha = 1.0
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, shape, params, value, alpha=1.0):
+        """Constructor from the shape name, its mm parameters, value and alpha"""
+        self.shape = shape
+        self.params = np.array(params, dtype=np.float64)
+        self.value = value
+        self.alpha = alpha
+
+    # ------------------------------------------------------------------------------
+    def crosses(self, origin, normal):
+        """Tell, from the plane position only, if the ROI crosses a slice plane"""
+        eps = 1e-6
+        if self.shape == 'sphere':
+            return abs((self.params[:3] - origin).dot(normal)) <= self.params[3] + eps
+        if self.shape == 'box':
+            corners = np.array(list(itertools.product(*zip(self.params[:3], self.params[3:6]))))
+            distances = (corners - origin).dot(normal)
+            return distances.min() <= eps and distances.max() >= -eps
+        axis = self.params[3:6] - self.params[:3]
+        axis_dir = axis / (np.linalg.norm(axis) or 1.0)
+        extent = self.params[6] * math.sqrt(max(1.0 - axis_dir.dot(normal) ** 2, 0.0))
+        distances = [(self.params[:3] - origin).dot(normal), (self.params[3:6] - origin).dot(normal)]
+        return min(distances) - extent <= eps and max(distances) + extent >= -eps
+
+    # ------------------------------------------------------------------------------
+    def mask(self, origin, geometry):
+        """Rasterize the ROI section of a slice, (rows, cols) boolean mask from the shared geometry"""
+        row_dir, col_dir, normal, grid_x, grid_y = geometry
+        mask = np.zeros((grid_y.size, grid_x.size), dtype=bool)
+        eps = 1e-6
+        if self.shape == 'sphere':
+            center = self.params[:3] - origin
+            pos_x, pos_y, dist = center.dot(row_dir), center.dot(col_dir), center.dot(normal)
+            radius2 = self.params[3] ** 2 - dist ** 2
+            if radius2 < 0:
+                return mask
+            radius = math.sqrt(radius2)
+            # analytic circle, within its bounding pixels only
+            first_x, last_x = np.searchsorted(grid_x, [pos_x - radius - eps, pos_x + radius + eps])
+            first_y, last_y = np.searchsorted(grid_y, [pos_y - radius - eps, pos_y + radius + eps])
+            mask[first_y:last_y, first_x:last_x] = \
+                (grid_x[first_x:last_x] - pos_x)[None, :] ** 2 + (grid_y[first_y:last_y] - pos_y)[:, None] ** 2 \
+                <= radius2 + eps
+        elif self.shape == 'box':
+            low = np.minimum(self.params[:3], self.params[3:6]) - eps
+            high = np.maximum(self.params[:3], self.params[3:6]) + eps
+            mask[:] = True
+            for k in range(3):
+                coords = (origin[k] + grid_y * col_dir[k])[:, None] + (grid_x * row_dir[k])[None, :]
+                mask &= (coords >= low[k]) & (coords <= high[k])
+        else:
+            start = self.params[:3]
+            axis = self.params[3:6] - start
+            length = np.linalg.norm(axis)
+            if length == 0:
+                return mask
+            axis_dir = axis / length
+            offset = origin - start
+            # position along the axis and squared distance to the start, both analytic in x, y
+            along = offset.dot(axis_dir) + (grid_y * col_dir.dot(axis_dir))[:, None] + \
+                (grid_x * row_dir.dot(axis_dir))[None, :]
+            dist2 = offset.dot(offset) + (2 * grid_y * offset.dot(col_dir) + grid_y ** 2)[:, None] + \
+                (2 * grid_x * offset.dot(row_dir) + grid_x ** 2)[None, :]
+            mask[:] = (along >= -eps) & (along <= length + eps) & (dist2 - along ** 2 <= self.params[6] ** 2 + eps)
+        return mask
+
+
+# ------------------------------------------------------------------------------
+def parse_rois_3d(args):
+    """Parse the -roi3d specs: sphere CX CY CZ R, box X0 Y0 Z0 X1 Y1 Z1 or cylinder X0 Y0 Z0 X1 Y1 Z1 R,
+       each followed by its value and alpha"""
+    rois = []
+    i = 0
+    while i < len(args):
+        shape = args[i].lower()
+        if shape not in Roi3D.shapes:
+            print("  Warning: unknown 3d ROI shape <" + args[i] + ">, expected sphere, box or cylinder ...")
+            break
+        count = Roi3D.shapes[shape] + 2
+        if i + 1 + count > len(args):
+            print("  Warning: " + shape + " expects " + str(count) + " values, found ending: <" +
+                  ' '.join(args[i:]) + '>')
+            break
+        values = args[i + 1:i + 1 + count]
+        rois.append(Roi3D(shape, [float(val) for val in values[:-2]],
+                          parse_pixel_value(values[-2]), float(values[-1])))
+        i += 1 + count
+    return rois
+
+
+# compiled 3d ROIs and the slice geometry grids shared by the slices of same orientation and size
+ROIS_3D = {}
+PLANE_GEOMETRIES = {}
+
+
+# ------------------------------------------------------------------------------
+def plane_geometry(dataset):
+    """Get the (origin, (row_dir, col_dir, normal, grid_x, grid_y)) of a slice, the directions and mm
+       grids being computed once for all the slices with the same orientation, spacing and size"""
+    key = (tuple(float(val) for val in dataset.ImageOrientationPatient),
+           tuple(float(val) for val in dataset.PixelSpacing), int(dataset.Rows), int(dataset.Columns))
+    if key not in PLANE_GEOMETRIES:
+        orient = np.array(key[0])
+        row_dir, col_dir = orient[:3], orient[3:]
+        row_spacing, col_spacing = key[1]
+        PLANE_GEOMETRIES[key] = (row_dir, col_dir, np.cross(row_dir, col_dir),
+                                 np.arange(key[3]) * col_spacing, np.arange(key[2]) * row_spacing)
+    return np.array([float(val) for val in dataset.ImagePositionPatient]), PLANE_GEOMETRIES[key]
+
+
+# ------------------------------------------------------------------------------
+def roi_sections_3d(dataset, args):
+    """Generate the (roi, mask) sections of the 3d ROIs crossing a slice, from its header only"""
+    if args == '':
+        return
+    key = tuple(args)
+    if key not in ROIS_3D:
+        ROIS_3D[key] = parse_rois_3d(args)
+    try:
+        origin, geometry = plane_geometry(dataset)
+    except (AttributeError, ValueError, TypeError):
+        print("  Warning: no image plane geometry, 3d ROIs won't be drawn ...")
+        return
+    for roi in ROIS_3D[key]:
+        if roi.crosses(origin, geometry[2]):
+            mask = roi.mask(origin, geometry)
+            if mask.any():
+                yield roi, mask
+
+
+# ------------------------------------------------------------------------------
+def rois_3d_apply(header, args):
+    """Tell if any 3d ROI crosses a slice"""
+    return any(True for section in roi_sections_3d(header, args.roi3d))
+
+
+# ------------------------------------------------------------------------------
+def draw_rois_3d(dataset, args, pixel_session):
+    """Draw the sections of the 3d ROIs crossing the slice, without decoding the pixels of the others"""
+    pixel_editor = None
+    for roi, mask in roi_sections_3d(dataset, args):
+        if pixel_editor is None:
+            pixel_editor = pixel_session.editor()  # decode on the first crossing ROI only
+            if isinstance(pixel_editor, GraphicEditor):
+                print("  Warning: 3d ROIs can't be drawn in presentation states ...")
+                return
+        pixel_editor.fill_mask(mask, roi.value, roi.alpha)
+
+
+# JPEG Baseline and Extended decoders output RGB from YBR encoded color data
+JPEG_YBR_TO_RGB_SYNTAXES = ['1.2.840.10008.1.2.4.50', '1.2.840.10008.1.2.4.51']
+
+
+# ------------------------------------------------------------------------------
+def rle_encode_segment(segment):
+    """PackBits encode a (rows, cols) uint8 array one row at a time, see PS3.5 Annex G.
+       Runs of 3 bytes or more are replicated, anything shorter goes in a literal run"""
+    cols = segment.shape[1]
+    data = segment.ravel()
+    if data.size == 0:
+        return b''
+
+    # runs of identical bytes, never crossing a row boundary
+    run_mask = np.ones(data.size, dtype=bool)
+    run_mask[1:] = data[1:] != data[:-1]
+    run_mask[::cols] = True
+    run_starts = np.flatnonzero(run_mask)
+    run_lengths = np.diff(np.append(run_starts, data.size))
+    replicate = run_lengths >= 3
+
+    # blocks: each replicate run alone, consecutive short runs merged as one literal
+    block_mask = replicate | (run_starts % cols == 0)
+    block_mask[1:] |= replicate[:-1]
+    block_runs = np.flatnonzero(block_mask)
+    block_starts = run_starts[block_runs]
+    block_lengths = np.diff(np.append(block_starts, data.size))
+    block_replicate = replicate[block_runs]
+
+    # PackBits runs hold at most 128 bytes, split the blocks accordingly
+    chunk_counts = (block_lengths + 127) // 128
+    chunk_block = np.repeat(np.arange(block_starts.size), chunk_counts)
+    chunk_rank = np.arange(chunk_block.size) - np.repeat(np.cumsum(chunk_counts) - chunk_counts,
+                                                         chunk_counts)
+    chunk_starts = block_starts[chunk_block] + 128 * chunk_rank
+    chunk_lengths = np.minimum(block_lengths[chunk_block] - 128 * chunk_rank, 128)
+    chunk_replicate = block_replicate[chunk_block]
+
+    # one header byte, then either the replicated byte or the literal bytes
+    payload = np.where(chunk_replicate, 1, chunk_lengths)
+    out_starts = np.cumsum(payload + 1) - (payload + 1)
+    out = np.empty(int((payload + 1).sum()), dtype=np.uint8)
+    out[out_starts] = np.where(chunk_replicate, (257 - chunk_lengths) & 0xFF, chunk_lengths - 1)
+    out[out_starts[chunk_replicate] + 1] = data[chunk_starts[chunk_replicate]]
+
+    literal = ~chunk_replicate
+    lit_lengths = chunk_lengths[literal]
+    lit_offsets = np.arange(lit_lengths.sum()) - np.repeat(np.cumsum(lit_lengths) - lit_lengths,
+                                                           lit_lengths)
+    out[np.repeat(out_starts[literal] + 1, lit_lengths) + lit_offsets] = \
+        data[np.repeat(chunk_starts[literal], lit_lengths) + lit_offsets]
+    return out.tobytes()
+
+
+# ------------------------------------------------------------------------------
+def rle_encode_frame(frame, bits_allocated):
+    """RLE Lossless encode one (rows, cols, samples) frame, one segment per sample byte, MSB first"""
+    nr_bytes = bits_allocated // 8
+    frame = np.ascontiguousarray(frame)
+    unsigned = frame.view(frame.dtype.newbyteorder('=').str.replace('i', 'u'))
+
+    segments = []
+    for sample in range(frame.shape[2]):
+        plane = unsigned[:, :, sample]
+        for byte in range(nr_bytes - 1, -1, -1):
+            segment = rle_encode_segment(((plane >> (8 * byte)) & 0xFF).astype(np.uint8))
+            if len(segment) % 2:
+                segment += b'\x80'  # no-op PackBits header as pad byte
+            segments.append(segment)
+
+    offsets = [0] * 15
+    offset = 64
+    for i, segment in enumerate(segments):
+        offsets[i] = offset
+        offset += len(segment)
+    header = struct.pack('<16L', len(segments), *offsets)
+    return header + b''.join(segments)
+
+
+# ------------------------------------------------------------------------------
+def frame_offsets(frames):
+    """Byte offsets of each frame first fragment item, from the first item after the basic offset table"""
+    offsets = []
+    offset = 0
+    for fragments in frames:
+        offsets.append(offset)
+        offset += sum(8 + len(fragment) for fragment in fragments)
+    return offsets
+
+
+# ------------------------------------------------------------------------------
+def encapsulate_fragments(frames, basic_offsets=True):
+    """Encapsulate a list of per frame fragment tuples with a basic offset table (an empty one if not
+       basic_offsets, i.e. when an extended offset table gives them)"""
+    offsets = frame_offsets(frames) if basic_offsets else []
+    item_tag = b'\xfe\xff\x00\xe0'
+    data = [item_tag, struct.pack('<L', 4 * len(offsets)), struct.pack('<%dL' % len(offsets), *offsets)]
+    for fragments in frames:
+        for fragment in fragments:
+            data.extend([item_tag, struct.pack('<L', len(fragment)), fragment])
+    return b''.join(data)
+
+
+# ------------------------------------------------------------------------------
+def set_extended_offset_table(dataset, frames):
+    """Rebuild the Extended Offset Table and its lengths of the encapsulated frames,
+       deleting them if frames is None (native pixel data)"""
+    for tag in [0x7FE00001, 0x7FE00002]:
+        if tag in dataset:
+            del dataset[tag]
+    if frames is not None:
+        offsets = frame_offsets(frames)
+        lengths = [sum(len(fragment) for fragment in fragments) for fragments in frames]
+        dataset.add_new(0x7FE00001, 'OV', struct.pack('<%dQ' % len(offsets), *offsets))
+        dataset.add_new(0x7FE00002, 'OV', struct.pack('<%dQ' % len(lengths), *lengths))
+
+
+# ------------------------------------------------------------------------------
+class PixelSession:
+    """ Decode-once access to the pixel data of a dataset for all the pixel editing
+        functions, frames are decoded on demand and only the edited ones are written back.
+        Encapsulated frames are re-encoded in RLE Lossless natively, through an available
+        pydicom encoder otherwise, or the dataset falls back to Explicit VR Little Endian"""
+    dataset = None
+    transfer_syntax = None
+    is_encapsulated = False
+    number_of_frames = 1
+    frame_selection = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, dataset, frame_selection=None, keep_original=False):
+        """Constructor from a dataset and the frames to edit (all by default), nothing gets decoded
+           until a frame is requested. keep_original keeps a copy of the decoded frames to count
+           the changed pixels"""
+        self.dataset = dataset
+        self.frame_selection = frame_selection
+        self.keep_original = keep_original
+        self.transfer_syntax = dataset.file_meta.TransferSyntaxUID
+        self.is_encapsulated = getattr(self.transfer_syntax, 'is_encapsulated',
+                                       self.transfer_syntax.is_compressed)
+        self.number_of_frames = int(dataset.get('NumberOfFrames', 1) or 1)
+        self._fragments = None
+        self._native = None
+        self._frames = {}
+        self._originals = {}
+        self._edited = set()
+        self._editor = None
+        self._editor_frames = None
+
+    # ------------------------------------------------------------------------------
+    def has_pixels(self):
+        """Tell if the dataset has any pixel data to edit"""
+        return 'PixelData' in self.dataset
+
+    # ------------------------------------------------------------------------------
+    def frame_indices(self, selection=None):
+        """Get the (0 based) frame indices of a selection, all frames by default"""
+        if selection is None:
+            return list(range(self.number_of_frames))
+        return [i for i in selection if 0 <= i < self.number_of_frames]
+
+    # ------------------------------------------------------------------------------
+    def _shape_frames(self, arr, count):
+        """Reshape a decoded pixel array as (frames, rows, cols, samples)"""
+        return arr.reshape((count, self.dataset.Rows, self.dataset.Columns,
+                            int(self.dataset.get('SamplesPerPixel', 1))))
+
+    # ------------------------------------------------------------------------------
+    def _frame_fragments(self):
+        """Get the encapsulated fragments of each frame, without decoding any of them"""
+        if self._fragments is None:
+            self._fragments = list(dicom.encaps.generate_pixel_data(self.dataset.PixelData,
+                                                                    self.number_of_frames))
+        return self._fragments
+
+    # ------------------------------------------------------------------------------
+    def _decode_frame(self, index):
+        """Decode a single encapsulated frame through the available pixel data handlers"""
+        frame_ds = dicom.dataset.Dataset()
+        for keyword in ['Rows', 'Columns', 'SamplesPerPixel', 'BitsAllocated', 'BitsStored',
+                        'HighBit', 'PixelRepresentation', 'PhotometricInterpretation',
+                        'PlanarConfiguration']:
+            if keyword in self.dataset:
+                setattr(frame_ds, keyword, self.dataset.data_element(keyword).value)
+        frame_ds.file_meta = dicom.dataset.FileMetaDataset() \
+            if hasattr(dicom.dataset, 'FileMetaDataset') else dicom.dataset.Dataset()
+        frame_ds.file_meta.TransferSyntaxUID = self.transfer_syntax
+        frame_ds.is_little_endian = True
+        frame_ds.is_implicit_VR = False
+        frame_ds.PixelData = encapsulate_fragments([self._frame_fragments()[index]])
+        frame_ds['PixelData'].is_undefined_length = True
+        return self._shape_frames(frame_ds.pixel_array, 1)[0]
+
+    # ------------------------------------------------------------------------------
+    def get_frames(self, indices):
+        """Get the decoded (frames, rows, cols, samples) array of the given frame indices"""
+        if not self.is_encapsulated:
+            if self._native is None:
+                arr = self.dataset.pixel_array
+                if not arr.flags.writeable:
+                    arr = arr.copy()
+                self._native = self._shape_frames(arr, self.number_of_frames)
+                if self.keep_original:
+                    self._originals = self._native.copy()
+            if indices == list(range(self.number_of_frames)):
+                return self._native
+            return self._native[indices]
+
+        for index in indices:
+            if index not in self._frames:
+                self._frames[index] = self._decode_frame(index)
+                if self.keep_original:
+                    self._originals[index] = self._frames[index].copy()
+        return np.stack([self._frames[index] for index in indices])
+
+    # ------------------------------------------------------------------------------
+    def set_frames(self, indices, arr):
+        """Store back the edited (frames, rows, cols, samples) array of the given frame indices"""
+        if not self.is_encapsulated:
+            if arr is not self._native:
+                self._native[indices] = arr
+        else:
+            for i, index in enumerate(indices):
+                self._frames[index] = arr[i]
+        self._edited.update(indices)
+
+    # ------------------------------------------------------------------------------
+    def changed_count(self):
+        """Count the pixels changed by the edits, a pixel counting once whatever its changed samples"""
+        if not self.keep_original:
+            return 0
+        self.flush_editor()
+        count = 0
+        for index in sorted(self._edited):
+            frame = self._native[index] if not self.is_encapsulated else self._frames[index]
+            count += int(np.count_nonzero((frame != self._originals[index]).any(axis=-1)))
+        return count
+
+    # ------------------------------------------------------------------------------
+    def editor(self, selection=None):
+        """Get a pixel editor over the selected frames (the session ones by default),
+           shared by the successive edits"""
+        indices = self.frame_indices(self.frame_selection if selection is None else selection)
+        if self._editor is not None and self._editor_frames == indices:
+            return self._editor
+        self.flush_editor()
+        self._editor = PixelEditor(self.get_frames(indices))
+        self._editor_frames = indices
+        return self._editor
+
+    # ------------------------------------------------------------------------------
+    def flush_editor(self):
+        """Store back the frames of the current pixel editor, if any"""
+        if self._editor is not None:
+            self.set_frames(self._editor_frames, self._editor.pixel_buffer)
+            self._editor = None
+            self._editor_frames = None
+
+    # ------------------------------------------------------------------------------
+    def _encode_frame(self, frame):
+        """Encode one edited frame in the current transfer syntax, None if not possible"""
+        bits_allocated = self.dataset.BitsAllocated
+        if self.transfer_syntax == dicom.uid.RLELossless and bits_allocated % 8 == 0:
+            return rle_encode_frame(frame, bits_allocated)
+        try:
+            from pydicom.encoders import get_encoder
+            encoder = get_encoder(self.transfer_syntax)
+        except (ImportError, NotImplementedError):
+            return None
+        if encoder is None or not encoder.is_available:
+            return None
+        try:
+            return encoder.encode(frame, rows=self.dataset.Rows, columns=self.dataset.Columns,
+                                  samples_per_pixel=frame.shape[2],
+                                  bits_allocated=bits_allocated, bits_stored=self.dataset.BitsStored,
+                                  pixel_representation=self.dataset.PixelRepresentation,
+                                  photometric_interpretation=self.dataset.PhotometricInterpretation,
+                                  number_of_frames=1)
+        except (ValueError, RuntimeError, TypeError) as exc:  # i.e. unsupported by the encoder plugins
+            print("  Warning: could not encode in " + self.transfer_syntax.name + ", " + str(exc))
+            return None
+
+    # ------------------------------------------------------------------------------
+    def _write_native(self, arr):
+        """Write a full (frames, rows, cols, samples) array as native pixel data"""
+        dataset = self.dataset
+        if dataset.BitsAllocated == 1:
+            dataset.PixelData = np.packbits(arr.ravel(), bitorder='little').tobytes()
+            return
+        if arr.shape[3] > 1 and dataset.get('PlanarConfiguration', 0) == 1:
+            arr = arr.transpose(0, 3, 1, 2)
+        byte_order = '<' if dataset.is_little_endian else '>'
+        dataset.PixelData = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder(byte_order)).tobytes()
+
+    # ------------------------------------------------------------------------------
+    def _switch_to_native(self):
+        """Decode all frames and switch the dataset to Explicit VR Little Endian"""
+        dataset = self.dataset
+        arr = self.get_frames(self.frame_indices())
+        if self.transfer_syntax in JPEG_YBR_TO_RGB_SYNTAXES \
+                and str(dataset.get('PhotometricInterpretation', '')).startswith('YBR'):
+            dataset.PhotometricInterpretation = 'RGB'  # decoders convert to RGB
+        if 'PlanarConfiguration' in dataset:
+            dataset.PlanarConfiguration = 0
+
+        dataset.file_meta.TransferSyntaxUID = dicom.uid.ExplicitVRLittleEndian
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        set_extended_offset_table(dataset, None)
+        self._write_native(arr)
+        dataset['PixelData'].VR = 'OB' if dataset.BitsAllocated <= 8 else 'OW'
+        dataset['PixelData'].is_undefined_length = False
+
+        self.transfer_syntax = dataset.file_meta.TransferSyntaxUID
+        self.is_encapsulated = False
+        self._native = arr
+        self._frames = {}
+        self._fragments = None
+
+    # ------------------------------------------------------------------------------
+    def commit(self):
+        """Write the edited frames back into the dataset pixel data, untouched
+           encapsulated fragments are copied byte for byte"""
+        self.flush_editor()
+        if not self._edited:
+            return
+
+        if not self.is_encapsulated:
+            self._write_native(self._native)
+        else:
+            frames = list(self._frame_fragments())
+            for index in sorted(self._edited):
+                encoded = self._encode_frame(self._frames[index])
+                if encoded is None:
+                    print("  Warning: no encoder for " + self.transfer_syntax.name +
+                          ", switching to Explicit VR Little Endian ...")
+                    self._switch_to_native()
+                    break
+                if len(encoded) % 2:
+                    encoded += b'\x00'
+                frames[index] = (encoded,)
+            else:
+                extended = 0x7FE00001 in self.dataset  # the offsets may not fit the basic offset table
+                self.dataset.PixelData = encapsulate_fragments(frames, not extended)
+                self.dataset['PixelData'].is_undefined_length = True
+                if extended:
+                    set_extended_offset_table(self.dataset, frames)
+                self._fragments = frames
+        self._edited = set()
+
+
+# ------------------------------------------------------------------------------
+class OverlayEditor(PixelEditor):
+    """ Pixel editor drawing the shapes as a (1, rows, cols, 1) bit mask instead of pixel
+        values, whatever their value and with any non zero alpha"""
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, rows, cols):
+        """Constructor from the image size"""
+        PixelEditor.__init__(self, np.zeros((1, rows, cols, 1), dtype=np.uint8))
+
+    # ------------------------------------------------------------------------------
+    def blend_region(self, region, val, alpha=1.0):
+        """Set the region bits"""
+        if alpha > 0:
+            self.pixel_buffer[(slice(None),) + tuple(region)] = 1
+
+
+# ------------------------------------------------------------------------------
+class GraphicEditor(PixelEditor):
+    """ Pixel editor recording the shapes as presentation state graphic objects, in PIXEL
+        units where the top left corner of the top left pixel is 0.0\\0.0"""
+    rows = 0
+    cols = 0
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, rows, cols):
+        """Constructor from the image size"""
+        PixelEditor.__init__(self, np.zeros((1, 0, 0, 1), dtype=np.uint8))
+        self.rows = rows
+        self.cols = cols
+        self.graphics = []
+
+    # ------------------------------------------------------------------------------
+    def buffer_length(self):
+        """Pixels count of the annotated image"""
+        return self.rows * self.cols
+
+    # ------------------------------------------------------------------------------
+    def add_graphic(self, graphic_type, points, filled=False):
+        """Record a graphic object from its (column, row) points"""
+        self.graphics.append((graphic_type, [float(coord) for point in points for coord in point], filled))
+
+    # ------------------------------------------------------------------------------
+    def draw_pixel(self, pos_x, width, xstep, pos_y, height, ystep, val, alpha=1.0):
+        """Record a single pixel as a point, a block of pixels as a filled rectangle"""
+        if alpha <= 0:
+            return
+        if int(width) <= 1 and int(height) <= 1:
+            self.add_graphic('POINT', [(int(pos_x) + 0.5, int(pos_y) + 0.5)])
+        else:
+            self.draw_frect(pos_x, pos_y, width, height, val, alpha)
+
+    # ------------------------------------------------------------------------------
+    def draw_rect(self, pos_x, pos_y, width, height, step, val, alpha=1.0):
+        """Record a rectangle outline through the centers of its border pixels"""
+        if alpha <= 0:
+            return
+        left, top = int(pos_x) + 0.5, int(pos_y) + 0.5
+        right, bottom = int(pos_x + width - 1) + 0.5, int(pos_y + height - 1) + 0.5
+        self.add_graphic('POLYLINE', [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)])
+
+    # ------------------------------------------------------------------------------
+    def draw_frect(self, pos_x, pos_y, width, height, val, alpha=1.0):
+        """Record a filled rectangle covering its pixels"""
+        if alpha <= 0 or width <= 0 or height <= 0:
+            return
+        left, top = int(pos_x), int(pos_y)
+        right, bottom = int(pos_x + width), int(pos_y + height)
+        self.add_graphic('POLYLINE', [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)],
+                         True)
+
+    # ------------------------------------------------------------------------------
+    def draw_elp(self, pos_x, pos_y, width, height, val, alpha=1.0, step=1):
+        """Record an ellipse from its major then minor axis end points"""
+        if alpha <= 0:
+            return
+        center_x, center_y = int(pos_x) + 0.5, int(pos_y) + 0.5
+        x_axis = [(center_x - width / 2.0, center_y), (center_x + width / 2.0, center_y)]
+        y_axis = [(center_x, center_y - height / 2.0), (center_x, center_y + height / 2.0)]
+        self.add_graphic('ELLIPSE', x_axis + y_axis if width >= height else y_axis + x_axis)
+
+
+# ------------------------------------------------------------------------------
+def pack_overlay_bits(mask):
+    """Pack a boolean mask as overlay data: first pixel in the lowest bit, padded to 16 bits words"""
+    bits = np.ascontiguousarray(mask, dtype=np.uint8).ravel()
+    bits = np.concatenate([bits, np.zeros(-bits.size % 16, dtype=np.uint8)])
+    try:
+        return np.packbits(bits, bitorder='little').tobytes()
+    except TypeError:  # numpy < 1.17
+        return np.packbits(bits.reshape(-1, 8)[:, ::-1]).tobytes()
+
+
+# ------------------------------------------------------------------------------
+class OverlaySession:
+    """ Non destructive replacement of a pixel session for the drawing functions: the shapes are
+        written as a 1 bit Overlay Plane (60xx group) or kept as graphics for a companion
+        Grayscale Softcopy Presentation State, the pixel data is never decoded nor changed"""
+    dataset = None
+    mode = 'plane'
+    frame_selection = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, dataset, mode='plane', frame_selection=None):
+        """Constructor from a dataset, the plane or gsps mode and the annotated frames"""
+        self.dataset = dataset
+        self.mode = mode
+        self.frame_selection = frame_selection
+        self.number_of_frames = int(dataset.get('NumberOfFrames', 1) or 1)
+        self._editors = OrderedDict()
+
+    # ------------------------------------------------------------------------------
+    def frame_indices(self, selection=None):
+        """Get the (0 based) frame indices of a selection, all frames by default"""
+        if selection is None:
+            return list(range(self.number_of_frames))
+        return [i for i in selection if 0 <= i < self.number_of_frames]
+
+    # ------------------------------------------------------------------------------
+    def editor(self, selection=None):
+        """Get the editor shared by the successive shapes of the selected frames (the session ones
+           by default), one per frames selection (None for all the frames)"""
+        selection = self.frame_selection if selection is None else selection
+        key = None if selection is None else tuple(self.frame_indices(selection))
+        if key not in self._editors:
+            rows, cols = int(self.dataset.get('Rows', 0) or 0), int(self.dataset.get('Columns', 0) or 0)
+            self._editors[key] = OverlayEditor(rows, cols) if self.mode == 'plane' else GraphicEditor(rows, cols)
+        return self._editors[key]
+
+    # ------------------------------------------------------------------------------
+    def commit(self):
+        """Add the overlay plane to the dataset, or add the graphics of each frames selection to the
+           ones of the presentation state (of the previous transforms of the dataset)"""
+        if not self._editors:
+            return
+        if self.mode == 'gsps':
+            annotations = [(editor.graphics, None if key is None else list(key))
+                           for key, editor in self._editors.items() if editor.graphics]
+            if annotations:
+                self.dataset.overlay_graphics = (getattr(self.dataset, 'overlay_graphics', None) or []) + annotations
+            return
+
+        rows, cols = int(self.dataset.get('Rows', 0) or 0), int(self.dataset.get('Columns', 0) or 0)
+        planes = np.zeros((self.number_of_frames, rows, cols), dtype=np.uint8)
+        for key, editor in self._editors.items():
+            planes[slice(None) if key is None else list(key)] |= editor.pixel_buffer[0, :, :, 0]
+        self._editors = OrderedDict()
+        mask = planes[0]
+        if not planes.any():
+            return
+        group = next((group for group in range(0x6000, 0x6020, 2)
+                      if (group << 16 | 0x3000) not in self.dataset and (group << 16 | 0x0010) not in self.dataset),
+                     None)
+        if group is None:
+            print("  Warning: no free overlay group, shapes won't be written ...")
+            return
+        tag = group << 16
+        self.dataset.add_new(tag | 0x0010, 'US', mask.shape[0])
+        self.dataset.add_new(tag | 0x0011, 'US', mask.shape[1])
+        self.dataset.add_new(tag | 0x0022, 'LO', 'dcm_transform shapes')
+        self.dataset.add_new(tag | 0x0040, 'CS', 'G')
+        self.dataset.add_new(tag | 0x0050, 'SS', [1, 1])
+        self.dataset.add_new(tag | 0x0100, 'US', 1)
+        self.dataset.add_new(tag | 0x0102, 'US', 0)
+        if self.number_of_frames > 1:
+            self.dataset.add_new(tag | 0x0015, 'IS', self.number_of_frames)
+            self.dataset.add_new(tag | 0x0051, 'US', 1)
+            mask = planes
+        self.dataset.add_new(tag | 0x3000, 'OW', pack_overlay_bits(mask))
+
+
+GSPS_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.11.1'
+
+
+# ------------------------------------------------------------------------------
+def build_presentation_state(dataset, annotations):
+    """Build a Grayscale Softcopy Presentation State referencing a dataset (its final uids) and
+       displaying the (graphics, frames) annotations, graphic objects recorded by a GraphicEditor
+       on their (0 based) frames, None for all the frames"""
+    sop_instance_uid = dicom.uid.generate_uid(entropy_srcs=[str(dataset.SOPInstanceUID), 'PR'])
+    file_meta = getattr(dicom.dataset, 'FileMetaDataset', dicom.dataset.Dataset)()
+    file_meta.MediaStorageSOPClassUID = GSPS_SOP_CLASS_UID
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = dicom.uid.ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = dicom.uid.PYDICOM_IMPLEMENTATION_UID
+    state = dicom.dataset.FileDataset('', {}, file_meta=file_meta, preamble=b'\x00' * 128)
+    state.is_little_endian = True
+    state.is_implicit_VR = False
+
+    state.SOPClassUID = GSPS_SOP_CLASS_UID
+    state.SOPInstanceUID = sop_instance_uid
+    for keyword in ['SpecificCharacterSet', 'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+                    'StudyInstanceUID', 'StudyDate', 'StudyTime', 'ReferringPhysicianName', 'StudyID',
+                    'AccessionNumber', 'RescaleSlope', 'RescaleIntercept', 'RescaleType']:
+        if keyword in dataset:
+            setattr(state, keyword, dataset.data_element(keyword).value)
+    state.Modality = 'PR'
+    state.SeriesInstanceUID = dicom.uid.generate_uid(entropy_srcs=[str(dataset.SeriesInstanceUID), 'PR'])
+    state.SeriesNumber = ''
+    state.InstanceNumber = dataset.get('InstanceNumber', 1) or 1
+    state.ContentLabel = 'DCM_TRANSFORM'
+    state.ContentDescription = 'dcm_transform shapes'
+    state.ContentCreatorName = ''
+    now = datetime.now()
+    state.PresentationCreationDate = now.strftime('%Y%m%d')
+    state.PresentationCreationTime = now.strftime('%H%M%S')
+
+    def referenced_images(frames):
+        """Referenced image sequence of the annotated image (frames)"""
+        image = dicom.dataset.Dataset()
+        image.ReferencedSOPClassUID = dataset.SOPClassUID
+        image.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
+        if frames is not None:
+            image.ReferencedFrameNumber = [index + 1 for index in frames]
+        return dicom.sequence.Sequence([image])
+
+    series = dicom.dataset.Dataset()
+    series.SeriesInstanceUID = dataset.SeriesInstanceUID
+    all_frames = any(frames is None for graphics, frames in annotations)
+    series.ReferencedImageSequence = referenced_images(
+        None if all_frames else sorted(set(index for graphics, frames in annotations for index in frames)))
+    state.ReferencedSeriesSequence = dicom.sequence.Sequence([series])
+
+    area = dicom.dataset.Dataset()
+    area.DisplayedAreaTopLeftHandCorner = [1, 1]
+    area.DisplayedAreaBottomRightHandCorner = [int(dataset.Columns), int(dataset.Rows)]
+    area.PresentationSizeMode = 'SCALE TO FIT'
+    area.PresentationPixelSpacing = list(dataset.get('PixelSpacing', [1, 1]))
+    state.DisplayedAreaSelectionSequence = dicom.sequence.Sequence([area])
+
+    layer = dicom.dataset.Dataset()
+    layer.GraphicLayer = 'DCM_TRANSFORM'
+    layer.GraphicLayerOrder = 1
+    state.GraphicLayerSequence = dicom.sequence.Sequence([layer])
+
+    items = []
+    for graphics, frames in annotations:
+        objects = []
+        for graphic_type, data, filled in graphics:
+            graphic = dicom.dataset.Dataset()
+            graphic.GraphicAnnotationUnits = 'PIXEL'
+            graphic.GraphicDimensions = 2
+            graphic.NumberOfGraphicPoints = len(data) // 2
+            graphic.GraphicData = data
+            graphic.GraphicType = graphic_type
+            graphic.GraphicFilled = 'Y' if filled else 'N'
+            objects.append(graphic)
+        annotation = dicom.dataset.Dataset()
+        annotation.ReferencedImageSequence = referenced_images(frames)
+        annotation.GraphicLayer = 'DCM_TRANSFORM'
+        annotation.GraphicObjectSequence = dicom.sequence.Sequence(objects)
+        items.append(annotation)
+    state.GraphicAnnotationSequence = dicom.sequence.Sequence(items)
+    state.PresentationLUTShape = 'INVERSE' if dataset.get('PhotometricInterpretation') == 'MONOCHROME1' \
+        else 'IDENTITY'
+    return state
+
+
+# ------------------------------------------------------------------------------
+def write_presentation_state(output_writer, dataset, output_filename):
+    """Write the companion presentation state of a dataset annotated in gsps mode, if any,
+       next to it as <name>_pr<ext>"""
+    annotations = getattr(dataset, 'overlay_graphics', None)
+    if not annotations:
+        return
+    base, ext = os.path.splitext(output_filename)
+    output_writer.write(build_presentation_state(dataset, annotations), base + '_pr' + ext)
+
+
+# options changing no file by themselves, and the header predicates of the options changing only some files
+PASSIVE_OPTIONS = set()
+SELECTIVE_OPTIONS = {}
+
+
+# ------------------------------------------------------------------------------
+class OptionParser(argparse.ArgumentParser):
+    """ Argument parser recording with each option declaration if it is passive (it changes no file by
+        itself) or selective (applies=predicate(header, args) telling which files it changes)"""
+
+    # ------------------------------------------------------------------------------
+    def add_argument(self, *args, **kwargs):
+        """Declare an option, with its optional passive and applies keywords"""
+        passive = kwargs.pop('passive', False)
+        applies = kwargs.pop('applies', None)
+        action = argparse.ArgumentParser.add_argument(self, *args, **kwargs)
+        if passive:
+            PASSIVE_OPTIONS.add(action.dest)
+        if applies is not None:
+            SELECTIVE_OPTIONS[action.dest] = applies
+        return action
+
+
 # ------------------------------------------------------------------------------
 def parse_arguments(the_args=None):
     """Parse all command line arguments"""
@@ -149,18 +1527,50 @@ def parse_arguments(the_args=None):
     defaulf_series_uid = '1.2.3.4.' + timestamp + '.0.0.0'
     defaulf_frame_of_ref_uid = '2.3.4.0.' + timestamp + '.0.0.0'
 
-    parser = argparse.ArgumentParser(description='dcm_transform, version '
-                                                 + version + ' (https://github.com/fab672000/dcmTransform). ')
+    parser = OptionParser(description='dcm_transform, version '
+                                          + version + ' (https://github.com/fab672000/dcmTransform). ')
 
-    parser.add_argument('input_series', help='Input Series folder (or file)  location')
-    parser.add_argument('output_series', help='Output Series folder (or file) location')
+    parser.add_argument('input_series', passive=True, help='Input Series folder (or file)  location')
+    parser.add_argument('output_series', passive=True, help='Output Series folder (or file) location')
 
     parser.add_argument('-an', nargs='?', type=str, default='',
                         help='Anonymize series as well (default is none)', metavar='ANON_NAME')
 
-    parser.add_argument('-r', '--recurse', action='store_true',
+    parser.add_argument('-r', '--recurse', passive=True, action='store_true',
                         help='traverse input dir tree and reproduce same subtree in output dir')
 
+    parser.add_argument('-include', passive=True, nargs='+', type=str, default='',
+                        help='Only process the files matching one of these glob patterns (name or relative path)')
+    parser.add_argument('-exclude', passive=True, nargs='+', type=str, default='',
+                        help='Skip the files and directories matching one of these glob patterns')
+    parser.add_argument('-max_depth', passive=True, nargs='?', type=int, default=-1,
+                        help='Maximum depth of the directories traversed with -r (0 for the input one only)')
+    parser.add_argument('-fsync', passive=True, nargs='?', type=str, default='never',
+                        choices=['file', 'dir', 'never'],
+                        help='Output durability: fsync each file and its directory, sync the files and ' +
+                             'their directory once per output directory (each file on Windows), or never ' +
+                             '(default). ' +
+                             'Files are always written to a temporary name then renamed in place')
+    parser.add_argument('-wbuf', passive=True, nargs='?', type=int, default=1024,
+                        help='Output write buffer size in KB (default 1024)')
+
+    parser.add_argument('-link', passive=True, action='store_true',
+                        help='Hard link the files copied through (non DICOM or needing no change) ' +
+                             'instead of copying them')
+
+    parser.add_argument('-shard', '--shard', passive=True, nargs='?', type=str, default='',
+                        help='Only process the series (directories) of the shard i/N of the tree (0 <= i < N), ' +
+                             'a stable hash of their relative path deciding their shard')
+    parser.add_argument('-merge_shards', passive=True, action='store_true',
+                        help='Merge the shard manifests found in the output and check they cover the input tree')
+
+    parser.add_argument('-jobs', applies=jobs_apply, nargs='?', type=str, default='',
+                        help='Multi-job mode: apply in one pass the option sets of the json job file rules ' +
+                             'whose predicate matches each file header', metavar='JOB_FILE')
+    parser.add_argument('-variants', passive=True, nargs='?', type=str, default='',
+                        help='Fan-out mode: read each input once and write all the variants ' +
+                             '(option sets, output roots) of a json spec file', metavar='SPEC_FILE')
+
     parser.add_argument('-dpt', '--delete_private_tags', action='store_true',
                         help='Delete private tags. Can be useful when anonymizing.')
 
@@ -172,14 +1582,25 @@ def parse_arguments(the_args=None):
     parser.add_argument('-ay', nargs='?', type=float, default=0.0, help='AY rotate angle in deg')
     parser.add_argument('-az', nargs='?', type=float, default=0.0, help='AZ rotate angle in deg')
 
+    parser.add_argument('-resample', passive=True, action='store_true',
+                        help='Resample the series volume with the 3d transform (rotation around the ' +
+                             'volume center) instead of only changing the slices geometry. The output ' +
+                             'slices keep the input slices geometry, an oblique series stays oblique ' +
+                             '(grayscale single frame slices of a directory series only, the other inputs ' +
+                             'get their geometry changed)')
+    parser.add_argument('-mem_mb', passive=True, nargs='?', type=int, default=256,
+                        help='Memory budget in MB for the volume resampling slabs')
+    parser.add_argument('-workers', passive=True, nargs='?', type=int, default=1,
+                        help='Number of worker threads for the volume resampling slabs')
+
     parser.add_argument('-sn', nargs='?', type=int, default=-1, help='Output Series  Number')
     parser.add_argument('-desc', nargs='?', type=str, default='',
                         help='Set Custom (Series) Description')
     parser.add_argument('-sdesc', nargs='?', type=str, default='',
                         help='Set Custom Study Description')
-    parser.add_argument('-suid', nargs='?', type=str, default=defaulf_series_uid,
+    parser.add_argument('-suid', passive=True, nargs='?', type=str, default=defaulf_series_uid,
                         help='Set Custom Series Instance UID')
-    parser.add_argument('-foruid', nargs='?', type=str, default=defaulf_frame_of_ref_uid,
+    parser.add_argument('-foruid', passive=True, nargs='?', type=str, default=defaulf_frame_of_ref_uid,
                         help='Set Custom Frame Of Reference UID')
     parser.add_argument('-pid', nargs='?', type=str, default='',
                         help='Set Custom PatientID')
@@ -212,9 +1633,25 @@ def parse_arguments(the_args=None):
                         metavar='DELTA_SECS')
     parser.add_argument('-adate', nargs='?', type=str, default='', help='Change acquisition date')
 
+    parser.add_argument('-dshift', nargs='?', type=str, default='', const='random',
+                        help='Shift all dates and times by a per patient offset, drawn from the SEED ' +
+                             'and the PatientID, or at random if no seed is given', metavar='SEED')
+    parser.add_argument('-dshift_max', passive=True, nargs='?', type=int, default=365,
+                        help='Maximum date shift in days, either way (default 365)')
+    parser.add_argument('-dshift_time', passive=True, action='store_true',
+                        help='Shift the times of day as well, not only whole days')
+    parser.add_argument('-dshift_map', passive=True, nargs='?', type=str, default='',
+                        help='Json file keeping the patients date shifts, loaded and updated (through a part ' +
+                             'per shard with -shard, merged by -merge_shards)')
+
     parser.add_argument('-tags', nargs='+', type=str, default='',
-                        help='Set your custom tags from  a <tag_name, tag_value> sequence !',
+                        help='Set your custom tags from  a <tag_name, tag_value> sequence ! ' +
+                             'Tags are keywords, (gggg,eeee) or 0xggggeeee, nested with [i] or [*] items ' +
+                             '(i.e. (0040,0275)[*].(0032,1060)), prefixed with + to create missing ones ' +
+                             'or ~ to delete them (no value), suffixed with :VR when not in the dictionary',
                         metavar=('TAG_NAME', 'TAG_VALUE'))
+    parser.add_argument('-tagfile', nargs='?', type=str, default='',
+                        help='Set custom tags from a file of <tag_name tag_value> lines, as -tags')
 
     parser.add_argument('-pixel', nargs='+', type=str, default='',
                         help='Set one pixel value in each file ',
@@ -245,6 +1682,59 @@ def parse_arguments(the_args=None):
                              'with intensity I and alpha blending A.',
                         metavar=('X, Y, W, H, I, A', '...'))
 
+    parser.add_argument('-roi3d', applies=rois_3d_apply, nargs='+', type=str, default='',
+                        help='Set 3d ROIs in patient mm drawn where they cross each slice: sphere CX CY CZ R, ' +
+                             'box X0 Y0 Z0 X1 Y1 Z1 or cylinder X0 Y0 Z0 X1 Y1 Z1 R, with intensity I and ' +
+                             'alpha blending A.',
+                        metavar=('SHAPE ... I A', '...'))
+    parser.add_argument('-annotations', applies=annotations_apply, nargs='?', type=str, default='',
+                        help='Draw the per instance shapes of a csv or json annotation file, keyed by ' +
+                             'sop_instance_uid or instance_number (and series_instance_uid), with shape ' +
+                             '(rect, frect, ellipse, fellipse, point), x, y(, z), width, height, value, ' +
+                             'alpha, frame and units (pixel or patient)',
+                        metavar='ANNOTATIONS_FILE')
+    parser.add_argument('-overlay', passive=True, nargs='?', type=str, default='burn',
+                        choices=['burn', 'plane', 'gsps'],
+                        help='Draw the -pixel, -roi, -crosshair, -elp, -rect and -frect shapes in the pixels ' +
+                             '(burn, default), in a 1 bit overlay plane or in a companion presentation state ' +
+                             'file (<name>_pr), the latter two leaving the pixel data untouched')
+
+    parser.add_argument('-redact', applies=redaction_applies, nargs='?', type=str, default='',
+                        help='Blank burned-in annotations with the regions of a json rule table keyed by ' +
+                             'Manufacturer, ManufacturerModelName, Rows, Columns and Modality',
+                        metavar='RULES_FILE')
+    parser.add_argument('-lut', nargs='?', type=str, default='',
+                        help='Remap pixel values through a lookup table file (.npy, or text with one output ' +
+                             'value per line, or interpolated input output pairs)', metavar='LUT_FILE')
+    parser.add_argument('-rescale', nargs=2, type=str, default='',
+                        help='Rescale pixel values linearly, clipped to the pixel data type range',
+                        metavar=('SLOPE', 'INTERCEPT'))
+    parser.add_argument('-threshold', nargs=3, type=str, default='',
+                        help='Set pixel values below T to LOW and the others to HIGH',
+                        metavar=('T', 'LOW', 'HIGH'))
+    parser.add_argument('-clip', nargs=2, type=str, default='',
+                        help='Clip pixel values to the MIN, MAX range', metavar=('MIN', 'MAX'))
+    parser.add_argument('-noise', nargs='+', type=str, default='',
+                        help='Add gaussian noise of standard deviation SIGMA, reproducible with a SEED',
+                        metavar=('SIGMA', 'SEED'))
+
+    parser.add_argument('-stats', nargs='?', type=str, default='',
+                        help='Compute the pixel statistics of the transformed images and write them per ' +
+                             'series in a csv or json (.json) report', metavar='REPORT_FILE')
+    parser.add_argument('-stats_bins', passive=True, nargs='?', type=int, default=16,
+                        help='Histogram bins count of the pixel statistics (default 16)')
+    parser.add_argument('-audit', passive=True, nargs='?', type=str, default='',
+                        help='Log the old and new values of every changed tag per file in a csv, SQLite ' +
+                             '(.db, .sqlite) or Parquet (.parquet) file, one part per shard with -shard',
+                        metavar='AUDIT_FILE')
+    parser.add_argument('-audit_batch', passive=True, nargs='?', type=int, default=10000,
+                        help='Audit log rows buffered before they are written at once (default 10000)')
+    parser.add_argument('-frames', passive=True, nargs='+', type=str, default='',
+                        help='Frames edited by the pixel options in multi-frame images: all (default), ' +
+                             'ranges like 2-10 or frame numbers (1 based). Pixel intensities can also ' +
+                             'be given per sample for color images, i.e. 255,0,0',
+                        metavar=('all|FIRST-LAST|FRAME', '...'))
+
     # parser.print_help()
 
     ret_args = parser.parse_args(the_args)
@@ -325,6 +1815,8 @@ def compute_3d_transforms(dataset, args):
     # Generate new UIDs automatically when any transform changes the geometry
     generate_new_uids(dataset, args.suid, args.foruid,
                       generate_soiud_from_seriesuid(args.suid, dataset.InstanceNumber))
+    if getattr(dataset, 'resampled', False):
+        return  # the pixels were resampled on the original geometry, see resample_series
 
     pos = [dataset.ImagePositionPatient[0].real,
            dataset.ImagePositionPatient[1].real, dataset.ImagePositionPatient[2].real, 1.]
@@ -350,9 +1842,240 @@ def compute_3d_transforms(dataset, args):
 
 
 # ------------------------------------------------------------------------------
-def fmt_float(title, num, sep):
-    """format all float numbers the same way but only if not zero"""
-    try:
+def store_native_frame(dataset, frame):
+    """Store a (rows, cols) array as the native pixel data of a dataset,
+       an encapsulated dataset is switched to Explicit VR Little Endian"""
+    transfer_syntax = dataset.file_meta.TransferSyntaxUID
+    if getattr(transfer_syntax, 'is_encapsulated', transfer_syntax.is_compressed):
+        dataset.file_meta.TransferSyntaxUID = dicom.uid.ExplicitVRLittleEndian
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+    byte_order = '<' if dataset.is_little_endian else '>'
+    dataset.PixelData = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder(byte_order)).tobytes()
+    dataset['PixelData'].VR = 'OB' if dataset.BitsAllocated <= 8 else 'OW'
+
+
+# ------------------------------------------------------------------------------
+def slice_normal(header):
+    """Get the unit normal of a slice from its ImageOrientationPatient"""
+    orient = np.array([float(val) for val in header.ImageOrientationPatient])
+    return np.cross(orient[:3], orient[3:])
+
+
+# ------------------------------------------------------------------------------
+def slice_position(header, normal):
+    """Get the position of a slice along the normal"""
+    return normal.dot([float(val) for val in header.ImagePositionPatient])
+
+
+# ------------------------------------------------------------------------------
+def volume_geometry(headers):
+    """Get the (origin, matrix) of the volume of the slices headers, sorted along the normal,
+       the matrix columns mapping (slice, row, col) voxel indices to patient mm"""
+    orient = np.array([float(val) for val in headers[0].ImageOrientationPatient])
+    row_dir, col_dir = orient[:3], orient[3:]
+    normal = slice_normal(headers[0])
+
+    positions = [slice_position(header, normal) for header in headers]
+    if len(positions) > 1:
+        slice_spacing = float(np.median(np.diff(positions)))
+    else:
+        slice_spacing = float(headers[0].get('SliceThickness', 1.0) or 1.0)
+    row_spacing, col_spacing = [float(val) for val in headers[0].PixelSpacing]
+
+    origin = np.array([float(val) for val in headers[0].ImagePositionPatient])
+    matrix = np.column_stack([normal * slice_spacing, col_dir * row_spacing, row_dir * col_spacing])
+    return origin, matrix
+
+
+# ------------------------------------------------------------------------------
+def resample_index_transform(origin, matrix, shape, args):
+    """Get the (matrix, offset) mapping output voxel indices to input voxel indices
+       for the -ax/-ay/-az rotation around the volume center and the -x/-y/-z offset"""
+    rotation = matrix_set_rotation(np.identity(4), args.ax, args.ay, args.az)[:3, :3]
+    center = origin + matrix.dot((np.array(shape) - 1) / 2.0)
+    inv_matrix = np.linalg.inv(matrix)
+    index_matrix = inv_matrix.dot(rotation.T).dot(matrix)
+    index_offset = inv_matrix.dot(rotation.T.dot(origin - center - [args.x, args.y, args.z]) + center - origin)
+
+    # drop the floating point noise so that i.e. 90 degrees rotations land exactly on the voxels
+    precision = 9
+    return np.around(index_matrix, precision), np.around(index_offset, precision)
+
+
+# ------------------------------------------------------------------------------
+def input_box(index_matrix, index_offset, first, last, shape):
+    """Get the input voxels box (lo, hi) needed to interpolate the output block first to last"""
+    corners = np.array([[c0, c1, c2] for c0 in (first[0], last[0])
+                        for c1 in (first[1], last[1]) for c2 in (first[2], last[2])], dtype=np.float64)
+    mapped = corners.dot(index_matrix.T) + index_offset
+    low = np.clip(np.floor(mapped.min(axis=0)).astype(int) - 1, 0, shape)
+    high = np.clip(np.ceil(mapped.max(axis=0)).astype(int) + 2, 0, shape)
+    return low, high
+
+
+# ------------------------------------------------------------------------------
+def resample_slab(volume, index_matrix, index_offset, first_slice, last_slice, budget, cval):
+    """Resample the output slices first_slice to last_slice (excluded) of the volume, reading only
+       the input box each block of rows needs, blocks being shrunk to fit the memory budget"""
+    from scipy import ndimage
+
+    rows, cols = volume.shape[1:]
+    slab = np.empty((last_slice - first_slice, rows, cols), dtype=np.float32)
+    block_rows = rows
+    while block_rows > 1:
+        low, high = input_box(index_matrix, index_offset, (first_slice, 0, 0),
+                              (last_slice - 1, block_rows - 1, cols - 1), volume.shape)
+        if 4 * (np.prod(np.maximum(high - low, 0)) + slab.shape[0] * block_rows * cols) <= budget:
+            break
+        block_rows = (block_rows + 1) // 2
+
+    for first_row in range(0, rows, block_rows):
+        last_row = min(rows, first_row + block_rows)
+        low, high = input_box(index_matrix, index_offset, (first_slice, first_row, 0),
+                              (last_slice - 1, last_row - 1, cols - 1), volume.shape)
+        if (high <= low).any():
+            slab[:, first_row:last_row] = cval
+            continue
+        box = np.asarray(volume[low[0]:high[0], low[1]:high[1], low[2]:high[2]], dtype=np.float32)
+        slab[:, first_row:last_row] = ndimage.affine_transform(
+            box, index_matrix, offset=index_matrix.dot([first_slice, first_row, 0]) + index_offset - low,
+            output_shape=(last_slice - first_slice, last_row - first_row, cols),
+            order=1, mode='constant', cval=cval)
+    return first_slice, slab
+
+
+# ------------------------------------------------------------------------------
+def resample_series(in_args, input_dir, output_dir, desc_prefix, filenames=None):
+    """Resample the series volume of input_dir with the 3d transform and write its slices, on the
+       input slices geometry, into output_dir. The volume is streamed in slabs within -mem_mb,
+       the input pixels being kept in a temporary memory mapped file if they don't fit"""
+    try:
+        from scipy import ndimage  # noqa: F401
+    except ImportError:
+        print("  Resampling requires scipy, volume won't be resampled ...")
+        return
+
+    # headers only, the pixels are streamed in the volume afterwards
+    headers = []
+    paths = {}
+    if filenames is None:
+        filenames = scan_files(input_dir, in_args)
+    for filename in filenames:
+        path = os.path.join(input_dir, filename)
+        if not is_dicom_file(path):
+            get_output_writer(in_args).copy(path, os.path.join(output_dir, filename), in_args.link)
+            continue
+        try:
+            header = dicom.read_file(path, stop_before_pixels=True)
+            if int(header.get('NumberOfFrames', 1) or 1) != 1:
+                print("  Warning: multi-frame " + filename + " skipped, only single frame slices are resampled ...")
+            elif 'ImagePositionPatient' not in header:
+                print("  Warning: " + filename + " skipped, it has no image position to be resampled ...")
+            else:
+                paths[id(header)] = path
+                headers.append(header)
+        except Exception as exc:
+            print(exc)
+    if any(int(header.get('SamplesPerPixel', 1)) != 1 for header in headers):
+        print("  Resampling requires grayscale slices, the color series " + input_dir + " won't be resampled ...")
+        return
+    for header in headers[1:]:
+        if (header.Rows, header.Columns, list(header.ImageOrientationPatient)) != \
+                (headers[0].Rows, headers[0].Columns, list(headers[0].ImageOrientationPatient)):
+            print("  Warning: " + os.path.basename(paths[id(header)]) + " skipped, its size or orientation " +
+                  "differs from the first slice of the volume ...")
+    headers = [header for header in headers
+               if (header.Rows, header.Columns, list(header.ImageOrientationPatient)) ==
+               (headers[0].Rows, headers[0].Columns, list(headers[0].ImageOrientationPatient))]
+    if not headers:
+        print("  No slices to resample in " + input_dir)
+        return
+
+    normal = slice_normal(headers[0])
+    headers.sort(key=lambda header: slice_position(header, normal))
+    positions = [slice_position(header, normal) for header in headers]
+    if len(positions) > 1 and np.min(np.diff(positions)) < 1e-3:
+        print("  Resampling requires distinct slice positions, the series " + input_dir +
+              " has duplicate ones (i.e. multi-echo) and won't be resampled ...")
+        return
+    sources = [paths[id(header)] for header in headers]
+    origin, matrix = volume_geometry(headers)
+    if abs(np.linalg.det(matrix)) < 1e-9:
+        print("  Resampling requires a non zero voxel size, the series " + input_dir + " won't be resampled ...")
+        return
+    budget = max(1, in_args.mem_mb) * 1024 * 1024
+    volume_file = None
+    for k, source in enumerate(sources):
+        frame = dicom.read_file(source).pixel_array
+        if k == 0:
+            shape = (len(headers),) + frame.shape
+            if 2 * frame.nbytes * len(headers) <= budget:
+                volume = np.empty(shape, dtype=frame.dtype)
+            else:
+                volume_fd, volume_file = tempfile.mkstemp(dir=output_dir, suffix='.volume')
+                os.close(volume_fd)
+                volume = np.memmap(volume_file, dtype=frame.dtype, mode='w+', shape=shape)
+            cval = frame.min()
+        volume[k] = frame
+        cval = min(cval, frame.min())
+
+    pool = None
+    try:
+        index_matrix, index_offset = resample_index_transform(origin, matrix, volume.shape, in_args)
+        workers = max(1, in_args.workers)
+        worker_budget = budget // workers
+        slab_slices = max(1, int(worker_budget // (3 * 4 * volume.shape[1] * volume.shape[2])))
+        tasks = [(first, min(first + slab_slices, volume.shape[0]))
+                 for first in range(0, volume.shape[0], slab_slices)]
+
+        def run_task(task):
+            """Resample one slab task"""
+            return resample_slab(volume, index_matrix, index_offset, task[0], task[1],
+                                 worker_budget, float(cval))
+
+        def window_results():
+            """Resample the slabs by windows of workers tasks, so that at most workers slabs are held"""
+            for first in range(0, len(tasks), workers):
+                pending = [pool.apply_async(run_task, (task,)) for task in tasks[first:first + workers]]
+                for result in pending:
+                    yield result.get()
+
+        pool = ThreadPool(workers) if workers > 1 else None
+        results = window_results() if pool is not None else (run_task(task) for task in tasks)
+        limits = np.iinfo(volume.dtype) if volume.dtype.kind in 'iu' else None
+        file_count = 0
+        for first_slice, slab in results:
+            for k in range(slab.shape[0]):
+                frame = np.rint(slab[k]) if limits is not None else slab[k]
+                if limits is not None:
+                    frame = np.clip(frame, limits.min, limits.max)
+                header = headers[first_slice + k]
+                audit_begin(header, in_args)  # the tags before the new pixel data switches the transfer syntax
+                store_native_frame(header, frame.astype(volume.dtype))
+                header.resampled = True
+                file_count += 1
+                transform_dataset(file_count, header, in_args, desc_prefix)
+                output_filename = os.path.join(output_dir, os.path.basename(sources[first_slice + k]))
+                get_output_writer(in_args).write(header, output_filename)
+                write_presentation_state(get_output_writer(in_args), header, output_filename)
+                audit_changes(header, output_filename)
+                headers[first_slice + k] = None  # written, let it go
+            print('  Resampled slices ' + str(first_slice + 1) + ' to ' +
+                  str(first_slice + slab.shape[0]) + ' of ' + str(volume.shape[0]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if volume_file is not None:
+            del volume
+            os.remove(volume_file)
+
+
+# ------------------------------------------------------------------------------
+def fmt_float(title, num, sep):
+    """format all float numbers the same way but only if not zero"""
+    try:
         if num != 0.0:
             val = title + "{:+06.1f}".format(num) + sep
         else:
@@ -381,7 +2104,7 @@ def modify_time(origdate, origtime, deltasecs):
        returns a datetime result
     """
     try:
-        torig = datetime.strptime(origdate + ' ' + origtime, "%Y%m%d %H%M%S.%f")
+        torig = parse_dicom_date_time(origdate, origtime)[0]
         dmicrosec = int((float(deltasecs) - int(float(deltasecs))) * 1000000)
         tdelta = timedelta(seconds=int(float(deltasecs)), microseconds=dmicrosec)
 
@@ -416,13 +2139,249 @@ def get_dicom_time_from(dtime):
         return '000000.000000'
 
 
+# ------------------------------------------------------------------------------
+def parse_dicom_datetime(text):
+    """Fast parse of a DT value YYYY[MM[DD[HH[MM[SS[.F{1-6}]]]]]][&ZZXX], return the datetime and its
+       (digits count, fraction digits count, utc offset suffix) format to write it back the same way"""
+    text = text.strip()
+    suffix = ''
+    for pos in range(4, len(text)):
+        if text[pos] in '+-':
+            text, suffix = text[:pos], text[pos:]
+            break
+    digits, fraction = text.partition('.')[::2]
+    value = datetime(int(digits[0:4]), int(digits[4:6] or 1), int(digits[6:8] or 1),
+                     int(digits[8:10] or 0), int(digits[10:12] or 0), int(digits[12:14] or 0),
+                     int((fraction + '000000')[:6]))
+    return value, (len(digits), len(fraction), suffix)
+
+
+# ------------------------------------------------------------------------------
+def format_dicom_datetime(value, dt_format):
+    """Format a datetime as a DT value with the format returned by parse_dicom_datetime"""
+    digits_count, fraction_count, suffix = dt_format
+    text = ('%04d%02d%02d%02d%02d%02d' % (value.year, value.month, value.day,
+                                          value.hour, value.minute, value.second))[:digits_count]
+    if fraction_count:
+        text += ('.%06d' % value.microsecond)[:fraction_count + 1]
+    return text + suffix
+
+
+# ------------------------------------------------------------------------------
+def parse_dicom_date_time(date_text, time_text=''):
+    """Parse a DA value (YYYYMMDD or old YYYY.MM.DD) and an optional TM value (HH[MM[SS[.F]]] or
+       old HH:MM:SS), return the datetime and its format as parse_dicom_datetime"""
+    date_text = date_text.strip().replace('.', '')
+    time_text = time_text.strip().replace(':', '')
+    return parse_dicom_datetime(date_text[:8] + time_text)
+
+
+# ------------------------------------------------------------------------------
+class DateShifter:
+    """ Per patient date shifting: each patient (PatientID) gets an offset of whole days (plus a time
+        of day if asked), drawn from a seed and the patient id or at random, cached for the run and
+        optionally persisted in a json file (a part of it per shard, merged by -merge_shards). All the
+        DA, DT and TM elements of a dataset are shifted in one walk, a XxxDate and its XxxTime together,
+        so intervals between studies are kept"""
+    seed = None
+    max_days = 365
+    with_time = False
+    map_filename = ''
+    save_filename = ''
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, seed=None, max_days=365, with_time=False, map_filename='', save_filename=None):
+        """Constructor from the seed (None for random offsets), the offsets range, the map file and
+           the file the map is saved to (the map file itself by default)"""
+        self.seed = seed
+        self.max_days = max_days
+        self.with_time = with_time
+        self.map_filename = map_filename
+        self.save_filename = map_filename if save_filename is None else save_filename
+        self.offsets = {}
+        self._time_tags = {}
+        self._modified = False
+        if map_filename != '' and os.path.exists(map_filename):
+            self.offsets = load_date_shift_map(map_filename)
+
+    # ------------------------------------------------------------------------------
+    def offset(self, patient):
+        """Offset of a patient, drawn once"""
+        if patient not in self.offsets:
+            if self.seed is None:
+                generator = random.SystemRandom()
+            else:
+                key = (str(self.seed) + '/' + patient).encode('utf-8')
+                generator = random.Random(int(hashlib.md5(key).hexdigest(), 16))
+            days = 0
+            while days == 0:
+                days = generator.randint(-self.max_days, self.max_days)
+            seconds = generator.randint(0, 86399) if self.with_time else 0
+            self.offsets[patient] = timedelta(days=days, seconds=seconds)
+            self._modified = True
+        return self.offsets[patient]
+
+    # ------------------------------------------------------------------------------
+    def time_tag(self, tag, keyword):
+        """Tag of the XxxTime element paired with a XxxDate one, None if none"""
+        if tag not in self._time_tags:
+            time_tag = None
+            if keyword.endswith('Date'):
+                time_tag = dicom.datadict.tag_for_keyword(keyword[:-4] + 'Time')
+            self._time_tags[tag] = time_tag
+        return self._time_tags[tag]
+
+    # ------------------------------------------------------------------------------
+    def shift_value(self, value, shift):
+        """Shift a (possibly multi valued) element value with a function of one value"""
+        if hasattr(value, 'append'):
+            return [self.shift_value(val, shift) for val in value]
+        try:
+            return shift(str(value)) if str(value).strip() != '' else value
+        except ValueError:  # malformed or range (query) value, left as is
+            return value
+
+    # ------------------------------------------------------------------------------
+    def shift_dataset(self, dataset, delta):
+        """Shift all the date and time elements of a dataset and its sequences by delta"""
+        day_delta = timedelta(days=delta.days)
+        time_delta = delta - day_delta
+        paired = set()
+
+        def shift_date(text):
+            """Shift a lone date as if its time was midnight"""
+            value, dt_format = parse_dicom_date_time(text)
+            return format_dicom_datetime(value + delta, dt_format)[:8]
+
+        def shift_time(text):
+            """Shift a lone time by the time of day of the offset"""
+            value, dt_format = parse_dicom_date_time('20000101', text)
+            return format_dicom_datetime(value + time_delta, dt_format)[8:]
+
+        def shift_datetime(text):
+            """Shift a date time"""
+            value, dt_format = parse_dicom_datetime(text)
+            return format_dicom_datetime(value + delta, dt_format)
+
+        for data_element in dataset:
+            vr = data_element.VR
+            if vr == 'SQ':
+                for item in data_element.value:
+                    self.shift_dataset(item, delta)
+            elif vr == 'DA':
+                time_tag = self.time_tag(data_element.tag, data_element.keyword)
+                time_element = dataset[time_tag] if time_tag is not None and time_tag in dataset else None
+                if time_element is not None and not hasattr(data_element.value, 'append') \
+                        and str(data_element.value).strip() != '' and str(time_element.value).strip() != '':
+                    try:
+                        value, dt_format = parse_dicom_date_time(str(data_element.value), str(time_element.value))
+                        text = format_dicom_datetime(value + delta, dt_format)
+                        data_element.value = text[:8]
+                        time_element.value = text[8:]
+                    except ValueError:
+                        pass
+                    paired.add(time_tag)
+                else:
+                    data_element.value = self.shift_value(data_element.value, shift_date)
+            elif vr == 'DT':
+                data_element.value = self.shift_value(data_element.value, shift_datetime)
+            elif vr == 'TM' and data_element.tag not in paired and time_delta:
+                data_element.value = self.shift_value(data_element.value, shift_time)
+
+    # ------------------------------------------------------------------------------
+    def apply(self, dataset):
+        """Shift the dataset dates and times by the offset of its patient"""
+        patient = str(dataset.get('PatientID', '') or dataset.get('PatientName', ''))
+        self.shift_dataset(dataset, self.offset(patient))
+
+    # ------------------------------------------------------------------------------
+    def save(self):
+        """Persist the patients offsets when a map file is given"""
+        if self.save_filename == '' or not self._modified:
+            return
+        save_date_shift_map(self.save_filename, self.offsets)
+        self._modified = False
+
+
+# ------------------------------------------------------------------------------
+def load_date_shift_map(filename):
+    """Load the patients offsets of a date shift map file"""
+    with open(filename) as map_file:
+        return dict((patient, timedelta(seconds=seconds)) for patient, seconds in json.load(map_file).items())
+
+
+# ------------------------------------------------------------------------------
+def save_date_shift_map(filename, offsets):
+    """Write the patients offsets to a date shift map file, atomically"""
+    with open(filename + '.tmp', 'w') as map_file:
+        json.dump(dict((patient, offset.days * 86400 + offset.seconds)
+                       for patient, offset in offsets.items()), map_file, indent=1, sort_keys=True)
+    if hasattr(os, 'replace'):
+        os.replace(filename + '.tmp', filename)
+    else:
+        os.rename(filename + '.tmp', filename)
+
+
+# ------------------------------------------------------------------------------
+def shard_run_key(args):
+    """Key of a sharded run, the same for all its shards: the hash of their common command line"""
+    common = [arg for arg in sys.argv[1:] if arg not in ('-shard', args.shard)]
+    return 'run:' + hashlib.md5('\0'.join(common).encode('utf-8')).hexdigest()
+
+
+# date shifters, with their patients offsets, for the whole run
+DATE_SHIFTERS = {}
+
+
+# ------------------------------------------------------------------------------
+def get_date_shifter(args):
+    """Get the date shifter requested by args, built once per run, None if not requested"""
+    if args.dshift == '':
+        return None
+    key = (args.dshift, args.dshift_max, args.dshift_time, args.dshift_map)
+    if key not in DATE_SHIFTERS:
+        seed = None if args.dshift == 'random' else args.dshift
+        save_filename = None
+        if args.shard:
+            # the shards must draw the same offset for a patient whose series they share
+            seed = shard_run_key(args) if seed is None else seed
+            if args.dshift_map != '':
+                save_filename = audit_part_filename(args.dshift_map, *parse_shard(args.shard))
+        DATE_SHIFTERS[key] = DateShifter(seed, args.dshift_max, args.dshift_time, args.dshift_map, save_filename)
+    return DATE_SHIFTERS[key]
+
+
+# ------------------------------------------------------------------------------
+def merge_date_shift_maps(filename, count):
+    """Merge the date shift map parts of N shards into the map file, return the list of problems found"""
+    offsets = load_date_shift_map(filename) if os.path.exists(filename) else {}
+    problems = []
+    for index in range(count):
+        part_filename = audit_part_filename(filename, index, count)
+        if not os.path.exists(part_filename):
+            continue  # the shard drew no new offset
+        for patient, offset in load_date_shift_map(part_filename).items():
+            if offsets.setdefault(patient, offset) != offset:
+                problems.append('Patient ' + patient + ' date shifted by different offsets in the shards')
+    save_date_shift_map(filename, offsets)
+    return problems
+
+
+# ------------------------------------------------------------------------------
+def close_date_shifters():
+    """Persist the offsets of all the date shifters"""
+    for date_shifter in DATE_SHIFTERS.values():
+        date_shifter.save()
+
+
 # ------------------------------------------------------------------------------
 # Define call-back functions for the dataset.walk() function
 # noinspection PyUnusedLocal
-def pn_callback(dataset, data_element):
-    """Called from the dataset "walk" recursive function for all data elements."""
+def pn_callback(dataset, data_element, name):
+    """Called from the dataset "walk" recursive function for all data elements,
+       bound to the anonymized name with functools.partial"""
     if data_element.VR == "PN":
-        data_element.value = ARGS.an
+        data_element.value = name
         # print (data_element.value)
 
 
@@ -434,49 +2393,260 @@ def curves_callback(dataset, data_element):
 
 
 # ------------------------------------------------------------------------------
-def assign_custom_tags(dataset, args):
-    """ Given a dataset and the args key, val pair array  arguments set custom tags"""
-    # assign custom tags
-    if args == '':
-        return
-    try:
-        tags_len = len(args)
-        if tags_len > 1:
-            print()
-        for i in range(0, int(tags_len / 2) * 2, 2):
-            print("Setting tag " + args[i] + " to " + args[i + 1] + ' ... ')
-            try:
-                data_element = dataset.data_element(args[i])
-            except KeyError:
-                # OK, maybe user wants a tag that is in file_meta metadata structure
-                # so give it a second chance:
-                data_element = dataset.file_meta.data_element(args[i])
-
-            if data_element is None:
-                print("  Could not find that tag, value won't be set ...")
-            else:
-                try:
-                    data_element.value = args[i + 1]
-                except Exception:
-                    print("  Could not set that tag value  <" + args[i + 1] +
-                          ">, value will not be set ...")
+class TagEdit:
+    """ Compiled custom tag edit: a path of (tag, item index) steps down nested sequences (index None
+        meaning all the items), a create, replace or delete mode and the value text, converted once
+        per VR to its native type. Replace only changes existing elements, create adds them as well"""
+    path = None
+    mode = 'replace'
+    vr = None
+    text = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, path, mode='replace', vr=None, text=None):
+        """Constructor from the path, mode, VR (None for the dictionary one) and value text"""
+        self.path = path
+        self.mode = mode
+        self.vr = vr
+        self.text = text
+        self.found = False
+        self._values = {}
+
+    # ------------------------------------------------------------------------------
+    def value(self, vr):
+        """Native value for a VR, converted once"""
+        if vr not in self._values:
+            self._values[vr] = convert_tag_value(self.text, vr)
+        return self._values[vr]
+
+    # ------------------------------------------------------------------------------
+    def apply(self, dataset):
+        """Apply the edit to a dataset (the file meta group for 0002 tags), return the edited count"""
+        if self.path[0][0] >> 16 == 0x0002:
+            targets = [dataset.file_meta] if getattr(dataset, 'file_meta', None) is not None else []
+        else:
+            targets = [dataset]
+        for tag, index in self.path[:-1]:
+            items = []
+            for target in targets:
+                if tag in target and target[tag].VR == 'SQ':
+                    sequence = target[tag].value
+                    if index is None:
+                        items.extend(sequence)
+                    elif index < len(sequence):
+                        items.append(sequence[index])
+            targets = items
+
+        tag = self.path[-1][0]
+        count = 0
+        for target in targets:
+            if tag in target:
+                if self.mode == 'delete':
+                    del target[tag]
+                else:
+                    data_element = target[tag]
+                    data_element.value = self.value(self.vr or data_element.VR)
+                count += 1
+            elif self.mode == 'create':
+                target.add_new(tag, self.vr, self.value(self.vr))
+                count += 1
+        if count:
+            self.found = True
+        return count
+
+
+# DICOM binary VRs given as numbers
+INT_VRS = ['US', 'SS', 'UL', 'SL', 'UV', 'SV']
+FLOAT_VRS = ['FL', 'FD']
+BYTES_VRS = ['OB', 'OW', 'OF', 'OD', 'OL', 'OV', 'UN', 'OB or OW', 'US or OW', 'US or SS or OW']
+
+TAG_STEP = re.compile(r'^(?:\(([0-9A-Fa-f]{4}),([0-9A-Fa-f]{4})\)|(?:0x)?([0-9A-Fa-f]{8})|([A-Za-z][A-Za-z0-9]*))'
+                      r'(?:\[(\*|\d+)\])?$')
+
 
-        if tags_len % 2 != 0:
+# ------------------------------------------------------------------------------
+def convert_tag_value(text, vr):
+    """Convert a value text to the native type of a VR, backslash separating multiple values"""
+    if vr in BYTES_VRS:
+        return binascii.unhexlify(text.replace(' ', '').replace('\\', ''))
+    if vr in INT_VRS:
+        values = [int(val, 0) for val in text.split('\\')]
+    elif vr in FLOAT_VRS:
+        values = [float(val) for val in text.split('\\')]
+    elif vr == 'AT':
+        values = [parse_tag_path(val)[0][0] for val in text.split('\\')]
+    elif vr == 'SQ':
+        raise ValueError('Sequences can only be deleted or edited through their items')
+    else:
+        return text  # text VRs (including DS, IS) are converted by pydicom
+    return values[0] if len(values) == 1 else values
+
+
+# ------------------------------------------------------------------------------
+def parse_tag_path(spec):
+    """Parse a tag path like (0040,0275)[*].(0032,1060), 0x00100010 or PatientName,
+       return its list of (tag, item index) steps"""
+    path = []
+    for step in spec.split('.'):
+        match = TAG_STEP.match(step)
+        if match is None:
+            raise ValueError('Invalid tag ' + step + ' in ' + spec)
+        group, element, number, keyword, index = match.groups()
+        if keyword is not None:
+            tag = dicom.datadict.tag_for_keyword(keyword)
+            if tag is None:
+                raise ValueError('Unknown tag keyword ' + keyword)
+        elif number is not None:
+            tag = int(number, 16)
+        else:
+            tag = int(group + element, 16)
+        path.append((tag, None if index in (None, '*') else int(index)))
+    return path
+
+
+# ------------------------------------------------------------------------------
+def compile_tag_edit(spec, text=None):
+    """Compile a tag spec: [+|~]path[:VR], '+' creating missing elements and '~' deleting them"""
+    mode = 'replace'
+    if spec.startswith('+'):
+        mode, spec = 'create', spec[1:]
+    elif spec.startswith('~'):
+        mode, spec = 'delete', spec[1:]
+    vr = None
+    if ':' in spec:
+        spec, vr = spec.rsplit(':', 1)
+        vr = vr.upper()
+    path = parse_tag_path(spec)
+    if vr is None and mode == 'create':
+        try:
+            vr = dicom.datadict.dictionary_VR(path[-1][0]).split(' or ')[0]
+        except KeyError:
+            raise ValueError('No VR known for ' + spec + ', give it as ' + spec + ':VR')
+    edit = TagEdit(path, mode, vr, text)
+    if vr is not None and mode != 'delete':
+        edit.value(vr)  # fail on invalid values now rather than on each file
+    return edit
+
+
+# ------------------------------------------------------------------------------
+def compile_tag_edits(tags, tag_filename=''):
+    """Compile the -tags <tag value> pairs ('~tag' taking no value) then the -tagfile lines"""
+    specs = []
+    i = 0
+    while i < len(tags):
+        if tags[i].startswith('~'):
+            specs.append(('-tags', tags[i], None))
+            i += 1
+        elif i + 1 < len(tags):
+            specs.append(('-tags', tags[i], tags[i + 1]))
+            i += 2
+        else:
             print("  Warning: list of pair of <tags value> expected, " +
                   "but odd count was found instead, " +
-                  "found ending: <" + args[tags_len - 1] + '>')
-    except Exception as exc:
-        print(exc)
+                  "found ending: <" + tags[i] + '>')
+            i += 1
+    if tag_filename != '':
+        with open(tag_filename) as tag_file:
+            for line_number, line in enumerate(tag_file):
+                fields = line.strip().split(None, 1)
+                if not fields or fields[0].startswith('#'):
+                    continue
+                specs.append((tag_filename + ':' + str(line_number + 1), fields[0],
+                              fields[1] if len(fields) > 1 else ('' if not fields[0].startswith('~') else None)))
+
+    edits = []
+    for origin, spec, text in specs:
+        try:
+            edits.append(compile_tag_edit(spec, text))
+        except Exception as exc:
+            print('  Warning: ' + origin + ': tag ' + spec + ' ignored, ' + str(exc))
+    return edits
+
+
+# cache of the compiled tag edits for the whole run
+TAG_EDITS = {}
+
+
+# ------------------------------------------------------------------------------
+def get_tag_edits(args):
+    """Get the tag edits requested by args, compiled once per run"""
+    key = (tuple(args.tags), args.tagfile)
+    if key not in TAG_EDITS:
+        TAG_EDITS[key] = compile_tag_edits(args.tags, args.tagfile)
+    return TAG_EDITS[key]
+
+
+# ------------------------------------------------------------------------------
+def assign_custom_tags(dataset, edits):
+    """ Given a dataset and the compiled tag edits (or the raw <tag value> pairs) set custom tags"""
+    if edits == '':
+        return
+    if edits and not isinstance(edits[0], TagEdit):
+        edits = compile_tag_edits(edits)
+    for edit in edits:
+        try:
+            if not edit.apply(dataset) and not edit.found and edit.mode == 'replace':
+                edit.found = True  # only warn once per run
+                print("  Could not find tag " + ' '.join('(%04X,%04X)' % (tag >> 16, tag & 0xffff)
+                                                         for tag, index in edit.path) +
+                      ", value won't be set ...")
+        except Exception as exc:
+            print(exc)
+
+
+# ------------------------------------------------------------------------------
+def parse_pixel_value(arg):
+    """Parse a pixel intensity, either one value or comma separated values per sample (i.e. 255,0,0)"""
+    values = [int(val) for val in arg.split(',')]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+# ------------------------------------------------------------------------------
+def parse_annotation_value(value):
+    """Parse the pixel value of an annotation: a number, a list of values per sample or their csv text
+       (i.e. 1023, 1023.0, [255, 0, 0] or "255,0,0")"""
+    if value is None or value == '':
+        return 0
+    if isinstance(value, (list, tuple)):
+        return [parse_annotation_value(val) for val in value]
+    if not isinstance(value, (int, float)):
+        values = [parse_annotation_value(float(val)) for val in str(value).split(',')]
+        return values[0] if len(values) == 1 else values
+    return int(round(value))
 
 
 # ------------------------------------------------------------------------------
-def set_image_pixels(dataset, args):
+def parse_frame_selection(args):
+    """Parse the frames selector args (all, 1 based ranges as 2-10, or frame numbers)
+       into a sorted list of 0 based frame indices, None meaning all frames"""
+    if args == '' or 'all' in args:
+        return None
+    indices = set()
+    for arg in args:
+        for token in arg.split(','):
+            if token == '':
+                continue
+            if '-' in token:
+                first, last = token.split('-')
+                indices.update(range(int(first) - 1, int(last)))
+            else:
+                indices.add(int(token) - 1)
+    return sorted(indices)
+
+
+# ------------------------------------------------------------------------------
+def set_image_pixels(dataset, args, pixel_session=None):
     """ Given a dataset and the args key, val pair array  arguments set custom tags"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         pix_len = len(args)
         n_vals = 4
         # if pix_len > 1:
@@ -484,7 +2654,7 @@ def set_image_pixels(dataset, args):
         for i in range(0, int(pix_len / n_vals) * n_vals, n_vals):
             pos_x = int(args[i + 0])
             pos_y = int(args[i + 1])
-            val = int(args[i + 2])
+            val = parse_pixel_value(args[i + 2])
             alpha = float(args[i + 3])
             if pixel_editor.buffer_length() == 0:
                 print("  Could not find a pixel array, value won't be set ...")
@@ -499,19 +2669,23 @@ def set_image_pixels(dataset, args):
             print("  Warning: list of quadruplets expected, but odd count was found instead, " +
                   "found ending: <" + args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
 
 # ------------------------------------------------------------------------------
-def draw_crosshair(dataset, args):
+def draw_crosshair(dataset, args, pixel_session=None):
     """ Draws a rectangular region of interest"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         n_vals = 6
         pix_len = len(args)
         # if pix_len > 1:
@@ -521,7 +2695,7 @@ def draw_crosshair(dataset, args):
             pos_y = float(args[i + 1])  # y pos
             crosshair_size = int(args[i + 2])  # crosshair size (line length)
             pen_width = int(args[i + 3])  # pen width (number of pixels)
-            intensity = int(args[i + 4])  # intensity (for dash lines purpose)
+            intensity = parse_pixel_value(args[i + 4])  # intensity (for dash lines purpose)
             alpha = float(args[i + 5])  # alpha blending (for dash lines purpose)
 
             if pixel_editor.buffer_length() == 0:
@@ -538,19 +2712,23 @@ def draw_crosshair(dataset, args):
             print("  Warning: list of 6 parameters sequences, but odd count was found instead, " +
                   "found ending: <" + args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
 
 # ------------------------------------------------------------------------------
-def draw_roi(dataset, args):
+def draw_roi(dataset, args, pixel_session=None):
     """ Draws a rectangular region of interest"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         n_vals = 4
         pix_len = len(args)
         # if pix_len > 1:
@@ -559,7 +2737,7 @@ def draw_roi(dataset, args):
             pos_x = float(args[i + 0])
             pos_y = float(args[i + 1])
             stepping = float(args[i + 2])
-            val = int(args[i + 3])
+            val = parse_pixel_value(args[i + 3])
             if pixel_editor.buffer_length() == 0:
                 print("  Could not find a pixel array, value won't be set ...")
             else:
@@ -573,19 +2751,23 @@ def draw_roi(dataset, args):
             print("  Warning: list of triplets expected, but odd count was found instead, " +
                   "found ending: <" + args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
 
 # ------------------------------------------------------------------------------
-def draw_ellipse(dataset, args):
+def draw_ellipse(dataset, args, pixel_session=None):
     """ Draws a rectangular region of interest"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         n_vals = 7
         pix_len = len(args)
         # if pix_len > 1:
@@ -595,7 +2777,7 @@ def draw_ellipse(dataset, args):
             pos_y = float(args[i + 1])  # y pos
             width = int(args[i + 2])  # rect rad width
             height = int(args[i + 3])  # rect rad height
-            pixel_intensity = int(args[i + 4])  # pixel intensity
+            pixel_intensity = parse_pixel_value(args[i + 4])  # pixel intensity
             alpha = float(args[i + 5])  # pixel alpha transparency
             stepping = int(args[i + 6])  # stepping
 
@@ -612,19 +2794,23 @@ def draw_ellipse(dataset, args):
             print("  Warning: list of triplets expected, but odd count was found instead, " +
                   "found ending: <" + args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
 
 # ------------------------------------------------------------------------------
-def draw_rectangle(dataset, args):
+def draw_rectangle(dataset, args, pixel_session=None):
     """ Draws a rectangular region of interest"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         n_vals = 7
         pix_len = len(args)
         # if pix_len > 1:
@@ -635,7 +2821,7 @@ def draw_rectangle(dataset, args):
             width = float(args[i + 2])  # rect width
             height = float(args[i + 3])  # rect height
             stepping = int(args[i + 4])  # stepping (for dash lines purpose)
-            pixel_intensity = int(args[i + 5])  # pixel intensity
+            pixel_intensity = parse_pixel_value(args[i + 5])  # pixel intensity
             alpha = float(args[i + 6])  # pixel alpha transparency
 
             if pixel_editor.buffer_length() == 0:
@@ -651,19 +2837,23 @@ def draw_rectangle(dataset, args):
             print("  Warning: list of triplets expected, but odd count was found instead, found ending: <" +
                   args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
 
 # ------------------------------------------------------------------------------
-def draw_frectangle(dataset, args):
+def draw_frectangle(dataset, args, pixel_session=None):
     """ Draws a rectangular region of interest"""
     # assign custom tags
     if args == '':
         return
     try:
-        pixel_editor = PixelEditor(dataset.pixel_array)
+        own_session = pixel_session is None
+        if own_session:
+            pixel_session = PixelSession(dataset)
+        pixel_editor = pixel_session.editor()
         n_vals = 6
         pix_len = len(args)
         # if pix_len > 1:
@@ -673,7 +2863,7 @@ def draw_frectangle(dataset, args):
             pos_y = float(args[i + 1])  # y pos
             width = float(args[i + 2])  # rect width
             height = float(args[i + 3])  # rect height
-            pixel_intensity = int(args[i + 4])  # pixel intensity
+            pixel_intensity = parse_pixel_value(args[i + 4])  # pixel intensity
             alpha = float(args[i + 5])  # pixel alpha transparency
 
             if pixel_editor.buffer_length() == 0:
@@ -688,7 +2878,8 @@ def draw_frectangle(dataset, args):
             print("  Warning: list of triplets expected, but odd count was found instead, found ending: <" +
                   args[pix_len - 1] + '>')
 
-        dataset.PixelData = pixel_editor.buffer_to_string()
+        if own_session:
+            pixel_session.commit()
     except Exception as exc:
         print(exc)
 
@@ -733,7 +2924,7 @@ def check_if_anonymize_or_cleanup_needed(dataset, args, remove_curves=False, rem
     # Remove patient name and any other person names
 
     if args.an != '':
-        dataset.walk(pn_callback)
+        dataset.walk(functools.partial(pn_callback, name=args.an))
 
         if args.pid != '':
             dataset.PatientID = args.pid
@@ -745,10 +2936,11 @@ def check_if_anonymize_or_cleanup_needed(dataset, args, remove_curves=False, rem
         change_tag_if_arg(dataset, "StationName", args.an)
         change_tag_if_arg(dataset, "SequenceName", args.an)
         change_tag_if_arg(dataset, "ProtocolName", args.an)
-        change_tag_if_arg(dataset, "ContentDate", '19010101')
-        change_tag_if_arg(dataset, "ContentTime", '000000.000000')
-        change_tag_if_arg(dataset, "PerformedProcedureStepStartDate", '19010101')
-        change_tag_if_arg(dataset, "PerformedProcedureStepStartTime", '000000.000000')
+        if args.dshift == '':  # shifted dates keep their intervals instead
+            change_tag_if_arg(dataset, "ContentDate", '19010101')
+            change_tag_if_arg(dataset, "ContentTime", '000000.000000')
+            change_tag_if_arg(dataset, "PerformedProcedureStepStartDate", '19010101')
+            change_tag_if_arg(dataset, "PerformedProcedureStepStartTime", '000000.000000')
         change_tag_if_arg(dataset, "PerformedProcedureStepID", "0")
         change_tag_if_arg(dataset, "PerformedProcedureStepDescription", args.an)
 
@@ -761,11 +2953,11 @@ def check_if_anonymize_or_cleanup_needed(dataset, args, remove_curves=False, rem
 
         # Same as above but for blanking data elements that are type 2.
         for name in ['PatientBirthDate', 'StudyDate', 'SeriesDate']:
-            if name in dataset:
+            if name in dataset and args.dshift == '':
                 dataset.data_element(name).value = '19010101'
 
         for name in ['SeriesTime', 'StudyTime']:
-            if name in dataset:
+            if name in dataset and args.dshift == '':
                 dataset.data_element(name).value = '000000.000000'
 
     # applicable with or without anon:
@@ -785,6 +2977,886 @@ def truncate_str(input_str, maxlen, ending='..'):
     return input_str
 
 
+# ------------------------------------------------------------------------------
+def stored_value_range(dataset):
+    """(lowest, highest) stored pixel values of a dataset, None for float pixel data"""
+    if 'BitsStored' not in dataset:
+        return None
+    bits = int(dataset.BitsStored)
+    if int(dataset.get('PixelRepresentation', 0) or 0):
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    return 0, (1 << bits) - 1
+
+
+# ------------------------------------------------------------------------------
+def slice_statistics(dataset, pixel_session, bins=16, selection=None):
+    """Pixel statistics of the selected frames (all by default) of a transformed dataset from the arrays
+       of its pixel session: min, max, mean, std, count of pixels at the stored range bounds (clipped),
+       count of pixels changed by the edits and a histogram of bins over the stored range"""
+    pixel_session.flush_editor()  # the pending edits of a frames subset or of encapsulated frames
+    frames = pixel_session.get_frames(pixel_session.frame_indices(selection))
+    values = frames.ravel()
+    stats = OrderedDict()
+    stats['frames'] = frames.shape[0]
+    stats['pixels'] = int(values.size)
+    stats['min'] = values.min().item()
+    stats['max'] = values.max().item()
+    stats['sum'] = float(values.sum(dtype=np.float64))
+    stats['sum2'] = float(np.dot(values.astype(np.float64), values.astype(np.float64)))
+    stats['mean'] = stats['sum'] / values.size
+    stats['std'] = math.sqrt(max(stats['sum2'] / values.size - stats['mean'] ** 2, 0.0))
+    value_range = stored_value_range(dataset) if values.dtype.kind in 'iu' else None
+    if value_range is None:
+        value_range = (stats['min'], stats['max'])
+        stats['clipped'] = 0
+    else:
+        stats['clipped'] = int(np.count_nonzero((values == value_range[0]) | (values == value_range[1])))
+    span = float(value_range[1] - value_range[0])
+    if values.dtype.kind in 'iu':
+        span += 1  # count of stored values
+    scale = bins / span if span > 0 else 0.0
+    indices = np.clip(((values - value_range[0]) * scale).astype(np.int64), 0, bins - 1)
+    stats['histogram'] = np.bincount(indices, minlength=bins).tolist()
+    stats['changed'] = pixel_session.changed_count()
+    return stats
+
+
+# ------------------------------------------------------------------------------
+class StatisticsReport:
+    """ Per slice pixel statistics aggregated per output series, written at the end of the run
+        as json (series totals with their slices) or csv (one line per series). With -shard each
+        shard writes its raw slices to a json part instead, merged by -merge_shards"""
+    filename = ''
+    bins = 16
+    part_filename = None
+    fields = ['series_instance_uid', 'series_description', 'slices', 'frames', 'pixels', 'min', 'max',
+              'mean', 'std', 'clipped', 'changed', 'empty_slices', 'histogram']
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, filename, bins=16, part_filename=None):
+        """Constructor from the report filename, the histograms bins count and the shard part filename"""
+        self.filename = filename
+        self.bins = bins
+        self.part_filename = part_filename
+        self.series = OrderedDict()
+
+    # ------------------------------------------------------------------------------
+    def add(self, dataset, stats):
+        """Add the statistics of a transformed dataset to its series"""
+        uid = str(dataset.get('SeriesInstanceUID', ''))
+        if uid not in self.series:
+            self.series[uid] = OrderedDict([('series_instance_uid', uid),
+                                            ('series_description', str(dataset.get('SeriesDescription', ''))),
+                                            ('slices', [])])
+        stats = OrderedDict([('sop_instance_uid', str(dataset.get('SOPInstanceUID', ''))),
+                             ('instance_number', dataset.get('InstanceNumber', ''))] + list(stats.items()))
+        self.series[uid]['slices'].append(stats)
+
+    # ------------------------------------------------------------------------------
+    def summary(self, series):
+        """Aggregate the slices of a series"""
+        slices = series['slices']
+        totals = OrderedDict((name, series[name]) for name in ['series_instance_uid', 'series_description'])
+        totals['slices'] = len(slices)
+        for name in ['frames', 'pixels', 'clipped', 'changed']:
+            totals[name] = sum(stats[name] for stats in slices)
+        totals['min'] = min(stats['min'] for stats in slices)
+        totals['max'] = max(stats['max'] for stats in slices)
+        totals['mean'] = sum(stats['sum'] for stats in slices) / totals['pixels']
+        totals['std'] = math.sqrt(max(sum(stats['sum2'] for stats in slices) / totals['pixels'] -
+                                      totals['mean'] ** 2, 0.0))
+        totals['empty_slices'] = sum(1 for stats in slices if stats['min'] == stats['max'])
+        totals['histogram'] = np.sum([stats['histogram'] for stats in slices], axis=0).tolist()
+        return totals
+
+    # ------------------------------------------------------------------------------
+    def write(self):
+        """Write the report"""
+        summaries = [self.summary(series) for series in self.series.values()]
+        with open(self.filename, 'w') as report_file:
+            if self.filename.lower().endswith('.json'):
+                for summary, series in zip(summaries, self.series.values()):
+                    summary['slices_stats'] = [OrderedDict((name, value) for name, value in stats.items()
+                                                           if name not in ('sum', 'sum2'))
+                                               for stats in series['slices']]
+                json.dump(OrderedDict([('bins', self.bins), ('series', summaries)]), report_file, indent=1)
+            else:
+                writer = csv.writer(report_file, lineterminator='\n')
+                writer.writerow(self.fields)
+                for summary in summaries:
+                    writer.writerow([' '.join(str(count) for count in summary[name]) if name == 'histogram'
+                                     else summary[name] for name in self.fields])
+
+    # ------------------------------------------------------------------------------
+    def write_part(self):
+        """Write the shard part: the raw slices of each series, sums included to merge them exactly"""
+        with open(self.part_filename, 'w') as part_file:
+            json.dump(OrderedDict([('bins', self.bins), ('series', list(self.series.values()))]), part_file)
+
+    # ------------------------------------------------------------------------------
+    def read_part(self, part_filename):
+        """Add the slices of a shard part to the series, return the list of problems found"""
+        with open(part_filename) as part_file:
+            part = json.load(part_file, object_pairs_hook=OrderedDict)
+        if part['bins'] != self.bins:
+            return ['Statistics part ' + part_filename + ' has ' + str(part['bins']) + ' bins instead of ' +
+                    str(self.bins)]
+        for series in part['series']:
+            uid = series['series_instance_uid']
+            if uid in self.series:
+                self.series[uid]['slices'].extend(series['slices'])
+            else:
+                self.series[uid] = series
+        return []
+
+
+# statistics reports of the whole run
+STATISTICS_REPORTS = {}
+
+
+# ------------------------------------------------------------------------------
+def statistics_part_filename(filename, index, count):
+    """Statistics report json part written by the shard i/N, merged by -merge_shards"""
+    return audit_part_filename(filename + '.json', index, count)
+
+
+# ------------------------------------------------------------------------------
+def get_statistics_report(args):
+    """Get the statistics report of the -stats file (writing the shard part of it with -shard),
+       None if not requested"""
+    if args.stats == '':
+        return None
+    if args.stats not in STATISTICS_REPORTS:
+        part_filename = statistics_part_filename(args.stats, *parse_shard(args.shard)) if args.shard else None
+        STATISTICS_REPORTS[args.stats] = StatisticsReport(args.stats, args.stats_bins, part_filename)
+    return STATISTICS_REPORTS[args.stats]
+
+
+# ------------------------------------------------------------------------------
+def close_statistics_reports():
+    """Write all the statistics reports, the shard parts even if empty"""
+    for report in STATISTICS_REPORTS.values():
+        if report.part_filename is not None:
+            report.write_part()
+        elif report.series:
+            report.write()
+
+
+# ------------------------------------------------------------------------------
+def merge_statistics_parts(filename, count, bins=16):
+    """Merge in shard order the statistics report parts of N shards, return the list of problems found"""
+    report = StatisticsReport(filename, bins)
+    problems = []
+    for index in range(count):
+        part_filename = statistics_part_filename(filename, index, count)
+        if not os.path.exists(part_filename):
+            problems.append('Statistics part ' + part_filename + ' missing')
+            continue
+        problems.extend(report.read_part(part_filename))
+    if report.series:
+        report.write()
+    return problems
+
+
+# the pixel data is not audited, only the tags are
+PIXEL_DATA_TAG = 0x7FE00010
+
+
+# ------------------------------------------------------------------------------
+def open_csv(filename, mode='r'):
+    """Open a csv file without newline translation, so that the quoted multi-line values round trip"""
+    if sys.version_info[0] < 3:
+        return open(filename, mode + 'b')
+    return open(filename, mode, newline='')
+
+
+# ------------------------------------------------------------------------------
+def audit_format(filename):
+    """Audit log format from its filename extension: sqlite, parquet or csv"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ['.db', '.sqlite', '.sqlite3']:
+        return 'sqlite'
+    if extension == '.parquet':
+        return 'parquet'
+    return 'csv'
+
+
+# ------------------------------------------------------------------------------
+def audit_part_filename(filename, index, count):
+    """Audit log part written by the shard i/N, merged by -merge_shards"""
+    root, extension = os.path.splitext(filename)
+    return root + '.shard-' + str(index) + '-of-' + str(count) + extension
+
+
+# ------------------------------------------------------------------------------
+def freeze_element(data_element):
+    """Comparable (VR, value) state of a parsed data element, copying its multiple values,
+       the raw (not yet parsed) elements being kept as is"""
+    if data_element is None or isinstance(data_element, dicom.dataelem.RawDataElement):
+        return data_element
+    value = data_element.value
+    if data_element.VR == 'SQ':
+        value = str(value)
+    elif isinstance(value, (list, dicom.multival.MultiValue)):
+        value = tuple(value)
+    return data_element.VR, value
+
+
+# ------------------------------------------------------------------------------
+def element_state(element):
+    """(VR, value) state of a snapshot or current element, parsing it if still raw"""
+    if isinstance(element, dicom.dataelem.RawDataElement):
+        return freeze_element(dicom.dataelem.DataElement_from_raw(element))
+    return freeze_element(element) if isinstance(element, dicom.dataelem.DataElement) else element
+
+
+# ------------------------------------------------------------------------------
+def audit_text(state):
+    """Audit log text of an element state, the binary values being summarized by their length"""
+    if state is None:
+        return ''
+    value = state[1]
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return '<' + str(len(value)) + ' bytes>'
+    if isinstance(value, tuple):
+        return '\\'.join(str(val) for val in value)
+    return '' if value is None else str(value)
+
+
+# ------------------------------------------------------------------------------
+def dataset_elements(dataset):
+    """All the (tag, element) of a dataset and its file meta group but the pixel data,
+       without parsing the raw elements"""
+    groups = [dataset.file_meta] if getattr(dataset, 'file_meta', None) is not None else []
+    for group in groups + [dataset]:
+        for tag in group.keys():
+            if tag != PIXEL_DATA_TAG:
+                yield tag, group.get_item(tag)
+
+
+# ------------------------------------------------------------------------------
+def read_audit_rows(filename):
+    """Read back the rows of an audit log (i.e. a shard part)"""
+    log_format = audit_format(filename)
+    if log_format == 'sqlite':
+        connection = sqlite3.connect(filename)
+        try:
+            for row in connection.execute('SELECT ' + ', '.join(AuditLog.fields) + ' FROM audit'):
+                yield list(row)
+        finally:
+            connection.close()
+    elif log_format == 'parquet':
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches():
+            columns = batch.to_pydict()
+            for row in zip(*[columns[name] for name in AuditLog.fields]):
+                yield list(row)
+    else:
+        with open_csv(filename) as log_file:
+            reader = csv.reader(log_file)
+            next(reader, None)  # header
+            for row in reader:
+                yield row
+
+
+# ------------------------------------------------------------------------------
+class AuditLog:
+    """ Change capture of the tags the transforms set, add, or delete: one (file, tag, old, new) row per
+        change appended to in memory column buffers, flushed in batches to a csv, SQLite (.db, .sqlite)
+        or Parquet (.parquet, with pyarrow) file. The elements never parsed during the transform are
+        compared by identity only, so that the audit stays cheap"""
+    filename = ''
+    batch_size = 10000
+    fields = ['file', 'tag', 'keyword', 'vr', 'action', 'old', 'new']
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, filename, batch_size=10000):
+        """Constructor from the log filename and the rows count flushed at once"""
+        self.filename = filename
+        self.batch_size = max(1, batch_size)
+        self.format = audit_format(filename)
+        if self.format == 'parquet' and pyarrow is None:
+            print("  Warning: pyarrow is not installed, the audit log is written as csv ...")
+            self.format = 'csv'
+            self.filename = os.path.splitext(filename)[0] + '.csv'
+        self.columns = OrderedDict((name, []) for name in self.fields)
+        self.rows = 0
+        self.total = 0
+        self._output = None
+
+    # ------------------------------------------------------------------------------
+    def snapshot(self, dataset):
+        """Capture the elements of a dataset before it is transformed"""
+        return dict((tag, freeze_element(element)) for tag, element in dataset_elements(dataset))
+
+    # ------------------------------------------------------------------------------
+    def record(self, filename, dataset, snapshot):
+        """Compare a transformed dataset to its snapshot and buffer a row per changed tag"""
+        current = dict(dataset_elements(dataset))
+        for tag in sorted(set(snapshot) | set(current)):
+            old, new = snapshot.get(tag), current.get(tag)
+            if old is new:
+                continue  # still raw, never parsed hence unchanged
+            old, new = element_state(old), element_state(new)
+            if old == new:
+                continue
+            try:
+                keyword = dicom.datadict.keyword_for_tag(tag)
+            except Exception:
+                keyword = ''
+            action = 'added' if old is None else 'deleted' if new is None else 'changed'
+            self.append([filename, '(%04X,%04X)' % (tag >> 16, tag & 0xffff), keyword, (new or old)[0], action,
+                         audit_text(old), audit_text(new)])
+
+    # ------------------------------------------------------------------------------
+    def append(self, row):
+        """Buffer a row, flushing the buffers once the batch is full"""
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+        self.rows += 1
+        if self.rows >= self.batch_size:
+            self.flush()
+
+    # ------------------------------------------------------------------------------
+    def open(self):
+        """Create the log file, replacing a previous one"""
+        if self.format == 'sqlite':
+            self._output = sqlite3.connect(self.filename)
+            self._output.execute('DROP TABLE IF EXISTS audit')
+            self._output.execute('CREATE TABLE audit (' + ', '.join(name + ' TEXT' for name in self.fields) + ')')
+        elif self.format == 'parquet':
+            schema = pyarrow.schema([(name, pyarrow.string()) for name in self.fields])
+            self._output = pyarrow.parquet.ParquetWriter(self.filename, schema)
+        else:
+            self._output = open_csv(self.filename, 'w')
+            csv.writer(self._output, lineterminator='\n').writerow(self.fields)
+
+    # ------------------------------------------------------------------------------
+    def flush(self):
+        """Write the buffered rows in one batch"""
+        if self._output is None:
+            self.open()
+        if self.rows == 0:
+            return
+        if self.format == 'sqlite':
+            self._output.executemany('INSERT INTO audit VALUES (' + ', '.join('?' * len(self.fields)) + ')',
+                                     zip(*self.columns.values()))
+            self._output.commit()
+        elif self.format == 'parquet':
+            self._output.write_table(pyarrow.Table.from_pydict(self.columns, schema=self._output.schema))
+        else:
+            csv.writer(self._output, lineterminator='\n').writerows(zip(*self.columns.values()))
+        self.total += self.rows
+        self.rows = 0
+        for column in self.columns.values():
+            del column[:]
+
+    # ------------------------------------------------------------------------------
+    def close(self):
+        """Flush the last rows and close the log file"""
+        self.flush()
+        if self.format == 'sqlite':
+            self._output.commit()
+        self._output.close()
+        self._output = None
+
+
+# audit logs of the whole run
+AUDIT_LOGS = {}
+
+
+# ------------------------------------------------------------------------------
+def get_audit_log(args):
+    """Get the audit log of the -audit file (the shard part of it with -shard), None if not requested"""
+    if args.audit == '':
+        return None
+    filename = args.audit
+    if args.shard:
+        filename = audit_part_filename(filename, *parse_shard(args.shard))
+    if filename not in AUDIT_LOGS:
+        AUDIT_LOGS[filename] = AuditLog(filename, args.audit_batch)
+    return AUDIT_LOGS[filename]
+
+
+# ------------------------------------------------------------------------------
+def audit_begin(dataset, args):
+    """Snapshot a dataset before its first transform, if an audit log is requested"""
+    audit_log = get_audit_log(args)
+    if audit_log is not None and getattr(dataset, 'audit_snapshot', None) is None:
+        dataset.audit_snapshot = (audit_log, audit_log.snapshot(dataset))
+
+
+# ------------------------------------------------------------------------------
+def audit_changes(dataset, filename):
+    """Log the tag changes of a transformed dataset once written to filename"""
+    audit = getattr(dataset, 'audit_snapshot', None)
+    if audit is not None:
+        audit[0].record(filename, dataset, audit[1])
+        dataset.audit_snapshot = None
+
+
+# ------------------------------------------------------------------------------
+def close_audit_logs():
+    """Flush and close all the audit logs"""
+    for audit_log in AUDIT_LOGS.values():
+        audit_log.close()
+    AUDIT_LOGS.clear()
+
+
+# ------------------------------------------------------------------------------
+def merge_audit_parts(filename, count, batch_size=10000):
+    """Merge in shard order the audit log parts of N shards, return the list of problems found"""
+    audit_log = AuditLog(filename, batch_size)
+    problems = []
+    for index in range(count):
+        part_filename = audit_part_filename(audit_log.filename, index, count)
+        if not os.path.exists(part_filename):
+            problems.append('Audit log part ' + part_filename + ' missing')
+            continue
+        for row in read_audit_rows(part_filename):
+            audit_log.append(row)
+    audit_log.close()
+    return problems
+
+
+# ------------------------------------------------------------------------------
+class OutputWriter:
+    """ Output layer writing each dataset to a temporary file of the target directory through
+        a large buffer, then renaming it in place, so that a crash never leaves a truncated file.
+        The fsync policy is either 'file' (each file and its directory), 'dir' (the file system of a
+        directory once for all its files, then the directory, when it is flushed; each file before it
+        is closed where the file system can't be synced at once, i.e. on Windows) or 'never'"""
+    fsync_policy = 'never'
+    buffer_size = 1024 * 1024
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, fsync_policy='never', buffer_size=1024 * 1024):
+        """Constructor from the fsync policy and the write buffer size in bytes"""
+        self.fsync_policy = fsync_policy
+        self.buffer_size = buffer_size
+        self._sync_files = fsync_policy == 'file' or (fsync_policy == 'dir' and not hasattr(os, 'sync'))
+        self._created = set()
+        self._pending = OrderedDict()
+        self._umask = os.umask(0)
+        os.umask(self._umask)
+
+    # ------------------------------------------------------------------------------
+    def make_dirs(self, directories):
+        """Create all the output directories of a scan at once, parents first"""
+        for directory in sorted(set(os.path.normpath(directory) for directory in directories)):
+            if directory in self._created:
+                continue
+            if not os.path.isdir(directory):
+                if os.path.exists(directory):
+                    raise IOError("Output name exists but is not a directory: " + directory)
+                os.makedirs(directory)
+            # parents exist too now
+            while directory not in self._created and directory not in ('', os.sep):
+                self._created.add(directory)
+                directory = os.path.dirname(directory)
+
+    # ------------------------------------------------------------------------------
+    def write(self, dataset, filename):
+        """Write a dataset to filename atomically"""
+        directory = os.path.dirname(filename) or os.curdir
+        self.make_dirs([directory])
+        temp_fd, temp_filename = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                                  suffix='.tmp', dir=directory)
+        try:
+            with io.open(temp_fd, 'wb', buffering=self.buffer_size) as out_file:
+                dataset.save_as(out_file)
+                out_file.flush()
+                if self._sync_files:
+                    os.fsync(out_file.fileno())
+            os.chmod(temp_filename, 0o666 & ~self._umask)  # mkstemp files are private
+            if hasattr(os, 'replace'):
+                os.replace(temp_filename, filename)
+            else:
+                os.rename(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        if self.fsync_policy == 'file':
+            fsync_directory(directory)
+        elif self.fsync_policy == 'dir':
+            self._pending[os.path.normpath(directory)] = True
+
+    # ------------------------------------------------------------------------------
+    def copy(self, src_filename, filename, link=False):
+        """Copy a file through without parsing it, hard linked if asked and possible,
+           else copied inside the kernel (copy_file_range, which reflinks when the
+           file system can, or sendfile), atomically as the written datasets"""
+        directory = os.path.dirname(filename) or os.curdir
+        self.make_dirs([directory])
+        temp_fd, temp_filename = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                                  suffix='.tmp', dir=directory)
+        try:
+            if link and hasattr(os, 'link'):
+                os.close(temp_fd)
+                os.remove(temp_filename)
+                try:
+                    os.link(src_filename, temp_filename)
+                    temp_fd = None
+                except OSError:  # i.e. another device, copy it
+                    temp_fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            if temp_fd is not None:
+                try:
+                    with open(src_filename, 'rb') as src_file:
+                        copy_file_data(src_file, temp_fd, os.fstat(src_file.fileno()).st_size)
+                    if self._sync_files:
+                        os.fsync(temp_fd)
+                finally:
+                    os.close(temp_fd)
+                os.chmod(temp_filename, 0o666 & ~self._umask)
+            if hasattr(os, 'replace'):
+                os.replace(temp_filename, filename)
+            else:
+                os.rename(temp_filename, filename)
+        except Exception:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        if self.fsync_policy == 'file':
+            fsync_directory(directory)
+        elif self.fsync_policy == 'dir':
+            self._pending[os.path.normpath(directory)] = True
+
+    # ------------------------------------------------------------------------------
+    def flush_directory(self, directory):
+        """Sync the files of a directory and the directory they were renamed into, once for all of
+           them, for the 'dir' policy"""
+        directory = os.path.normpath(directory or os.curdir)
+        if self._pending.pop(directory, False):
+            if not self._sync_files:
+                sync_file_system(directory)
+            fsync_directory(directory)
+
+    # ------------------------------------------------------------------------------
+    def close(self):
+        """Flush all the directories still pending"""
+        for directory in list(self._pending.keys()):
+            self.flush_directory(directory)
+
+
+# ------------------------------------------------------------------------------
+def copy_file_data(src_file, dst_fd, size):
+    """Copy size bytes of an open file to a file descriptor, inside the kernel when possible"""
+    src_fd = src_file.fileno()
+    copied = 0
+    for kernel_copy in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+        if kernel_copy is None:
+            continue
+        try:
+            while copied < size:
+                if kernel_copy is os.sendfile:
+                    count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                else:
+                    count = kernel_copy(src_fd, dst_fd, size - copied, copied, copied)
+                if count == 0:
+                    break
+                copied += count
+            if copied >= size:
+                return
+        except OSError:  # not supported by this file system / platform, try the next one
+            pass
+    src_file.seek(copied)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        chunk = src_file.read(1024 * 1024)
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+
+
+# ------------------------------------------------------------------------------
+def sync_file_system(directory):
+    """Sync all the written files of the file system of a directory in one call: syncfs on Linux,
+       the whole system sync elsewhere"""
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                if ctypes.CDLL(None, use_errno=True).syncfs(dir_fd) == 0:
+                    return
+            finally:
+                os.close(dir_fd)
+        except (OSError, AttributeError, ImportError):
+            pass
+    os.sync()
+
+
+# ------------------------------------------------------------------------------
+def fsync_directory(directory):
+    """Sync a directory entry list so the renames are durable (not supported on Windows)"""
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+# output writers for the whole run
+OUTPUT_WRITERS = {}
+
+
+# ------------------------------------------------------------------------------
+def get_output_writer(args):
+    """Get the output writer of the -fsync and -wbuf options, created once per run"""
+    key = (args.fsync, args.wbuf)
+    if key not in OUTPUT_WRITERS:
+        OUTPUT_WRITERS[key] = OutputWriter(args.fsync, max(1, args.wbuf) * 1024)
+    return OUTPUT_WRITERS[key]
+
+
+# ------------------------------------------------------------------------------
+def close_output_writers():
+    """Flush the pending directories of all the output writers at the end of the run"""
+    for output_writer in OUTPUT_WRITERS.values():
+        output_writer.close()
+
+
+# ------------------------------------------------------------------------------
+def list_directory(dirpath):
+    """List a directory in one pass, return its (name, is_dir) entries, the file types coming from
+       the directory entries themselves (no stat per file on most file systems, but the symbolic
+       links, followed as os.path.isdir does)"""
+    if scandir is None:
+        return [(name, os.path.isdir(os.path.join(dirpath, name))) for name in os.listdir(dirpath)]
+    entries = scandir(dirpath)
+    try:
+        return [(entry.name, entry.is_dir()) for entry in entries]
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+
+
+# ------------------------------------------------------------------------------
+def path_matches(rel_path, patterns):
+    """Tell if a relative path ('/' separated) or its name matches any of the glob patterns"""
+    name = rel_path.rsplit('/', 1)[-1]
+    for pattern in patterns:
+        if fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+# ------------------------------------------------------------------------------
+def scan_tree(root, args, recurse=None):
+    """Lazily yield the (dirpath, rel_dir, filenames) series directories of a tree, pre-order as
+       os.walk, with one directory listing each. Directories matching -exclude or deeper than
+       -max_depth are pruned, filenames keep the (sorted) files matching -include but not -exclude"""
+    if recurse is None:
+        recurse = args.recurse
+    stack = [(root, '', 0)]
+    visited = set()
+    while stack:
+        dirpath, rel_dir, depth = stack.pop()
+        real_path = os.path.realpath(dirpath)
+        if real_path in visited:
+            print('  Warning: ' + dirpath + ' already scanned, symbolic link loop skipped')
+            continue
+        visited.add(real_path)
+        try:
+            entries = list_directory(dirpath)
+        except OSError as exc:
+            print('  Warning: could not list ' + dirpath + ', ' + str(exc))
+            continue
+        filenames = []
+        subdirs = []
+        for name, is_dir in entries:
+            rel_path = rel_dir + '/' + name if rel_dir != '' else name
+            if args.exclude and path_matches(rel_path, args.exclude):
+                continue
+            if is_dir:
+                if recurse and (args.max_depth < 0 or depth < args.max_depth):
+                    subdirs.append(name)
+            elif not args.include or path_matches(rel_path, args.include):
+                filenames.append(name)
+        yield dirpath, rel_dir.replace('/', os.sep), sorted(filenames)
+        for name in sorted(subdirs, reverse=True):
+            stack.append((os.path.join(dirpath, name), rel_dir + '/' + name if rel_dir != '' else name, depth + 1))
+
+
+# ------------------------------------------------------------------------------
+def scan_files(dirpath, args):
+    """Files of one directory, filtered as scan_tree"""
+    return next(scan_tree(dirpath, args, False))[2]
+
+
+# ------------------------------------------------------------------------------
+def is_dicom_file(filename):
+    """Tell if a file is a DICOM (part 10) dataset from its 128 bytes preamble and DICM prefix,
+       a DICOMDIR media directory being copied through as the other non image files"""
+    if os.path.basename(filename).upper() == 'DICOMDIR':
+        return False
+    try:
+        with open(filename, 'rb') as dicom_file:
+            header = dicom_file.read(132)
+    except (IOError, OSError):
+        return False
+    return len(header) == 132 and header[128:] == b'DICM'
+
+
+# default values of all the options, parsed once for the whole run
+OPTION_DEFAULTS = {}
+
+
+# ------------------------------------------------------------------------------
+def option_defaults(args):
+    """Get the default values of all the options, parsing them on the first call only"""
+    if not OPTION_DEFAULTS:
+        OPTION_DEFAULTS.update(vars(parse_arguments([args.input_series, args.output_series])))
+    return OPTION_DEFAULTS
+
+
+# ------------------------------------------------------------------------------
+def active_options(args):
+    """Get the names of the options, but the passive ones, set to a non default value"""
+    defaults = option_defaults(args)
+    return [name for name, value in vars(args).items()
+            if name not in PASSIVE_OPTIONS and value != defaults.get(name)]
+
+
+# ------------------------------------------------------------------------------
+def needs_transform(args):
+    """Tell if any option changes the files, otherwise they are copied through without parsing"""
+    return len(active_options(args)) > 0
+
+
+# ------------------------------------------------------------------------------
+def file_selectors(args):
+    """Get the header predicates of the active options if they are all selective, a file no predicate
+       holds for being copied through, None if an option changes every file"""
+    names = active_options(args)
+    if not names or any(name not in SELECTIVE_OPTIONS for name in names):
+        return None
+    return [(SELECTIVE_OPTIONS[name], args) for name in names]
+
+
+# ------------------------------------------------------------------------------
+def file_needs_transform(filename, selectors):
+    """Tell from its header only if any of the selective options changes a file"""
+    try:
+        header = dicom.read_file(filename, stop_before_pixels=True)
+        return any(applies(header, args) for applies, args in selectors)
+    except Exception as exc:
+        print(exc)
+        return True  # let the transform report the problem
+
+
+# ------------------------------------------------------------------------------
+def commit_pixels(dataset, args, pixel_session):
+    """Compute the pixel statistics from the edited arrays if requested, then encode back the edited
+       frames, return the statistics (None if not computed)"""
+    pixel_stats = None
+    if args.stats != '' and pixel_session.has_pixels():
+        try:
+            pixel_stats = slice_statistics(dataset, pixel_session, args.stats_bins,
+                                           parse_frame_selection(args.frames))
+        except Exception as exc:
+            print("  Could not compute the pixel statistics, " + str(exc))
+    pixel_session.commit()
+    return pixel_stats
+
+
+# ------------------------------------------------------------------------------
+def transform_dataset(file_count, dataset, args, desc_prefix, pixel_session=None):
+    """Replace data element values of an already loaded dataset to partly transform it.
+       A given pixel session is shared with other transforms of the dataset, its owner commits it"""
+    audit_begin(dataset, args)  # the tags before the first transform
+
+    # 3d xforms user cmd options
+    compute_3d_transforms(dataset, args)
+
+    # all pixel edits share one decode, edited frames are encoded back once
+    own_session = pixel_session is None
+    if own_session:
+        pixel_session = PixelSession(dataset, parse_frame_selection(args.frames), args.stats != '')
+    else:
+        pixel_session.frame_selection = parse_frame_selection(args.frames)
+    pixel_transform = get_pixel_transform(args)
+    if pixel_transform is not None:
+        pixel_transform.apply(dataset, pixel_session)  # intensity transforms before overlays
+    redaction_rules = get_redaction_rules(args)
+    if redaction_rules is not None:
+        redaction_rules.apply(dataset, pixel_session)  # blank burned-in annotations
+    # shapes are burned in the pixels, or kept aside in an overlay plane or a presentation state
+    shapes_session = pixel_session if args.overlay == 'burn' \
+        else OverlaySession(dataset, args.overlay, parse_frame_selection(args.frames))
+    annotation_index = get_annotation_index(args)
+    if annotation_index is not None:
+        annotation_index.apply(dataset, shapes_session)  # this instance shapes of the annotation file
+    set_image_pixels(dataset, args.pixel, shapes_session)  # set pixels in image buffer
+    draw_roi(dataset, args.roi, shapes_session)  # set a ROI square in image buffer
+    draw_ellipse(dataset, args.elp, shapes_session)  # set an ellipse
+    draw_rectangle(dataset, args.rect, shapes_session)  # set a rectangle in image buffer
+    draw_frectangle(dataset, args.frect, shapes_session)  # set a filled rectangle in image buffer
+    draw_crosshair(dataset, args.crosshair, shapes_session)  # set a crosshair in image buffer
+    draw_rois_3d(dataset, args.roi3d, shapes_session)  # sections of the patient space ROIs
+    if shapes_session is not pixel_session:
+        shapes_session.commit()
+    pixel_stats = commit_pixels(dataset, args, pixel_session) if own_session else None
+
+    if args.sn > 0:
+        dataset.SeriesNumber = args.sn
+
+    # Shift all dates and times by the patient offset, before the anonymization replaces its id
+    date_shifter = get_date_shifter(args)
+    if date_shifter is not None:
+        date_shifter.apply(dataset)
+
+    # Anonymize dataset tags
+    check_if_anonymize_or_cleanup_needed(dataset, args, False, args.delete_private_tags)
+
+    # Deal with all sorts of dates and time if user asks for it:
+    transform_dates(file_count, dataset, args)
+
+    # optional changes of useful tags if they have a non default / set value:
+    change_tag_if_arg(dataset, "StudyDescription", args.sdesc)
+    change_tag_if_arg(dataset, "InstitutionName", args.iname)
+    change_tag_if_arg(dataset, "InstitutionAddress", args.iaddr)
+    change_tag_if_arg(dataset, "ProtocolName", args.proto)
+    change_tag_if_arg(dataset, "Manufacturer", args.mname)
+    change_tag_if_arg(dataset, "ManufacturerModelName", args.mmname)
+    change_tag_if_arg(dataset, "PatientID", args.pid)
+    change_tag_if_arg(dataset, "PatientName", args.pname)
+    change_tag_if_arg(dataset, "PatientBirthDate", args.dob)
+
+    # custom DICOM tags settings alternative
+    assign_custom_tags(dataset, get_tag_edits(args))
+
+    # do useful things with the series description
+    if args.desc != '':
+        change_tag_if_arg(dataset, "SeriesDescription", args.desc)  # optionally change study desc
+    else:  # automatic tracking of transformations
+        sdesc = dataset.dir("SeriesDescription")
+
+        try:
+            if desc_prefix != '':
+                if len(sdesc) != 0:
+                    desc = ' ' + dataset.SeriesDescription
+                else:
+                    desc = ''
+                dataset.SeriesDescription = desc_prefix + desc
+                sdesc = dataset.dir("SeriesDescription")  # refresh in case we just created it
+        except Exception as exc:
+            print(exc)
+        if len(sdesc) != 0:
+            dataset.SeriesDescription = truncate_str(dataset.SeriesDescription, 63)
+
+    if pixel_stats is not None:
+        get_statistics_report(args).add(dataset, pixel_stats)
+    return dataset
+
+
 # ------------------------------------------------------------------------------
 def transform(file_count, args, desc_prefix, input_filename, output_filename):
     """Replace data element values to partly transform a DICOM file.
@@ -797,60 +3869,12 @@ def transform(file_count, args, desc_prefix, input_filename, output_filename):
         # Load the current dicom file to 'transform'
         dataset = dicom.read_file(input_filename)
 
-        # 3d xforms user cmd options
-        compute_3d_transforms(dataset, args)
-
-        set_image_pixels(dataset, args.pixel)  # set pixels in image buffer
-        draw_roi(dataset, args.roi)  # set a ROI square in image buffer
-        draw_ellipse(dataset, args.elp)  # set an ellipse
-        draw_rectangle(dataset, args.rect)  # set a rectangle in image buffer
-        draw_frectangle(dataset, args.frect)  # set a filled rectangle in image buffer
-        draw_crosshair(dataset, args.crosshair)  # set a crosshair in image buffer
-
-        if args.sn > 0:
-            dataset.SeriesNumber = args.sn
-
-        # Anonymize dataset tags
-        check_if_anonymize_or_cleanup_needed(dataset, args, False, args.delete_private_tags)
-
-        # Deal with all sorts of dates and time if user asks for it:
-        transform_dates(file_count, dataset, args)
-
-        # optional changes of useful tags if they have a non default / set value:
-        change_tag_if_arg(dataset, "StudyDescription", args.sdesc)
-        change_tag_if_arg(dataset, "InstitutionName", args.iname)
-        change_tag_if_arg(dataset, "InstitutionAddress", args.iaddr)
-        change_tag_if_arg(dataset, "ProtocolName", args.proto)
-        change_tag_if_arg(dataset, "Manufacturer", args.mname)
-        change_tag_if_arg(dataset, "ManufacturerModelName", args.mmname)
-        change_tag_if_arg(dataset, "PatientID", args.pid)
-        change_tag_if_arg(dataset, "PatientName", args.pname)
-        change_tag_if_arg(dataset, "PatientBirthDate", args.dob)
-
-        # custom DICOM tags settings alternative
-        assign_custom_tags(dataset, args.tags)
-
-        # do useful things with the series description
-        if args.desc != '':
-            change_tag_if_arg(dataset, "SeriesDescription", args.desc)  # optionally change study desc
-        else:  # automatic tracking of transformations
-            sdesc = dataset.dir("SeriesDescription")
-
-            try:
-                if desc_prefix != '':
-                    if len(sdesc) != 0:
-                        desc = ' ' + dataset.SeriesDescription
-                    else:
-                        desc = ''
-                    dataset.SeriesDescription = desc_prefix + desc
-                    sdesc = dataset.dir("SeriesDescription")  # refresh in case we just created it
-            except Exception as exc:
-                print(exc)
-            if len(sdesc) != 0:
-                dataset.SeriesDescription = truncate_str(dataset.SeriesDescription, 63)
+        transform_dataset(file_count, dataset, args, desc_prefix)
 
         # write the 'transformed' DICOM out under the new filename
-        dataset.save_as(output_filename)
+        get_output_writer(args).write(dataset, output_filename)
+        write_presentation_state(get_output_writer(args), dataset, output_filename)
+        audit_changes(dataset, output_filename)
 
     except Exception as exc:
         print(exc)
@@ -870,43 +3894,455 @@ def is_3d_tranformation(in_args):
 
 
 # ------------------------------------------------------------------------------
-def iterate_once(in_args, input_dir, output_dir):
-    """Execute the full script except the recursive option"""
+def series_description_prefix(in_args):
+    """Build the series description prefix tracking the 3d transforms"""
+    if is_3d_tranformation(in_args):
+        return 'T[' + fmt_float3d('', in_args.x, in_args.y, in_args.z, ' ') \
+               + fmt_float3d('A', in_args.ax, in_args.ay, in_args.az, ' ') + ']'
+    return ''
+
+
+# ------------------------------------------------------------------------------
+def iterate_once(in_args, input_dir, output_dir, filenames=None):
+    """Execute the full script except the recursive option, return the files counts.
+       filenames are the input_dir files given by the tree scan, listed here if None"""
     series_file_count = 0
+    counts = {'files': 0, 'transformed': 0, 'copied': 0, 'failed': 0}
 
     try:
-        if is_3d_tranformation(in_args):
-            series_desc_prefix = 'T[' + fmt_float3d('', in_args.x, in_args.y, in_args.z, ' ') \
-                                 + fmt_float3d('A', in_args.ax, in_args.ay, in_args.az, ' ') + ']'
-        else:
-            series_desc_prefix = ''
+        series_desc_prefix = series_description_prefix(in_args)
 
     except Exception:
         print("Could not convert the x, y, z offsets")
         sys.exit()
 
+    output_writer = get_output_writer(in_args)
     if os.path.isdir(input_dir):
-        if os.path.exists(output_dir):
-            if not os.path.isdir(output_dir):
-                raise IOError("Input is directory; output name exists but is not a directory")
-        else:  # out_dir does not exist; create it.
-            os.makedirs(output_dir)
-
-        fnames = os.listdir(input_dir)
-        for filename in fnames:
-            if not os.path.isdir(os.path.join(input_dir, filename)):
+        if os.path.exists(output_dir) and not os.path.isdir(output_dir):
+            raise IOError("Input is directory; output name exists but is not a directory")
+        output_writer.make_dirs([output_dir])
+        if filenames is None:
+            filenames = scan_files(input_dir, in_args)
+
+        if in_args.resample and is_3d_tranformation(in_args):
+            print('Resampling ' + series_desc_prefix + input_dir + " ...")
+            resample_series(in_args, input_dir, output_dir, series_desc_prefix, filenames)
+            output_writer.flush_directory(output_dir)
+            counts['files'] = len(filenames)
+            counts['transformed'] = counts['files']
+            print()
+            return counts
+
+        transforming = needs_transform(in_args)
+        selectors = file_selectors(in_args) if transforming else None
+        job_rules = get_job_rules(in_args)
+        job_file_counts = [0] * len(job_rules or [])
+        for filename in filenames:
+            counts['files'] += 1
+            if not transforming or not is_dicom_file(os.path.join(input_dir, filename)) or \
+                    (selectors is not None and not file_needs_transform(os.path.join(input_dir, filename),
+                                                                         selectors)):
+                print('Copying ' + filename + " ...", end='')
+                try:
+                    output_writer.copy(os.path.join(input_dir, filename),
+                                       os.path.join(output_dir, filename), in_args.link)
+                    counts['copied'] += 1
+                except Exception as exc:
+                    print(exc)
+                    counts['failed'] += 1
+                print(" done\r")
+            else:
                 print('Transforming ' + series_desc_prefix + filename + " ...", end='')
-                series_file_count, dataset = transform(series_file_count, ARGS, series_desc_prefix,
-                                                       os.path.join(input_dir, filename),
-                                                       os.path.join(output_dir, filename))
+                if job_rules is not None:
+                    dataset = transform_jobs(job_file_counts, job_rules, output_writer,
+                                             os.path.join(input_dir, filename), os.path.join(output_dir, filename))
+                else:
+                    series_file_count, dataset = transform(series_file_count, in_args, series_desc_prefix,
+                                                           os.path.join(input_dir, filename),
+                                                           os.path.join(output_dir, filename))
                 if dataset is None:
                     print("Null dataset was return after transformation !")
+                    counts['failed'] += 1
+                else:
+                    counts['transformed'] += 1
                 print(" done\r")
+        output_writer.flush_directory(output_dir)
     else:  # first arg not a directory, assume two files given
         in_filename = in_args.input_series
         out_filename = in_args.output_series
-        transform(series_file_count, ARGS, series_desc_prefix, in_filename, out_filename)
+        counts['files'] = 1
+        if get_job_rules(in_args) is not None:
+            dataset = transform_jobs([0] * len(get_job_rules(in_args)), get_job_rules(in_args), output_writer,
+                                     in_filename, out_filename)
+        else:
+            series_file_count, dataset = transform(series_file_count, in_args, series_desc_prefix,
+                                                   in_filename, out_filename)
+        counts['transformed' if dataset is not None else 'failed'] = 1
     print()
+    return counts
+
+
+# ------------------------------------------------------------------------------
+def parse_shard(shard):
+    """Parse a i/N shard specification, return the (index, count) tuple"""
+    try:
+        index, count = [int(value) for value in shard.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard ' + shard + ', expected i/N')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Invalid shard ' + shard + ', expected 0 <= i < N')
+    return index, count
+
+
+# ------------------------------------------------------------------------------
+def series_key(dirpath, root):
+    """Stable, platform independent key of a series directory relative to the tree root"""
+    return os.path.relpath(dirpath, root).replace(os.sep, '/')
+
+
+# ------------------------------------------------------------------------------
+def shard_of(key, count):
+    """Shard owning a series, from a stable hash of its key (the same on every node and run)"""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:15], 16) % count
+
+
+# ------------------------------------------------------------------------------
+def shard_manifest_filename(output_dir, index, count):
+    """Per shard manifest file, written in the output tree root"""
+    return os.path.join(output_dir, '.dcm_transform.shard-' + str(index) + '-of-' + str(count) + '.json')
+
+
+# the tree scan options of a sharded run, replayed by -merge_shards to check the coverage
+SCAN_OPTIONS = ['recurse', 'max_depth', 'include', 'exclude']
+
+
+# ------------------------------------------------------------------------------
+def write_shard_manifest(in_args, index, count, series):
+    """Record the series processed by a shard, with their files counts"""
+    manifest = OrderedDict([('shard', index), ('count', count),
+                            ('input', os.path.abspath(in_args.input_series)),
+                            ('arguments', sys.argv[1:]),
+                            ('scan', OrderedDict((name, getattr(in_args, name)) for name in SCAN_OPTIONS)),
+                            ('series', series)])
+    output_dir = in_args.output_series
+    get_output_writer(in_args).make_dirs([output_dir])
+    manifest_filename = shard_manifest_filename(output_dir, index, count)
+    with open(manifest_filename + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    if hasattr(os, 'replace'):
+        os.replace(manifest_filename + '.tmp', manifest_filename)
+    else:
+        os.rename(manifest_filename + '.tmp', manifest_filename)
+
+
+# ------------------------------------------------------------------------------
+def merge_shards(in_args):
+    """Merge the shard manifests of the output tree, check the shards cover every input series
+       exactly once, write the merged manifest (and audit log, statistics report, date shift map) and
+       return the list of problems found"""
+    input_dir = in_args.input_series
+    output_dir = in_args.output_series
+    problems = []
+    manifests = []
+    for manifest_filename in sorted(glob.glob(os.path.join(output_dir, '.dcm_transform.shard-*-of-*.json'))):
+        with open(manifest_filename) as manifest_file:
+            manifests.append(json.load(manifest_file, object_pairs_hook=OrderedDict))
+    if not manifests:
+        return ['No shard manifest found in ' + output_dir]
+
+    count = manifests[0]['count']
+    indices = set()
+    series = OrderedDict()
+    for manifest in manifests:
+        if manifest['count'] != count:
+            problems.append('Shard ' + str(manifest['shard']) + ' was run with ' + str(manifest['count']) +
+                            ' shards instead of ' + str(count))
+            continue
+        indices.add(manifest['shard'])
+        for key, counts in manifest['series'].items():
+            if key in series:
+                problems.append('Series ' + key + ' processed by several shards')
+            series[key] = counts
+            if counts['failed']:
+                problems.append('Series ' + key + ': ' + str(counts['failed']) + ' file(s) failed')
+    for index in range(count):
+        if index not in indices:
+            problems.append('Shard ' + str(index) + '/' + str(count) + ' manifest missing')
+
+    # scan the tree as the shards did, whatever the options of the merge command
+    scan_args = copy.copy(in_args)
+    scan_args.recurse = True
+    for name, value in manifests[0].get('scan', {}).items():
+        setattr(scan_args, name, value)
+    if any(manifest.get('scan') != manifests[0].get('scan') for manifest in manifests):
+        problems.append('The shards were run with different -r, -max_depth, -include or -exclude options')
+    if os.path.isdir(input_dir):
+        for dirpath, rel_dir, filenames in scan_tree(input_dir, scan_args):
+            key = series_key(dirpath, input_dir)
+            if key not in series and shard_of(key, count) in indices:
+                problems.append('Series ' + key + ' not processed by its shard ' + str(shard_of(key, count)))
+
+    if in_args.audit != '':
+        problems.extend(merge_audit_parts(in_args.audit, count, in_args.audit_batch))
+    if in_args.stats != '':
+        problems.extend(merge_statistics_parts(in_args.stats, count, in_args.stats_bins))
+    if in_args.dshift_map != '':
+        problems.extend(merge_date_shift_maps(in_args.dshift_map, count))
+
+    merged = OrderedDict([('count', count), ('shards', sorted(indices)), ('series', series),
+                          ('totals', OrderedDict((name, sum(counts[name] for counts in series.values()))
+                                                 for name in ['files', 'transformed', 'copied', 'failed'])),
+                          ('problems', problems)])
+    with open(os.path.join(output_dir, '.dcm_transform.shards.json'), 'w') as merged_file:
+        json.dump(merged, merged_file, indent=1)
+    return problems
+
+
+# ------------------------------------------------------------------------------
+def copy_dataset(dataset):
+    """Cheap copy of a dataset for fan-out variants: each data element is deep copied, so that the
+       variants never share their multiple values or sequences, but the immutable values (i.e. the
+       PixelData bytes) stay shared until the variant replaces them"""
+    def copy_elements(source, target):
+        """Copy all the data elements of source into target"""
+        for data_element in source:
+            target.add(copy.deepcopy(data_element))
+        return target
+
+    file_meta = copy_elements(dataset.file_meta, dicom.dataset.FileMetaDataset()
+                              if hasattr(dicom.dataset, 'FileMetaDataset') else dicom.dataset.Dataset())
+    clone = dicom.dataset.FileDataset(dataset.filename, {}, file_meta=file_meta,
+                                      preamble=dataset.preamble,
+                                      is_implicit_VR=dataset.is_implicit_VR,
+                                      is_little_endian=dataset.is_little_endian)
+    return copy_elements(dataset, clone)
+
+
+# ------------------------------------------------------------------------------
+class Variant:
+    """ One fan-out variant: a name, an output root and its own parsed option set"""
+    name = ''
+    output = ''
+    args = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, name, output, args):
+        """Constructor from the variant name, output root and parsed arguments"""
+        self.name = name
+        self.output = output
+        self.args = args
+
+
+# ------------------------------------------------------------------------------
+def load_variants(spec_filename, argv):
+    """Load a fan-out variant spec (json) and parse the option set of each variant on top of argv.
+       The spec may hold a "variants" list of {"name", "args", "output"} entries and/or a "grid"
+       of {option: [values]} expanded as all the combinations, "output" being the output root
+       template ({output_series}/{name} by default) and "first_sn" the series number
+       assigned sequentially to the variants which don't set -sn"""
+    with open(spec_filename) as spec_file:
+        spec = json.load(spec_file, object_pairs_hook=OrderedDict)
+
+    # remove the fan-out option itself from the base command line
+    base_argv = list(argv)
+    if '-variants' in base_argv:
+        i = base_argv.index('-variants')
+        del base_argv[i:i + 2]
+    base_args = parse_arguments(base_argv)
+
+    entries = [(entry.get('name', 'v' + str(i + 1)), [str(arg) for arg in entry.get('args', [])],
+                entry.get('output')) for i, entry in enumerate(spec.get('variants', []))]
+    grid = spec.get('grid', {})
+    for values in itertools.product(*grid.values()):
+        variant_argv = []
+        names = []
+        for option, value in zip(grid.keys(), values):
+            value = [str(val) for val in value] if isinstance(value, list) else [str(value)]
+            variant_argv += [option] + value
+            names.append(option.lstrip('-') + '_'.join(value))
+        entries.append(('_'.join(names).replace(os.sep, '_'), variant_argv, None))
+
+    timestamp = str(int(time.time()))
+    variants = []
+    for i, (name, variant_argv, output) in enumerate(entries):
+        args = parse_arguments(base_argv + variant_argv)
+        # each variant is a new series with its own uids and series number
+        if '-suid' not in base_argv + variant_argv:
+            args.suid = '1.2.3.4.' + timestamp + '.' + str(i + 1) + '.0.0'
+        if '-foruid' not in base_argv + variant_argv:
+            args.foruid = '2.3.4.0.' + timestamp + '.' + str(i + 1) + '.0.0'
+        if '-sn' not in base_argv + variant_argv and 'first_sn' in spec:
+            args.sn = int(spec['first_sn']) + i
+        if output is None:
+            output = spec.get('output', os.path.join('{output_series}', '{name}'))
+        output = output.format(output_series=base_args.output_series, name=name, index=i + 1)
+        variants.append(Variant(name, output, args))
+    return variants
+
+
+# ------------------------------------------------------------------------------
+def fan_out_file(file_counts, variants, input_filename, output_filenames):
+    """Read and parse an input file once, then transform and write a cheap copy for each variant"""
+    if not is_dicom_file(input_filename):
+        for i, variant in enumerate(variants):
+            get_output_writer(variant.args).copy(input_filename, output_filenames[i], variant.args.link)
+        return
+    dataset = dicom.read_file(input_filename)
+    for i, variant in enumerate(variants):
+        try:
+            variant_dataset = copy_dataset(dataset)
+            file_counts[i] += 1
+            transform_dataset(file_counts[i], variant_dataset, variant.args,
+                              series_description_prefix(variant.args))
+
+            foruid = variant.args.foruid if is_3d_tranformation(variant.args) \
+                else variant_dataset.get('FrameOfReferenceUID', variant.args.foruid)
+            generate_new_uids(variant_dataset, variant.args.suid, foruid,
+                              generate_soiud_from_seriesuid(variant.args.suid,
+                                                            variant_dataset.InstanceNumber))
+            get_output_writer(variant.args).write(variant_dataset, output_filenames[i])
+            write_presentation_state(get_output_writer(variant.args), variant_dataset, output_filenames[i])
+            audit_changes(variant_dataset, output_filenames[i])
+        except Exception as exc:
+            print(exc)
+
+
+# ------------------------------------------------------------------------------
+def fan_out(in_args, variants):
+    """Generate all the variants of the input file, directory or tree (-r) in a single read pass"""
+    input_series = in_args.input_series
+    if not os.path.isdir(input_series):
+        fan_out_file([0] * len(variants), variants, input_series,
+                     [variant.output for variant in variants])
+        return
+
+    for dirpath, rel_dir, filenames in scan_tree(input_series, in_args):
+        output_dirs = [os.path.normpath(os.path.join(variant.output, rel_dir)) for variant in variants]
+        for i, output_dir in enumerate(output_dirs):
+            get_output_writer(variants[i].args).make_dirs([output_dir])
+
+        print('Fanning out ' + dirpath + ' to ' + str(len(variants)) + ' variants ...', end='')
+        file_counts = [0] * len(variants)  # per series counts, as in iterate_once
+        for filename in filenames:
+            fan_out_file(file_counts, variants, os.path.join(dirpath, filename),
+                         [os.path.join(output_dir, filename) for output_dir in output_dirs])
+        for i, output_dir in enumerate(output_dirs):
+            get_output_writer(variants[i].args).flush_directory(output_dir)
+        print(' done')
+
+
+# ------------------------------------------------------------------------------
+class JobRule:
+    """ One rule of a job file: a predicate on header fields and the option set applied to the
+        files it matches. The predicate maps tags (keywords or (gggg,eeee)) to fnmatch patterns
+        for strings (i.e. a UID prefix 1.2.840.*) or numbers, a list meaning any of them"""
+    name = ''
+    match = None
+    args = None
+
+    # ------------------------------------------------------------------------------
+    def __init__(self, name, match, args):
+        """Constructor from the rule name, {tag: pattern(s)} predicate and parsed arguments"""
+        self.name = name
+        self.match = [(parse_tag_path(key)[0][0], patterns if isinstance(patterns, list) else [patterns])
+                      for key, patterns in match.items()]
+        self.args = args
+
+    # ------------------------------------------------------------------------------
+    def matches(self, dataset):
+        """Tell if a dataset header matches all the predicate fields"""
+        for tag, patterns in self.match:
+            if tag not in dataset:
+                return False
+            value = dataset[tag].value
+            text = '\\'.join(str(val) for val in value) if hasattr(value, 'append') else str(value)
+            for pattern in patterns:
+                if isinstance(pattern, (int, float)) and not isinstance(pattern, bool):
+                    try:
+                        if float(text) == pattern:
+                            break
+                    except ValueError:
+                        pass
+                elif fnmatch.fnmatchcase(text, str(pattern)):
+                    break
+            else:
+                return False
+        return True
+
+
+# ------------------------------------------------------------------------------
+def load_jobs(jobs_filename, in_args):
+    """Load a job file (json) of {"name", "match", "args"} "rules", each option set being parsed
+       once with the input and output of in_args. The other options of in_args (but -jobs) make a
+       first rule matching all the files, the -suid and -foruid of in_args apply to all the rules,
+       as do its run wide -audit and -shard"""
+    with open(jobs_filename) as jobs_file:
+        spec = json.load(jobs_file, object_pairs_hook=OrderedDict)
+
+    base_args = copy.copy(in_args)
+    base_args.jobs = ''
+    rules = []
+    if needs_transform(base_args):
+        rules.append(JobRule('command line', {}, base_args))
+    for i, rule in enumerate(spec.get('rules', [])):
+        rule_argv = [str(arg) for arg in rule.get('args', [])]
+        args = parse_arguments([in_args.input_series, in_args.output_series] + rule_argv)
+        for name in ['suid', 'foruid']:
+            if '-' + name not in rule_argv:
+                setattr(args, name, getattr(in_args, name))
+        for name in ['audit', 'audit_batch', 'shard', 'stats', 'stats_bins']:
+            setattr(args, name, getattr(in_args, name))
+        rules.append(JobRule(rule.get('name', 'rule' + str(i + 1)), rule.get('match', {}), args))
+    return rules
+
+
+# cache of the compiled job rules for the whole run
+JOB_RULES = {}
+
+
+# ------------------------------------------------------------------------------
+def jobs_apply(header, args):
+    """Tell if any job rule matches a file header, the others being copied through"""
+    return any(rule.matches(header) for rule in get_job_rules(args))
+
+
+# ------------------------------------------------------------------------------
+def get_job_rules(args):
+    """Get the job rules of the -jobs file, compiled once per run, None if not requested"""
+    if args.jobs == '':
+        return None
+    if args.jobs not in JOB_RULES:
+        JOB_RULES[args.jobs] = load_jobs(args.jobs, args)
+    return JOB_RULES[args.jobs]
+
+
+# ------------------------------------------------------------------------------
+def transform_jobs(file_counts, rules, output_writer, input_filename, output_filename):
+    """Read a file once, apply in order the rules matching its original header, sharing one pixel
+       session (a single decode and encode), and write it once, file_counts holding the per series
+       count of the files each rule transformed"""
+    try:
+        dataset = dicom.read_file(input_filename)
+        matching = [i for i, rule in enumerate(rules) if rule.matches(dataset)]
+        stats_args = ([rules[i].args for i in matching if rules[i].args.stats != ''] + [None])[0]
+        pixel_session = PixelSession(dataset, keep_original=stats_args is not None)
+        for i in matching:
+            file_counts[i] += 1
+            transform_dataset(file_counts[i], dataset, rules[i].args, series_description_prefix(rules[i].args),
+                              pixel_session)
+        if stats_args is not None:
+            pixel_stats = commit_pixels(dataset, stats_args, pixel_session)  # once per file, whatever the rules
+            if pixel_stats is not None:
+                get_statistics_report(stats_args).add(dataset, pixel_stats)
+        else:
+            pixel_session.commit()
+        output_writer.write(dataset, output_filename)
+        write_presentation_state(output_writer, dataset, output_filename)
+        audit_changes(dataset, output_filename)
+    except Exception as exc:
+        print(exc)
+        dataset = None
+    return dataset
 
 
 # ------------------------------------------------------------------------------
@@ -916,12 +4352,40 @@ if __name__ == "__main__":
     ARGS = parse_arguments()
 
     # for timestamped offset computing
-    if not ARGS.recurse:
+    if ARGS.merge_shards:
+        PROBLEMS = merge_shards(ARGS)
+        for problem in PROBLEMS:
+            print('  Warning: ' + problem)
+        print('Shards merged, ' + ('coverage complete' if not PROBLEMS else str(len(PROBLEMS)) + ' problem(s)'))
+        sys.exit(1 if PROBLEMS else 0)
+    elif ARGS.variants != '':
+        fan_out(ARGS, load_variants(ARGS.variants, sys.argv[1:]))
+    elif not ARGS.recurse and not ARGS.shard:
         iterate_once(ARGS, ARGS.input_series, ARGS.output_series)
     else:
         IN_DIR = ARGS.input_series
         OUT_DIR = ARGS.output_series
-        for dirpath, dirnames, filenames in os.walk(IN_DIR):
-            cur_dir = os.path.join(OUT_DIR, dirpath[1 + len(IN_DIR):])
+        if ARGS.shard:
+            SHARD_INDEX, SHARD_COUNT = parse_shard(ARGS.shard)
+            if is_3d_tranformation(ARGS) and ('-suid' not in sys.argv or '-foruid' not in sys.argv):
+                print('  Warning: give -suid and -foruid explicitly for the shards to assign the same UIDs')
+            if ARGS.dshift == 'random':
+                print('  Warning: the shards draw the date shifts from their common arguments, ' +
+                      'give -dshift a SEED to keep the offsets secret')
+            get_audit_log(ARGS)  # an empty part still tells the shard ran
+            get_statistics_report(ARGS)
+        # stream the scan, each output directory being created once (parents first) as the scan yields it
+        SERIES = OrderedDict()
+        for dirpath, rel_dir, filenames in scan_tree(IN_DIR, ARGS):
+            if ARGS.shard and shard_of(series_key(dirpath, IN_DIR), SHARD_COUNT) != SHARD_INDEX:
+                continue
+            cur_dir = os.path.normpath(os.path.join(OUT_DIR, rel_dir))
+            get_output_writer(ARGS).make_dirs([cur_dir])
             print('Traversing: ', dirpath)
-            iterate_once(ARGS, dirpath, cur_dir)
+            SERIES[series_key(dirpath, IN_DIR)] = iterate_once(ARGS, dirpath, cur_dir, filenames)
+        if ARGS.shard:
+            write_shard_manifest(ARGS, SHARD_INDEX, SHARD_COUNT, SERIES)
+    close_output_writers()
+    close_date_shifters()
+    close_statistics_reports()
+    close_audit_logs()
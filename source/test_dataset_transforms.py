@@ -8,7 +8,9 @@
 import unittest
 import dcm_transform
 
-import os, os.path, time
+import os, os.path, sys, time, json, shutil, tempfile, subprocess, csv, sqlite3, struct
+import numpy as np
+from datetime import datetime, timedelta
 
 try:
     import dicom
@@ -122,6 +124,1106 @@ class DcmTestPixelEditor(DcmTestCase):
         self.assertIsNotNone(dataset.pixel_array)
 
 
+class DcmTestPixelSession(DcmTestCase):
+    """Test the decode-once pixel session on encapsulated pixel data"""
+
+    def rle_multiframe_dataset(self):
+        """Build a 3 frames RLE Lossless dataset from the native test image"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        frame = dataset.pixel_array
+        frames = [frame, frame[::-1].copy(), frame.T.copy()]
+        dataset.NumberOfFrames = 3
+        dataset.PixelData = dicom.encaps.encapsulate(
+            [dcm_transform.rle_encode_frame(arr[:, :, None], 16) for arr in frames])
+        dataset['PixelData'].is_undefined_length = True
+        dataset.file_meta.TransferSyntaxUID = dicom.uid.RLELossless
+        return dataset, frames
+
+    def test_rle_encode_round_trip(self):
+        """Test the native RLE encoder against the pydicom RLE decoder"""
+        dataset, frames = self.rle_multiframe_dataset()
+        for i, arr in enumerate(dataset.pixel_array):
+            self.assertTrue((arr == frames[i]).all())
+
+    def test_rle_edit_one_frame(self):
+        """Test that only the edited frame is decoded and re-encoded"""
+        dataset, frames = self.rle_multiframe_dataset()
+        before = list(dicom.encaps.generate_pixel_data(dataset.PixelData, 3))
+
+        pixel_session = dcm_transform.PixelSession(dataset)
+        pixel_session.editor([1]).draw_frect(0, 0, 5, 5, 999)
+        pixel_session.commit()
+
+        after = list(dicom.encaps.generate_pixel_data(dataset.PixelData, 3))
+        self.assertEqual(dataset.file_meta.TransferSyntaxUID, dicom.uid.RLELossless)
+        self.assertEqual(before[0], after[0])
+        self.assertEqual(before[2], after[2])
+        arr = dataset.pixel_array
+        self.assertTrue((arr[1, :5, :5] == 999).all())
+        self.assertTrue((arr[1, 5:] == frames[1][5:]).all())
+
+    def test_fallback_to_explicit_little_endian(self):
+        """Test the switch to native Explicit VR Little Endian when the transfer syntax has no encoder"""
+        dataset, frames = self.rle_multiframe_dataset()
+        pixel_session = dcm_transform.PixelSession(dataset)
+        pixel_session.editor([0, 1, 2]).draw_frect(0, 0, 5, 5, 999)
+        pixel_session.transfer_syntax = dicom.uid.JPEGLSLossless  # frames decoded, no encoder for it
+        pixel_session.commit()
+
+        self.assertEqual(dataset.file_meta.TransferSyntaxUID, dicom.uid.ExplicitVRLittleEndian)
+        self.assertFalse(dataset['PixelData'].is_undefined_length)
+        self.assertEqual(dataset['PixelData'].VR, 'OW')
+        self.assertEqual(dataset.PhotometricInterpretation, 'MONOCHROME2')
+        self.set_sample_images_io(self.image2, 'result_native.dcm')
+        dataset.save_as(self.output_ds_path)
+        arr = dicom.read_file(self.output_ds_path).pixel_array
+        self.assertTrue((arr[:, :5, :5] == 999).all())
+        for i in range(3):
+            self.assertTrue((arr[i, 5:] == frames[i][5:]).all())
+
+    def test_encoder_error_fallback(self):
+        """Test the switch to Explicit VR Little Endian when an available encoder fails, the extended
+           offset table being dropped with the encapsulated fragments"""
+        class FailingEncoder(object):
+            """Encoder of plugins failing on the frame"""
+            is_available = True
+
+            def encode(self, frame, **kwargs):
+                raise RuntimeError('unsupported frame')
+
+        import pydicom.encoders
+        get_encoder = pydicom.encoders.get_encoder
+        pydicom.encoders.get_encoder = lambda uid: FailingEncoder()
+        try:
+            dataset, frames = self.rle_multiframe_dataset()
+            dcm_transform.set_extended_offset_table(dataset, [(b'',)] * 3)
+            pixel_session = dcm_transform.PixelSession(dataset)
+            pixel_session.editor([0, 1, 2]).draw_frect(0, 0, 5, 5, 999)
+            pixel_session.transfer_syntax = dicom.uid.JPEGLSLossless  # frames decoded, failing encoder
+            pixel_session.commit()
+        finally:
+            pydicom.encoders.get_encoder = get_encoder
+        self.assertEqual(dataset.file_meta.TransferSyntaxUID, dicom.uid.ExplicitVRLittleEndian)
+        self.assertNotIn(0x7FE00001, dataset)
+        self.assertNotIn(0x7FE00002, dataset)
+        self.assertTrue((dataset.pixel_array[1, :5, :5] == 999).all())
+
+    def test_rle_extended_offset_table(self):
+        """Test that the extended offset table is rebuilt with the re-encoded fragments"""
+        dataset, frames = self.rle_multiframe_dataset()
+        fragments = [(fragment,) for fragment in dicom.encaps.generate_pixel_data_frame(dataset.PixelData, 3)]
+        dataset.PixelData = dcm_transform.encapsulate_fragments(fragments, False)
+        dcm_transform.set_extended_offset_table(dataset, fragments)
+
+        pixel_session = dcm_transform.PixelSession(dataset)
+        pixel_session.editor([0]).draw_frect(0, 0, 64, 64, 999)
+        pixel_session.commit()
+
+        after = list(dicom.encaps.generate_pixel_data_frame(dataset.PixelData, 3))
+        offsets = struct.unpack('<3Q', dataset[0x7FE00001].value)
+        lengths = struct.unpack('<3Q', dataset[0x7FE00002].value)
+        self.assertEqual(list(lengths), [len(frame) for frame in after])
+        self.assertEqual(list(offsets), [0, 8 + len(after[0]), 16 + len(after[0]) + len(after[1])])
+        self.assertEqual(struct.unpack('<L', dataset.PixelData[4:8])[0], 0)  # empty basic offset table
+        self.assertTrue((dataset.pixel_array[0, :64, :64] == 999).all())
+        self.assertTrue((dataset.pixel_array[2] == frames[2]).all())
+
+    def test_ybr_jpeg_fallback_to_rgb(self):
+        """Test that the YBR data decoded to RGB by the JPEG decoders is written back as RGB"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        gray = (dataset.pixel_array >> 4).astype('uint8')
+        rgb = np.stack([gray, gray // 2, 255 - gray], axis=-1)
+        dataset.SamplesPerPixel = 3
+        dataset.PlanarConfiguration = 0
+        dataset.PhotometricInterpretation = 'YBR_FULL_422'
+        dataset.BitsAllocated = dataset.BitsStored = 8
+        dataset.HighBit = 7
+        dataset.PixelData = dicom.encaps.encapsulate([dcm_transform.rle_encode_frame(rgb, 8)])
+        dataset['PixelData'].is_undefined_length = True
+        dataset.file_meta.TransferSyntaxUID = dicom.uid.RLELossless
+
+        pixel_session = dcm_transform.PixelSession(dataset)
+        pixel_session.editor().draw_frect(0, 0, 5, 5, [255, 0, 0])
+        pixel_session.transfer_syntax = dicom.uid.JPEGBaseline8Bit  # decoded as RGB, no encoder for it
+        pixel_session.commit()
+
+        self.assertEqual(dataset.file_meta.TransferSyntaxUID, dicom.uid.ExplicitVRLittleEndian)
+        self.assertEqual(dataset.PhotometricInterpretation, 'RGB')
+        self.assertEqual(dataset.PlanarConfiguration, 0)
+        self.assertEqual(dataset['PixelData'].VR, 'OB')
+        self.set_sample_images_io(self.image2, 'result_rgb.dcm')
+        dataset.save_as(self.output_ds_path)
+        arr = dicom.read_file(self.output_ds_path).pixel_array
+        self.assertTrue((arr[:5, :5] == [255, 0, 0]).all())
+        self.assertTrue((arr[5:] == rgb[5:]).all())
+
+
+class DcmTestMultiFrame(DcmTestCase):
+    """Test frame selection and per sample values of the pixel options"""
+
+    def test_rgb_frame_selection(self):
+        """Test a per sample filled rectangle on a subset of frames of an RGB cine"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        gray = (dataset.pixel_array >> 4).astype('uint8')
+        frames = [gray + i for i in range(4)]
+        rgb = np.stack([np.stack([frame] * 3, axis=-1) for frame in frames])
+        dataset.NumberOfFrames = 4
+        dataset.SamplesPerPixel = 3
+        dataset.PlanarConfiguration = 0
+        dataset.PhotometricInterpretation = 'RGB'
+        dataset.BitsAllocated = dataset.BitsStored = 8
+        dataset.HighBit = 7
+        dataset.PixelData = rgb.tobytes()
+        dataset['PixelData'].VR = 'OB'
+        self.set_sample_images_io('result_cine_in.dcm', 'result_cine.dcm')
+        dataset.save_as(self.input_ds_path)
+
+        self.in_args.extend(['-frames', '2-3', '-frect', '10', '10', '5', '5', '255,0,0', '1.0'])
+        self.test_args = dcm_transform.parse_arguments(self.in_args)
+        file_count, dataset = self.instanciate_sut_transform(self.test_args)
+
+        self.assertEqual(file_count, 1)
+        arr = dicom.read_file(self.output_ds_path).pixel_array
+        self.assertTrue((arr[[0, 3]] == rgb[[0, 3]]).all())
+        self.assertTrue((arr[1:3, 10:15, 10:15] == [255, 0, 0]).all())
+        self.assertTrue((arr[1:3, 15:] == rgb[1:3, 15:]).all())
+
+    def test_parse_frame_selection(self):
+        """Test the frames selector parsing"""
+        self.assertIsNone(dcm_transform.parse_frame_selection(['all']))
+        self.assertEqual(dcm_transform.parse_frame_selection(['1', '4-5,7']), [0, 3, 4, 6])
+
+
+class DcmTestOverlay(DcmTestCase):
+    """Test the non destructive overlay outputs of the shapes"""
+
+    def test_overlay_plane(self):
+        """Test shapes written in an overlay plane at the pixels the burn mode would change"""
+        self.set_sample_images_io(self.image2, 'result.dcm')
+        shapes = ['-rect', '10', '20', '30', '15', '1', '900', '1', '-elp', '64', '64', '40', '20', '900', '1', '1']
+        burnt = self.instanciate_sut_transform(dcm_transform.parse_arguments(self.in_args + shapes))[1]
+        file_count, dataset = self.instanciate_sut_transform(
+            dcm_transform.parse_arguments(self.in_args + shapes + ['-overlay', 'plane']))
+
+        original = dicom.read_file(self.input_ds_path)
+        self.assertEqual(dataset.PixelData, original.PixelData)
+        self.assertEqual(dataset[0x60000100].value, 1)
+        bits = np.unpackbits(np.frombuffer(dataset[0x60003000].value, dtype=np.uint8), bitorder='little')
+        mask = bits[:dataset.Rows * dataset.Columns].reshape(dataset.Rows, dataset.Columns)
+        np.testing.assert_array_equal(mask == 1, burnt.pixel_array != original.pixel_array)
+
+    def test_presentation_state(self):
+        """Test shapes written as graphics of a companion presentation state"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            output_filename = os.path.join(work_dir, 'out.dcm')
+            args = dcm_transform.parse_arguments(self.in_args + ['-roi', '62', '62', '4', '1023', '-elp', '64',
+                                                                 '64', '20', '40', '900', '1', '1',
+                                                                 '-overlay', 'gsps'])
+            file_count, dataset = self.instanciate_sut_transform(args, out_file=output_filename)
+            self.assertEqual(dicom.read_file(output_filename).PixelData, self.dataset.PixelData)
+
+            state = dicom.read_file(os.path.join(work_dir, 'out_pr.dcm'))
+            self.assertEqual(state.Modality, 'PR')
+            self.assertEqual(state.ReferencedSeriesSequence[0].ReferencedImageSequence[0].ReferencedSOPInstanceUID,
+                             dataset.SOPInstanceUID)
+            graphics = state.GraphicAnnotationSequence[0].GraphicObjectSequence
+            self.assertEqual([graphic.GraphicType for graphic in graphics], ['POLYLINE', 'ELLIPSE'])
+            self.assertEqual(list(graphics[0].GraphicData[:4]), [62.5, 62.5, 65.5, 62.5])
+            self.assertEqual(list(graphics[1].GraphicData[:2]), [64.5, 44.5])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_overlay_per_frame_shapes(self):
+        """Test shapes of different frames kept on their frames, and presentation state graphics merged"""
+        dataset = self.dataset
+        dataset.NumberOfFrames = 3
+        dataset.PixelData = dataset.PixelData * 3
+        overlay_session = dcm_transform.OverlaySession(dataset, 'plane')
+        overlay_session.editor([0]).draw_frect(0, 0, 4, 2, 1)
+        overlay_session.editor([2]).draw_frect(8, 8, 2, 2, 1)
+        overlay_session.commit()
+        bits = np.unpackbits(np.frombuffer(dataset[0x60003000].value, dtype=np.uint8), bitorder='little')
+        planes = bits[:3 * dataset.Rows * dataset.Columns].reshape(3, dataset.Rows, dataset.Columns)
+        self.assertEqual([int(plane.sum()) for plane in planes], [8, 0, 4])
+        self.assertTrue(planes[2, 8:10, 8:10].all())
+
+        for frames, width in [([1], 4), (None, 6)]:  # i.e. two job rules
+            overlay_session = dcm_transform.OverlaySession(dataset, 'gsps', frames)
+            overlay_session.editor().draw_frect(0, 0, width, 2, 1)
+            overlay_session.commit()
+        state = dcm_transform.build_presentation_state(dataset, dataset.overlay_graphics)
+        annotations = state.GraphicAnnotationSequence
+        self.assertEqual(len(annotations), 2)
+        self.assertEqual(annotations[0].ReferencedImageSequence[0].ReferencedFrameNumber, 2)
+        self.assertNotIn('ReferencedFrameNumber', annotations[1].ReferencedImageSequence[0])
+        self.assertEqual(annotations[1].GraphicObjectSequence[0].GraphicData[2], 6)
+
+
+class DcmTestAnnotations(DcmTestCase):
+    """Test the per instance annotation import"""
+
+    def annotate(self, dataset, annotations, extension='.csv'):
+        """Apply the annotations of a csv (or json) file written from dictionaries to a dataset"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(work_dir, 'annotations' + extension)
+            with open(filename, 'w') as annotations_file:
+                if extension == '.json':
+                    json.dump(annotations, annotations_file)
+                else:
+                    names = sorted(set(name for annotation in annotations for name in annotation))
+                    annotations_file.write(','.join(names) + '\n')
+                    for annotation in annotations:
+                        annotations_file.write(','.join(str(annotation.get(name, '')) for name in names) + '\n')
+            session = dcm_transform.PixelSession(dataset)
+            dcm_transform.load_annotations(filename).apply(dataset, session)
+            session.commit()
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_pixel_annotations(self):
+        """Test the batch rasterized shapes against the pixel editor ones"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        expected = dataset.pixel_array.copy()
+        pixel_editor = dcm_transform.PixelEditor(expected)
+        pixel_editor.draw_frect(10, 20, 30, 5, 900)
+        pixel_editor.draw_rect(50, 60, 12, 7, 1, 800)
+        pixel_editor.draw_pixel(100, 1, 1, 90, 1, 1, 700)
+        rows, cols = np.mgrid[:dataset.Rows, :dataset.Columns]
+        expected[((cols + 0.5 - 85) / 10) ** 2 + ((rows + 0.5 - 25) / 5) ** 2 <= 1] = 600
+
+        self.annotate(dataset, [
+            {'instance_number': dataset.InstanceNumber, 'shape': 'frect', 'x': 10, 'y': 20, 'width': 30,
+             'height': 5, 'value': 900},
+            {'sop_instance_uid': dataset.SOPInstanceUID, 'shape': 'rect', 'x': 50, 'y': 60, 'width': 12,
+             'height': 7, 'value': 800},
+            {'instance_number': dataset.InstanceNumber, 'shape': 'point', 'x': 100, 'y': 90, 'value': 700},
+            {'instance_number': dataset.InstanceNumber, 'shape': 'fellipse', 'x': 75, 'y': 20, 'width': 20,
+             'height': 10, 'value': 600},
+            {'instance_number': dataset.InstanceNumber + 1, 'shape': 'frect', 'x': 0, 'y': 0, 'width': 128,
+             'height': 128, 'value': 0}])
+        np.testing.assert_array_equal(dataset.pixel_array, expected)
+
+    def test_series_scoped_annotations(self):
+        """Test instance numbers scoped by their series, the unscoped ones matching any series"""
+        index = dcm_transform.AnnotationIndex([
+            {'instance_number': 1, 'series_instance_uid': '1.2.1', 'x': 1},
+            {'instance_number': 1, 'series_instance_uid': '1.2.2', 'x': 2},
+            {'instance_number': 1, 'x': 3}])
+        dataset = dicom.dataset.Dataset()
+        dataset.InstanceNumber = 1
+        for series, expected in [('1.2.1', [1, 3]), ('1.2.2', [2, 3]), ('1.2.3', [3])]:
+            dataset.SeriesInstanceUID = series
+            self.assertEqual(index.columns['x'][index.select(dataset)].tolist(), expected)
+
+    def test_patient_annotations(self):
+        """Test shapes given in patient coordinates"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        dataset.ImagePositionPatient = [-127, -127, 0]
+        dataset.PixelSpacing = [2, 2]
+        self.annotate(dataset, [{'instance_number': dataset.InstanceNumber, 'shape': 'frect', 'units': 'patient',
+                                 'x': -107, 'y': -117, 'z': 0, 'width': 8, 'height': 4, 'value': 1000}], '.json')
+        changed = np.argwhere(dataset.pixel_array == 1000)
+        # the pixels whose center is in the box, as a 3D ROI box
+        self.assertEqual((changed.min(axis=0).tolist(), changed.max(axis=0).tolist()), ([5, 10], [7, 14]))
+
+    def test_annotation_json_values(self):
+        """Test the json numbers of the value and alpha columns, a zero alpha included"""
+        index = dcm_transform.AnnotationIndex([
+            {'instance_number': 1, 'value': 1023.0, 'alpha': 0},
+            {'instance_number': 1, 'value': '255,0,0', 'alpha': ''},
+            {'instance_number': 1, 'value': [255, 0, 0], 'alpha': 0.5}])
+        self.assertEqual(index.columns['value'], [1023, [255, 0, 0], [255, 0, 0]])
+        self.assertEqual(index.columns['alpha'].tolist(), [0.0, 1.0, 0.5])
+
+
+class DcmTestRois3D(DcmTestCase):
+    """Test the patient space 3d ROIs sections"""
+
+    def draw(self, dataset, rois):
+        """Draw the 3d ROIs in the dataset pixels"""
+        pixel_session = dcm_transform.PixelSession(dataset)
+        dcm_transform.draw_rois_3d(dataset, rois, pixel_session)
+        pixel_session.commit()
+
+    def test_sphere_box_cylinder(self):
+        """Test the analytic sections against a brute force evaluation of the pixel centers"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        dataset.ImagePositionPatient = [-127, -127, 6]
+        dataset.PixelSpacing = [2, 2]
+        rows, cols = np.mgrid[0:128, 0:128]
+        pos_x, pos_y = cols * 2.0 - 127, rows * 2.0 - 127
+        expected = dataset.pixel_array.copy()
+        expected[(pos_x - 10) ** 2 + (pos_y + 20) ** 2 + (6 - 0) ** 2 <= 30 ** 2] = 1000
+        expected[(pos_x >= 40) & (pos_x <= 60) & (pos_y >= -100) & (pos_y <= -80)] = 2000
+        expected[(pos_x >= -100) & (pos_x <= -60) & ((pos_y - 50) ** 2 + 36 <= 10 ** 2)] = 3000
+        self.draw(dataset, ['sphere', '10', '-20', '0', '30', '1000', '1',
+                            'box', '60', '-80', '-5', '40', '-100', '6', '2000', '1',
+                            'cylinder', '-100', '50', '0', '-60', '50', '0', '10', '3000', '1'])
+        np.testing.assert_array_equal(dataset.pixel_array, expected)
+
+    def test_culled_slice(self):
+        """Test that a slice missed by all the ROIs keeps its pixel data untouched"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        dataset.ImagePositionPatient = [-127, -127, 100]
+        dataset.PixelSpacing = [2, 2]
+        pixel_data = dataset.PixelData
+        self.draw(dataset, ['sphere', '0', '0', '0', '30', '1000', '1',
+                            'box', '0', '0', '0', '10', '10', '99', '0', '1'])
+        self.assertIs(dataset.PixelData, pixel_data)
+
+
+class DcmTestPixelTransform(DcmTestCase):
+    """Test the pixel intensity transform stage"""
+
+    def test_rescale_widens_bits_stored(self):
+        """Test a linear rescale with a cached lookup table and the BitsStored update"""
+        self.set_sample_images_io(self.image2, 'result_rescale.dcm')
+        self.in_args.extend(['-rescale', '16', '10', '-clip', '0', '20000'])
+        self.test_args = dcm_transform.parse_arguments(self.in_args)
+        original = dicom.read_file(self.input_ds_path).pixel_array.astype(np.int64)
+        file_count, dataset = self.instanciate_sut_transform(self.test_args)
+
+        self.assertEqual(file_count, 1)
+        self.assertIs(dcm_transform.get_pixel_transform(self.test_args),
+                      dcm_transform.get_pixel_transform(dcm_transform.parse_arguments(self.in_args)))
+        result = dicom.read_file(self.output_ds_path)
+        self.assertTrue((result.pixel_array == np.clip(original * 16 + 10, 0, 20000)).all())
+        self.assertEqual(result.BitsStored, 14)
+        self.assertEqual(result.HighBit, 13)
+
+    def test_seeded_noise_and_threshold(self):
+        """Test that seeded noise is reproducible and thresholding gives two values"""
+        self.set_sample_images_io(self.image2, 'result_noise.dcm')
+        self.test_args = dcm_transform.parse_arguments(self.in_args + ['-noise', '20', '7'])
+        self.instanciate_sut_transform(self.test_args)
+        first = dicom.read_file(self.output_ds_path).pixel_array
+        self.instanciate_sut_transform(self.test_args)
+        self.assertTrue((first == dicom.read_file(self.output_ds_path).pixel_array).all())
+
+        self.test_args = dcm_transform.parse_arguments(self.in_args + ['-threshold', '100', '0', '1000'])
+        self.instanciate_sut_transform(self.test_args)
+        self.assertEqual(set(np.unique(dicom.read_file(self.output_ds_path).pixel_array)), {0, 1000})
+
+
+class DcmTestStatistics(DcmTestCase):
+    """Test the single pass pixel statistics report"""
+
+    def test_statistics_report(self):
+        """Test the per slice statistics, changed pixels count and the per series json report"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            report_filename = os.path.join(work_dir, 'report.json')
+            self.set_sample_images_io(self.image2, 'result.dcm')
+            args = dcm_transform.parse_arguments(self.in_args + ['-frect', '0', '0', '10', '4', '4095', '1',
+                                                                 '-stats', report_filename, '-stats_bins', '4'])
+            for count in range(2):
+                file_count, dataset = self.instanciate_sut_transform(args)
+            dcm_transform.close_statistics_reports()
+            del dcm_transform.STATISTICS_REPORTS[report_filename]
+
+            with open(report_filename) as report_file:
+                report = json.load(report_file)
+            series = report['series'][0]
+            pixels = dataset.pixel_array
+            self.assertEqual(series['slices'], 2)
+            self.assertEqual(series['max'], 4095)
+            self.assertAlmostEqual(series['mean'], pixels.mean())
+            self.assertAlmostEqual(series['std'], pixels.std())
+            self.assertEqual(series['clipped'], 2 * np.count_nonzero((pixels == 0) | (pixels == 4095)))
+            self.assertEqual(series['histogram'], (2 * np.bincount(pixels.ravel() // 1024, minlength=4)).tolist())
+            original = dicom.read_file(self.input_ds_path).pixel_array
+            self.assertEqual(series['slices_stats'][0]['changed'], np.count_nonzero(original[:4, :10] != 4095))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_statistics_of_edited_frames(self):
+        """Test that the statistics of an encapsulated or a frames subset edit describe the edited pixels"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        frame = dataset.pixel_array
+        frames = np.stack([frame, frame[::-1]])
+        dataset.NumberOfFrames = 2
+        for encapsulated in [True, False]:
+            if encapsulated:
+                dataset.PixelData = dicom.encaps.encapsulate(
+                    [dcm_transform.rle_encode_frame(arr[:, :, None], 16) for arr in frames])
+                dataset['PixelData'].is_undefined_length = True
+                dataset.file_meta.TransferSyntaxUID = dicom.uid.RLELossless
+            else:
+                dataset.PixelData = frames.tobytes()
+                dataset['PixelData'].is_undefined_length = False
+                dataset.file_meta.TransferSyntaxUID = dicom.uid.ExplicitVRLittleEndian
+            pixel_session = dcm_transform.PixelSession(dataset, [1], keep_original=True)
+            pixel_session.editor().draw_frect(0, 0, 10, 4, 4000)
+            stats = dcm_transform.slice_statistics(dataset, pixel_session, 4, [1])
+            self.assertEqual(stats['frames'], 1)
+            self.assertEqual(stats['max'], 4000)
+            self.assertEqual(stats['changed'], np.count_nonzero(frames[1][:4, :10] != 4000))
+
+    def test_statistics_shards_merge(self):
+        """Test the per shard statistics parts merged into the report of the whole tree"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            for i in range(4):
+                os.makedirs(os.path.join(input_dir, 'series%d' % i))
+                shutil.copy(os.path.join(self.dcm_data_root, self.image2), os.path.join(input_dir, 'series%d' % i))
+
+            report_filename = os.path.join(work_dir, 'report.csv')
+            script = os.path.join(os.path.dirname(os.path.abspath(dcm_transform.__file__)), 'dcm_transform.py')
+            command = [sys.executable, script, input_dir, output_dir, '-r', '-stats', report_filename]
+            for index in range(2):
+                subprocess.check_output(command + ['-shard', '%d/2' % index])
+                self.assertFalse(os.path.exists(report_filename))
+            self.assertEqual(subprocess.call(command + ['-merge_shards'], stdout=subprocess.PIPE), 0)
+
+            with open(report_filename) as report_file:
+                rows = list(csv.DictReader(report_file))
+            pixels = dicom.read_file(os.path.join(self.dcm_data_root, self.image2)).pixel_array
+            self.assertEqual(len(rows), 1)  # the copies share their series instance uid
+            self.assertEqual(int(rows[0]['slices']), 4)
+            self.assertEqual(int(rows[0]['pixels']), 4 * pixels.size)
+            self.assertAlmostEqual(float(rows[0]['mean']), pixels.mean(), places=4)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestRedaction(DcmTestCase):
+    """Test the rule based burned-in annotation redaction"""
+
+    def test_redact_matching_rule(self):
+        """Test that the regions of the matching rule are blanked with a cached mask"""
+        self.set_sample_images_io(self.image2, 'result_redact.dcm')
+        rules_filename = os.path.join(self.dcm_data_root, 'result_rules.json')
+        with open(rules_filename, 'w') as rules_file:
+            json.dump([{'Manufacturer': 'dem*', 'Rows': 128, 'Columns': 128, 'Modality': 'MR',
+                        'regions': [[0, 0, 128, 12], [96, 116, 32, 12, 7]]},
+                       {'Manufacturer': 'ACME', 'regions': [[0, 0, 128, 128]]}], rules_file)
+        self.in_args.extend(['-redact', rules_filename])
+        self.test_args = dcm_transform.parse_arguments(self.in_args)
+        original = dicom.read_file(self.input_ds_path).pixel_array
+        self.instanciate_sut_transform(self.test_args)
+
+        arr = dicom.read_file(self.output_ds_path).pixel_array
+        self.assertTrue((arr[:12] == 0).all())
+        self.assertTrue((arr[116:, 96:] == 7).all())
+        self.assertTrue((arr[12:116] == original[12:116]).all())
+
+        rules = dcm_transform.get_redaction_rules(self.test_args)
+        self.assertIs(rules.masks(dicom.read_file(self.output_ds_path))[0][0],
+                      rules.masks(dicom.read_file(self.input_ds_path))[0][0])
+        self.assertEqual(rules.masks(self.dataset), [])
+
+
+class DcmTestResample(DcmTestCase):
+    """Test the volumetric resampling of a series"""
+
+    def write_series(self, series_dir, volume):
+        """Write an axial series of 2 mm voxels from a (slices, rows, cols) volume"""
+        dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        dataset.PixelSpacing = [2, 2]
+        for k, frame in enumerate(volume):
+            dataset.ImagePositionPatient = [-127, -127, 2 * k]
+            dataset.InstanceNumber = k + 1
+            dataset.PixelData = frame.astype(np.uint16).tobytes()
+            dataset.save_as(os.path.join(series_dir, 'slice%03d.dcm' % k))
+
+    def resample(self, volume, options):
+        """Resample a volume through a written series, return the output volume"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            self.write_series(input_dir, volume)
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-resample'] + options)
+            dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual(sorted(os.listdir(output_dir)), sorted(os.listdir(input_dir)))
+            return np.stack([dicom.read_file(os.path.join(output_dir, filename)).pixel_array
+                             for filename in sorted(os.listdir(output_dir))])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_resample_rotation(self):
+        """Test a 90 degrees rotation around the slice normal streamed in small slabs"""
+        volume = np.random.RandomState(0).randint(0, 1000, size=(40, 128, 128))
+        result = self.resample(volume, ['-az', '90', '-mem_mb', '1', '-workers', '2'])
+        self.assertTrue((result == np.rot90(volume, -1, axes=(1, 2))).all())
+
+    def test_resample_translation(self):
+        """Test a translation of 10 mm along x, the series geometry being kept"""
+        volume = np.random.RandomState(1).randint(0, 1000, size=(4, 128, 128))
+        result = self.resample(volume, ['-x', '10'])
+        self.assertTrue((result[:, :, 5:] == volume[:, :, :-5]).all())
+        self.assertTrue((result[:, :, :5] == 0).all())
+
+    def test_resample_rejects_color(self):
+        """Test that a color series is rejected instead of failing in the resampling"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            self.write_series(input_dir, np.zeros((2, 128, 128)))
+            for filename in os.listdir(input_dir):
+                dataset = dicom.read_file(os.path.join(input_dir, filename))
+                dataset.SamplesPerPixel = 3
+                dataset.PlanarConfiguration = 0
+                dataset.PhotometricInterpretation = 'RGB'
+                dataset.BitsAllocated = dataset.BitsStored = 8
+                dataset.HighBit = 7
+                dataset.PixelData = np.zeros((128, 128, 3), dtype=np.uint8).tobytes()
+                dataset.save_as(os.path.join(input_dir, filename))
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-resample', '-az', '90'])
+            dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual(os.listdir(output_dir) if os.path.isdir(output_dir) else [], [])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_resample_rejects_duplicate_positions(self):
+        """Test that a series with duplicate slice positions is skipped instead of aborting the run"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            self.write_series(input_dir, np.zeros((2, 128, 128)))
+            for filename in os.listdir(input_dir):
+                dataset = dicom.read_file(os.path.join(input_dir, filename))
+                dataset.ImagePositionPatient = [-127, -127, 0]  # second echo of the same slice
+                dataset.save_as(os.path.join(input_dir, filename))
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-resample', '-az', '90'])
+            dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual(os.listdir(output_dir) if os.path.isdir(output_dir) else [], [])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_resample_presentation_state(self):
+        """Test that the presentation states of the resampled slices are written in gsps mode"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            self.write_series(input_dir, np.zeros((2, 128, 128)))
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-resample', '-x', '10', '-overlay', 'gsps',
+                                                  '-frect', '0', '0', '10', '10', '100', '1'])
+            dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             ['slice000.dcm', 'slice000_pr.dcm', 'slice001.dcm', 'slice001_pr.dcm'])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_resample_single_file_falls_back(self):
+        """Test that a single file input gets the geometry transform, there is no volume to resample"""
+        self.set_sample_images_io(self.image2, 'result_resample.dcm')
+        args = dcm_transform.parse_arguments(self.in_args + ['-resample', '-x', '10'])
+        self.instanciate_sut_transform(args)
+        before = dicom.read_file(self.input_ds_path).ImagePositionPatient
+        after = dicom.read_file(self.output_ds_path).ImagePositionPatient
+        self.assertAlmostEqual(float(after[0]), float(before[0]) + 10, places=3)
+
+
+class DcmTestOutputWriter(DcmTestCase):
+    """Test the atomic output writer"""
+
+    def test_atomic_write(self):
+        """Test the write through a renamed temporary file and the directory batch fsync"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            output_writer = dcm_transform.OutputWriter('dir')
+            output_dir = os.path.join(work_dir, 'a', 'b')
+            output_writer.make_dirs([output_dir, os.path.join(work_dir, 'a', 'c')])
+            output_writer.write(self.dataset, os.path.join(output_dir, 'out.dcm'))
+            self.assertEqual(os.listdir(output_dir), ['out.dcm'])
+            self.assertEqual(dicom.read_file(os.path.join(output_dir, 'out.dcm')).SOPInstanceUID,
+                             self.dataset.SOPInstanceUID)
+            output_writer.flush_directory(output_dir)
+            output_writer.close()
+            self.assertTrue(os.path.isdir(os.path.join(work_dir, 'a', 'c')))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_dir_policy_defers_file_syncs(self):
+        """Test that the 'dir' policy syncs no file on its own, only the file system once per directory"""
+        work_dir = tempfile.mkdtemp()
+        calls = []
+        fsync, sync_file_system = os.fsync, dcm_transform.sync_file_system
+        os.fsync = lambda fd: calls.append('fsync')
+        dcm_transform.sync_file_system = lambda directory: calls.append(('syncfs', directory))
+        try:
+            output_writer = dcm_transform.OutputWriter('dir')
+            for i in range(3):
+                output_writer.write(self.dataset, os.path.join(work_dir, 'out%d.dcm' % i))
+            self.assertEqual(calls, [])
+            output_writer.close()
+            self.assertEqual(calls, [('syncfs', os.path.normpath(work_dir)), 'fsync'])
+        finally:
+            os.fsync, dcm_transform.sync_file_system = fsync, sync_file_system
+            shutil.rmtree(work_dir)
+
+    def test_failed_write_leaves_nothing(self):
+        """Test that a failing write leaves neither a truncated file nor a temporary one"""
+        class BrokenDataset(object):
+            """Dataset failing in the middle of its serialization"""
+            def save_as(self, out_file):
+                out_file.write(b'DICM')
+                raise IOError('disk full')
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            output_writer = dcm_transform.OutputWriter('file')
+            with self.assertRaises(IOError):
+                output_writer.write(BrokenDataset(), os.path.join(work_dir, 'out.dcm'))
+            self.assertEqual(os.listdir(work_dir), [])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_copy_through(self):
+        """Test the unparsed copy of a file, copied then hard linked"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            src_filename = os.path.join(work_dir, 'notes.txt')
+            with open(src_filename, 'wb') as src_file:
+                src_file.write(b'not a dicom file' * 10000)
+            output_writer = dcm_transform.OutputWriter()
+            for link in [False, True]:
+                out_filename = os.path.join(work_dir, 'out', str(link) + '.txt')
+                output_writer.copy(src_filename, out_filename, link)
+                with open(out_filename, 'rb') as out_file:
+                    self.assertEqual(out_file.read(), b'not a dicom file' * 10000)
+            self.assertEqual(os.stat(os.path.join(work_dir, 'out', 'True.txt')).st_ino,
+                             os.stat(src_filename).st_ino)
+            self.assertFalse(dcm_transform.is_dicom_file(src_filename))
+            self.assertTrue(dcm_transform.is_dicom_file(os.path.join(self.dcm_data_root, 'brain2.dcm')))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_needs_transform(self):
+        """Test the detection of the options leaving the files untouched"""
+        args = dcm_transform.parse_arguments(['in', 'out', '-fsync', 'dir', '-workers', '4'])
+        self.assertFalse(dcm_transform.needs_transform(args))
+        args = dcm_transform.parse_arguments(['in', 'out', '-fsync', 'dir', '-workers', '4', '-shard', '0/2',
+                                              '-overlay', 'plane', '-dshift_max', '30', '-stats_bins', '8'])
+        self.assertFalse(dcm_transform.needs_transform(args))
+        args = dcm_transform.parse_arguments(['in', 'out', '-pid', 'anon'])
+        self.assertTrue(dcm_transform.needs_transform(args))
+        self.assertIsNone(dcm_transform.file_selectors(args))
+
+    def test_selective_copy_through(self):
+        """Test that the files no annotation applies to are copied through, byte for byte"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+            for number in [1, 2]:
+                dataset.InstanceNumber = number
+                dataset.save_as(os.path.join(input_dir, 'slice%d.dcm' % number))
+            annotations_filename = os.path.join(work_dir, 'annotations.json')
+            with open(annotations_filename, 'w') as annotations_file:
+                json.dump([{'instance_number': 2, 'shape': 'frect', 'x': 0, 'y': 0, 'width': 4, 'height': 4,
+                            'value': 1000}], annotations_file)
+
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-annotations', annotations_filename,
+                                                  '-overlay', 'plane'])
+            self.assertEqual(len(dcm_transform.file_selectors(args)), 1)
+            counts = dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual((counts['copied'], counts['transformed']), (1, 1))
+            for number, copied in [(1, True), (2, False)]:
+                with open(os.path.join(input_dir, 'slice%d.dcm' % number), 'rb') as input_file:
+                    with open(os.path.join(output_dir, 'slice%d.dcm' % number), 'rb') as output_file:
+                        self.assertEqual(input_file.read() == output_file.read(), copied)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestFanOut(DcmTestCase):
+    """Test the read-once fan-out of variants"""
+
+    def test_fan_out_variants(self):
+        """Test a grid and a listed variant generated from a single read of the input"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            os.makedirs(input_dir)
+            shutil.copy(os.path.join(self.dcm_data_root, self.image2), input_dir)
+            spec_filename = os.path.join(work_dir, 'variants.json')
+            with open(spec_filename, 'w') as spec_file:
+                json.dump({'first_sn': 70,
+                           'grid': {'-x': [0, 10]},
+                           'variants': [{'name': 'roi', 'args': ['-roi', '62', '62', '4', '1023']}]},
+                          spec_file)
+
+            argv = [input_dir, os.path.join(work_dir, 'out'), '-variants', spec_filename]
+            variants = dcm_transform.load_variants(spec_filename, argv)
+            self.assertEqual([variant.name for variant in variants], ['roi', 'x0', 'x10'])
+            dcm_transform.fan_out(dcm_transform.parse_arguments(argv), variants)
+
+            original = dicom.read_file(os.path.join(input_dir, self.image2))
+            outputs = [dicom.read_file(os.path.join(variant.output, self.image2)) for variant in variants]
+            self.assertEqual([output.SeriesNumber for output in outputs], [70, 71, 72])
+            self.assertEqual(len(set(output.SeriesInstanceUID for output in outputs)), 3)
+            self.assertTrue((outputs[0].pixel_array[62, 62:66] == 1023).all())
+            self.assertEqual(outputs[1].PixelData, original.PixelData)
+            self.assertEqual(float(outputs[2].ImagePositionPatient[0]),
+                             float(original.ImagePositionPatient[0]) + 10)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_fan_out_anonymized_names(self):
+        """Test that each variant anonymizes with its own name, leaving the run arguments alone"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            os.makedirs(input_dir)
+            shutil.copy(os.path.join(self.dcm_data_root, self.image2), input_dir)
+            spec_filename = os.path.join(work_dir, 'variants.json')
+            with open(spec_filename, 'w') as spec_file:
+                json.dump({'variants': [{'name': 'alpha', 'args': ['-an', 'alpha']},
+                                        {'name': 'beta', 'args': ['-an', 'beta']}]}, spec_file)
+
+            argv = [input_dir, os.path.join(work_dir, 'out'), '-variants', spec_filename]
+            variants = dcm_transform.load_variants(spec_filename, argv)
+            args = dcm_transform.parse_arguments(argv)
+            dcm_transform.ARGS = args
+            dcm_transform.fan_out(args, variants)
+            self.assertIs(dcm_transform.ARGS, args)
+            names = dict((variant.name, str(dicom.read_file(os.path.join(variant.output, self.image2)).PatientName))
+                         for variant in variants)
+            self.assertEqual((names['alpha'], names['beta']), ('alpha', 'beta'))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_fan_out_geometry_variants(self):
+        """Test that each geometry variant moves the original position and orientation, not the previous one"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            os.makedirs(input_dir)
+            original = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+            original.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+            original.save_as(os.path.join(input_dir, self.image2))
+            spec_filename = os.path.join(work_dir, 'variants.json')
+            with open(spec_filename, 'w') as spec_file:
+                json.dump({'grid': {'-x': [10, 20], '-az': [0, 90]}}, spec_file)
+
+            argv = [input_dir, os.path.join(work_dir, 'out'), '-variants', spec_filename]
+            variants = dcm_transform.load_variants(spec_filename, argv)
+            dcm_transform.fan_out(dcm_transform.parse_arguments(argv), variants)
+
+            position = [float(val) for val in original.ImagePositionPatient]
+            for variant in variants:
+                output = dicom.read_file(os.path.join(variant.output, self.image2))
+                self.assertEqual([float(val) for val in output.ImagePositionPatient],
+                                 [position[0] + variant.args.x] + position[1:])
+                expected = [1, 0, 0, 0, 1, 0] if variant.args.az == 0 else [0, 1, 0, -1, 0, 0]
+                self.assertEqual([round(float(val), 5) + 0.0 for val in output.ImageOrientationPatient],
+                                 expected)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestJobs(DcmTestCase):
+    """Test the single pass multi-job rules"""
+
+    def test_job_rules(self):
+        """Test that only the rules matching the original header apply, with one read and write"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            shutil.copy(os.path.join(self.dcm_data_root, self.image2), input_dir)
+            jobs_filename = os.path.join(work_dir, 'jobs.json')
+            with open(jobs_filename, 'w') as jobs_file:
+                json.dump({'rules': [
+                    {'name': 'all', 'args': ['-pid', 'anon']},
+                    {'name': 'ct', 'match': {'Modality': 'CT'}, 'args': ['-x', '10']},
+                    {'name': 'mr', 'match': {'Modality': ['CT', 'MR'], 'Rows': 128, '(0008,0070)': 'dem*'},
+                     'args': ['-roi', '62', '62', '4', '1023', '-pid', 'mr']}]}, jobs_file)
+
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-jobs', jobs_filename, '-sn', '7'])
+            rules = dcm_transform.get_job_rules(args)
+            self.assertEqual([rule.name for rule in rules], ['command line', 'all', 'ct', 'mr'])
+            counts = dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual(counts['transformed'], 1)
+
+            original = dicom.read_file(os.path.join(input_dir, self.image2))
+            dataset = dicom.read_file(os.path.join(output_dir, self.image2))
+            self.assertEqual(dataset.SeriesNumber, 7)
+            self.assertEqual(dataset.PatientID, 'mr')
+            self.assertEqual(dataset.ImagePositionPatient, original.ImagePositionPatient)
+            self.assertTrue((dataset.pixel_array[62, 62:66] == 1023).all())
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_job_rules_shared_pixels(self):
+        """Test the pixel edits of several rules in one session, the files matching no rule being copied"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            os.makedirs(input_dir)
+            dataset = dicom.read_file(os.path.join(self.dcm_data_root, self.image2))
+            for modality in ['MR', 'CT']:
+                dataset.Modality = modality
+                dataset.save_as(os.path.join(input_dir, modality + '.dcm'))
+            jobs_filename = os.path.join(work_dir, 'jobs.json')
+            with open(jobs_filename, 'w') as jobs_file:
+                json.dump({'rules': [
+                    {'name': 'roi', 'match': {'Modality': 'MR'}, 'args': ['-roi', '62', '62', '4', '1023']},
+                    {'name': 'frect', 'match': {'Modality': 'MR'}, 'args': ['-frect', '0', '0', '4', '4', '999', '1']}
+                ]}, jobs_file)
+
+            args = dcm_transform.parse_arguments([input_dir, output_dir, '-jobs', jobs_filename])
+            counts = dcm_transform.iterate_once(args, input_dir, output_dir)
+            self.assertEqual((counts['transformed'], counts['copied']), (1, 1))
+            arr = dicom.read_file(os.path.join(output_dir, 'MR.dcm')).pixel_array
+            self.assertTrue((arr[62, 62:66] == 1023).all())
+            self.assertTrue((arr[:4, :4] == 999).all())
+            with open(os.path.join(input_dir, 'CT.dcm'), 'rb') as input_file:
+                with open(os.path.join(output_dir, 'CT.dcm'), 'rb') as output_file:
+                    self.assertEqual(input_file.read(), output_file.read())
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestTreeScan(DcmTestCase):
+    """Test the tree scanner"""
+
+    def test_scan_filters(self):
+        """Test the include / exclude patterns, maximum depth and relative paths of the scan"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            for rel_path in ['a.dcm', 'notes.txt', 's1/b.dcm', 's1/deep/c.dcm', 'tmp/d.dcm']:
+                path = os.path.join(work_dir, 'in', *rel_path.split('/'))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+
+            args = dcm_transform.parse_arguments([os.path.join(work_dir, 'in') + os.sep, 'out', '-r',
+                                                  '-include', '*.dcm', '-exclude', 'tmp', '-max_depth', '1'])
+            scanned = [(rel_dir, filenames) for dirpath, rel_dir, filenames
+                       in dcm_transform.scan_tree(args.input_series, args)]
+            self.assertEqual(scanned, [('', ['a.dcm']), ('s1', ['b.dcm'])])
+            args = dcm_transform.parse_arguments([os.path.join(work_dir, 'in'), 'out'])
+            self.assertEqual(dcm_transform.scan_files(args.input_series, args), ['a.dcm', 'notes.txt'])
+        finally:
+            shutil.rmtree(work_dir)
+
+    @unittest.skipUnless(hasattr(os, 'symlink') and os.name != 'nt', 'symbolic links required')
+    def test_scan_symbolic_links(self):
+        """Test that linked directories are scanned as directories, link loops once only"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(work_dir, 'data', 'series'))
+            open(os.path.join(work_dir, 'data', 'series', 'b.dcm'), 'w').close()
+            os.makedirs(os.path.join(work_dir, 'in'))
+            os.symlink(os.path.join(work_dir, 'data', 'series'), os.path.join(work_dir, 'in', 'linked'))
+            os.symlink(os.path.join(work_dir, 'in'), os.path.join(work_dir, 'data', 'series', 'loop'))
+
+            args = dcm_transform.parse_arguments([os.path.join(work_dir, 'in'), 'out', '-r'])
+            scanned = [(rel_dir, filenames) for dirpath, rel_dir, filenames
+                       in dcm_transform.scan_tree(args.input_series, args)]
+            self.assertEqual(scanned, [('', []), ('linked', ['b.dcm'])])
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestShards(DcmTestCase):
+    """Test the deterministic sharding of a tree by series"""
+
+    def test_shards_cover_tree(self):
+        """Test shards run as separate processes processing disjoint series, then merged"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            series = ['patient%d/series%d' % (i // 2, i) for i in range(6)]
+            for key in series:
+                os.makedirs(os.path.join(input_dir, key))
+                shutil.copy(os.path.join(self.dcm_data_root, self.image2), os.path.join(input_dir, key))
+
+            script = os.path.join(os.path.dirname(os.path.abspath(dcm_transform.__file__)), 'dcm_transform.py')
+            command = [sys.executable, script, input_dir, output_dir, '-r', '-pid', 'anon']
+            for index in range(3):
+                subprocess.check_output(command + ['-shard', '%d/3' % index])
+            merge_command = [sys.executable, script, input_dir, output_dir, '-merge_shards']  # no -r
+            self.assertEqual(subprocess.call(merge_command, stdout=subprocess.PIPE), 0)
+
+            with open(os.path.join(output_dir, '.dcm_transform.shards.json')) as merged_file:
+                merged = json.load(merged_file)
+            self.assertEqual(merged['totals']['transformed'], 6)
+            for key in series:
+                self.assertEqual(dicom.read_file(os.path.join(output_dir, key, self.image2)).PatientID, 'anon')
+
+            # a series left out by its shard is found by the recursive scan of the shards
+            manifest_filename = dcm_transform.shard_manifest_filename(output_dir, 0, 3)
+            with open(manifest_filename) as manifest_file:
+                manifest = json.load(manifest_file, object_pairs_hook=dcm_transform.OrderedDict)
+            dropped = list(manifest['series'])[0]
+            del manifest['series'][dropped]
+            with open(manifest_filename, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            self.assertEqual(subprocess.call(merge_command, stdout=subprocess.PIPE), 1)
+            with open(os.path.join(output_dir, '.dcm_transform.shards.json')) as merged_file:
+                self.assertEqual(json.load(merged_file)['problems'],
+                                 ['Series ' + dropped + ' not processed by its shard 0'])
+
+            os.remove(dcm_transform.shard_manifest_filename(output_dir, 1, 3))
+            self.assertEqual(subprocess.call(command + ['-merge_shards'], stdout=subprocess.PIPE), 1)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestAudit(DcmTestCase):
+    """Test the audit log of the tag changes"""
+
+    def test_audit_log(self):
+        """Test the changed, added and deleted tags rows, batch flushed to a SQLite audit log"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            audit_filename = os.path.join(work_dir, 'audit.db')
+            self.set_sample_images_io(self.image2, 'result.dcm')
+            args = dcm_transform.parse_arguments(self.in_args + ['-pid', 'anon', '-mname', 'demo',
+                                                                 '-tags', '+(0011,1001):LO', 'note', '~(0008,0070)',
+                                                                 '-frect', '0', '0', '10', '4', '4095', '1',
+                                                                 '-audit', audit_filename, '-audit_batch', '2'])
+            self.instanciate_sut_transform(args)
+            dcm_transform.close_audit_logs()
+
+            connection = sqlite3.connect(audit_filename)
+            rows = connection.execute('SELECT tag, action, old, new, file FROM audit').fetchall()
+            connection.close()
+            self.assertEqual(sorted(row[:4] for row in rows),
+                             [('(0008,0070)', 'deleted', 'demo', ''), ('(0010,0020)', 'changed', 'id', 'anon'),
+                              ('(0011,1001)', 'added', '', 'note')])
+            self.assertEqual(set(row[4] for row in rows), {self.output_ds_path})
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_audit_csv_multi_line_values(self):
+        """Test that the multi-line values of a csv audit log part survive the merge"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            audit_filename = os.path.join(work_dir, 'audit.csv')
+            row = ['file.dcm', '(0020,4000)', 'ImageComments', 'LT', 'changed', 'first\r\nsecond', 'third\nfourth']
+            for index in range(2):
+                audit_log = dcm_transform.AuditLog(dcm_transform.audit_part_filename(audit_filename, index, 2))
+                audit_log.append(row)
+                audit_log.close()
+            self.assertEqual(dcm_transform.merge_audit_parts(audit_filename, 2), [])
+            self.assertEqual(list(dcm_transform.read_audit_rows(audit_filename)), [row, row])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_audit_shards_merge(self):
+        """Test the per shard audit log parts merged in shard order"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            for i in range(4):
+                os.makedirs(os.path.join(input_dir, 'series%d' % i))
+                shutil.copy(os.path.join(self.dcm_data_root, self.image2), os.path.join(input_dir, 'series%d' % i))
+
+            audit_filename = os.path.join(work_dir, 'audit.csv')
+            script = os.path.join(os.path.dirname(os.path.abspath(dcm_transform.__file__)), 'dcm_transform.py')
+            command = [sys.executable, script, input_dir, output_dir, '-r', '-pid', 'anon', '-audit', audit_filename]
+            for index in range(2):
+                subprocess.check_output(command + ['-shard', '%d/2' % index])
+            self.assertEqual(subprocess.call(command + ['-merge_shards'], stdout=subprocess.PIPE), 0)
+
+            with open(audit_filename) as audit_file:
+                rows = list(csv.DictReader(audit_file))
+            self.assertEqual(sorted(os.path.relpath(row['file'], output_dir) for row in rows),
+                             [os.path.join('series%d' % i, self.image2) for i in range(4)])
+            self.assertEqual(set((row['keyword'], row['old'], row['new']) for row in rows),
+                             {('PatientID', 'id', 'anon')})
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class DcmTestDateShift(DcmTestCase):
+    """Test the per patient date and time shifting"""
+
+    def test_dicom_datetime_forms(self):
+        """Test the parsing and formatting back of the DA, TM and DT forms"""
+        for date_text, time_text in [('20150923', '1205'), ('2015.09.23', '12:05:07'),
+                                     ('20150923', '120507.25'), ('20150923', '')]:
+            value, dt_format = dcm_transform.parse_dicom_date_time(date_text, time_text)
+            self.assertEqual((value.year, value.month, value.day), (2015, 9, 23))
+            self.assertEqual(dcm_transform.format_dicom_datetime(value, dt_format),
+                             '20150923' + time_text.replace(':', ''))
+        value, dt_format = dcm_transform.parse_dicom_datetime('20150923235959.5-0500')
+        self.assertEqual(dcm_transform.format_dicom_datetime(value, dt_format), '20150923235959.5-0500')
+        self.assertEqual(dcm_transform.modify_time('20150923', '235959', '2'), datetime(2015, 9, 24, 0, 0, 1))
+
+    def test_random_shift_shards(self):
+        """Test that the shards shift a patient they share by the same random offset, their maps merged"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, 'in')
+            output_dir = os.path.join(work_dir, 'out')
+            for i in range(4):
+                os.makedirs(os.path.join(input_dir, 'series%d' % i))
+                shutil.copy(os.path.join(self.dcm_data_root, self.image2), os.path.join(input_dir, 'series%d' % i))
+
+            map_filename = os.path.join(work_dir, 'shifts.json')
+            script = os.path.join(os.path.dirname(os.path.abspath(dcm_transform.__file__)), 'dcm_transform.py')
+            command = [sys.executable, script, input_dir, output_dir, '-r', '-dshift', '-dshift_map', map_filename]
+            shards = [subprocess.Popen(command + ['-shard', '%d/2' % index], stdout=subprocess.PIPE)
+                      for index in range(2)]  # concurrent, none of them sees the map of the other
+            for shard in shards:
+                shard.communicate()
+                self.assertEqual(shard.returncode, 0)
+            self.assertEqual(subprocess.call(command + ['-merge_shards'], stdout=subprocess.PIPE), 0)
+
+            with open(map_filename) as map_file:
+                self.assertEqual(len(json.load(map_file)), 1)
+            self.assertEqual(len(set(dicom.read_file(os.path.join(output_dir, 'series%d' % i, self.image2)).StudyDate
+                                     for i in range(4))), 1)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_patient_shift_keeps_intervals(self):
+        """Test that the studies of a patient are shifted by the same seeded offset"""
+        date_shifter = dcm_transform.DateShifter('seed', 100, True)
+        datasets = []
+        for study_date in ['20150923', '20151003']:
+            dataset = dicom.read_file(self.input_ds_path)
+            dataset.PatientID = 'patient'
+            dataset.StudyDate = study_date
+            dataset.StudyTime = '120000'
+            dataset.AcquisitionDateTime = study_date + '120000.000'
+            date_shifter.apply(dataset)
+            datasets.append(dataset)
+
+        offset = date_shifter.offsets['patient']
+        self.assertEqual(offset, dcm_transform.DateShifter('seed', 100, True).offset('patient'))
+        studies = [dcm_transform.parse_dicom_date_time(dataset.StudyDate, dataset.StudyTime)[0]
+                   for dataset in datasets]
+        self.assertEqual(studies[0], datetime(2015, 9, 23, 12) + offset)
+        self.assertEqual(studies[1] - studies[0], timedelta(days=10))
+        self.assertEqual(datasets[1].AcquisitionDateTime, studies[1].strftime('%Y%m%d%H%M%S') + '.000')
+
+    def test_anonymize_with_shift(self):
+        """Test that anonymizing with a date shift keeps shifted dates instead of flattening them"""
+        self.in_args.extend(['-an', 'anon', '-dshift', '7'])
+        file_count, dataset = self.instanciate_sut_transform(dcm_transform.parse_arguments(self.in_args))
+        self.assertNotEqual(dataset.StudyDate, '19010101')
+        self.assertNotEqual(dataset.StudyDate, self.dataset.StudyDate)
+        self.assertEqual(dataset.StudyTime, self.dataset.StudyTime)
+
+
 class DcmTestTagChanges(DcmTestCase):
     """ Test dcm_transform tag changing options"""
 
@@ -147,6 +1249,41 @@ class DcmTestTagChanges(DcmTestCase):
         self.assertEqual(dataset.PatientID, '1234')
         self.assertEqual(dataset.PatientBirthDate, '19420402')
 
+    def test_custom_tags(self):
+        """Test the compiled custom tag edits: hex tags, nested paths, typed values, create and delete"""
+        step = dicom.dataset.Dataset()
+        step.ScheduledProcedureStepID = 'old'
+        self.dataset.RequestAttributesSequence = dicom.sequence.Sequence([step, dicom.dataset.Dataset()])
+        self.dataset.PatientComments = 'to delete'
+        edits = dcm_transform.compile_tag_edits(
+            ['(0010,0020)', 'hexid', '+0x00280106', '5', '~PatientComments',
+             '(0040,0275)[*].ScheduledProcedureStepID', 'new',
+             '+RequestAttributesSequence[1].(0040,0007)', 'created', '+(0011,1001):LO', 'private'])
+        self.assertEqual(len(edits), 6)
+        dcm_transform.assign_custom_tags(self.dataset, edits)
+
+        self.assertEqual(self.dataset.PatientID, 'hexid')
+        self.assertEqual(self.dataset.SmallestImagePixelValue, 5)
+        self.assertFalse('PatientComments' in self.dataset)
+        self.assertEqual(self.dataset.RequestAttributesSequence[0].ScheduledProcedureStepID, 'new')
+        self.assertFalse('ScheduledProcedureStepID' in self.dataset.RequestAttributesSequence[1])
+        self.assertEqual(self.dataset.RequestAttributesSequence[1].ScheduledProcedureStepDescription, 'created')
+        self.assertEqual(self.dataset[0x00111001].VR, 'LO')
+
+    def test_tag_file(self):
+        """Test custom tags read from a tag file, invalid lines being ignored"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            tag_filename = os.path.join(work_dir, 'tags.txt')
+            with open(tag_filename, 'w') as tag_file:
+                tag_file.write('# patient\nPatientName doe^jane smith\n+(0011,1001) no VR\nNoSuchTag x\n')
+            self.in_args.extend(['-tagfile', tag_filename])
+            file_count, dataset = self.instanciate_sut_transform(dcm_transform.parse_arguments(self.in_args))
+            self.assertEqual(dataset.PatientName, 'doe^jane smith')
+            self.assertFalse(0x00111001 in dataset)
+        finally:
+            shutil.rmtree(work_dir)
+
     def test_generate_uids(self):
         """Test common patient tags settings"""
         self.assertNotEqual(self.series_uid, self.dataset.SeriesInstanceUID)